@@ -0,0 +1,392 @@
+"""Đo hiệu năng các handler của bot trên mạng măng xông giả lập
+
+Chạy trong cùng tiến trình, không cần Telegram: Update/Context giả, bot
+giả ghi lại tin đã gửi. Mỗi lệnh được đo độ trễ p50/p95/p99, bộ nhớ cấp
+phát (tracemalloc) và bộ nhớ đỉnh; kết quả có thể lưu thành baseline JSON
+và so sánh với lần chạy sau để phát hiện chậm đi.
+
+Ví dụ:
+    python bench.py --sizes 100,1000,10000 --save bench_baseline.json
+    python bench.py --sizes 100,1000,10000 --compare bench_baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+import contextlib
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import check
+
+# Số lần đo mặc định cho mỗi lệnh
+DEFAULT_ITERATIONS = 200
+# /download tạo một sheet cho mỗi măng xông nên chỉ đo ít lần
+DOWNLOAD_MAX_CLOSURES = 10000
+DOWNLOAD_ITERATIONS = 5
+# /download chạy với giới hạn số file mở thấp hơn số sheet, để phát hiện việc giữ một file mỗi sheet
+DOWNLOAD_FD_LIMIT = 256
+# Số măng xông mỗi lần /importmx và mỗi lần ghi gộp của WORKBOOK_FLUSHER
+IMPORT_BATCH = 20
+FLUSH_BATCH = 20
+# Các lệnh ghi file Excel hoặc thêm măng xông (làm mạng lớn dần) chỉ đo ít lần
+WRITE_ITERATIONS = 20
+# Số măng xông nối tiếp nhau trên một tuyến cáp (cho /trace)
+CABLE_ROUTE_LENGTH = 50
+# Tỉ lệ chậm đi (so với baseline) bị coi là hồi quy
+REGRESSION_THRESHOLD = 1.25
+
+
+class FakeMessage:
+    """Tin nhắn giả: ghi lại mọi nội dung bot trả lời"""
+
+    def __init__(self, text='', chat_id=1, document=None):
+        self.text = text
+        self.chat_id = chat_id
+        self.location = None
+        self.document = document
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent), text=text)
+
+    async def reply_document(self, document, caption=None, **kwargs):
+        # Đọc hết file như khi tải lên Telegram
+        if hasattr(document, 'read'):
+            document.read()
+        self.sent.append(caption)
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"BENCH{len(self.sent)}"))
+
+
+class FakeBot:
+    """Bot giả: ghi lại tin gửi qua context.bot (vd. tin báo tiến độ của /addmx)"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent), text=text)
+
+
+def fake_document(filename, data):
+    """File đính kèm giả, tải về trả lại data"""
+    async def download_as_bytearray():
+        return bytearray(data)
+
+    async def get_file():
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    return SimpleNamespace(file_name=filename, file_size=len(data), get_file=get_file)
+
+
+def fake_update(text='', username='bench', chat_id=1, document=None):
+    """Update giả cho một tin nhắn văn bản hoặc file"""
+    message = FakeMessage(text, chat_id, document)
+    user = SimpleNamespace(id=chat_id, username=username, first_name=username)
+    return SimpleNamespace(message=message, effective_message=message, effective_user=user,
+                           effective_chat=SimpleNamespace(id=chat_id, type='private'))
+
+
+def fake_context(user_data=None, args=None):
+    """Context giả với bot không gửi gì ra ngoài"""
+    return SimpleNamespace(user_data={} if user_data is None else user_data, args=args or [],
+                           bot=FakeBot(), bot_data={})
+
+
+def build_network(size, fiber_count=check.DEFAULT_FIBER_COUNT, seed=1):
+    """Tạo mạng giả lập size măng xông với đấu nối ngẫu nhiên rồi nạp vào kho bộ nhớ"""
+    rng = random.Random(seed)
+    check.CONNECTIONS.clear()
+    for index in range(size):
+        outputs = list(range(1, fiber_count + 1))
+        rng.shuffle(outputs)
+        check.CONNECTIONS[f"MX{index:06d}"] = {
+            'location': {'lat': 10 + rng.random() * 2, 'long': 106 + rng.random() * 2},
+            'connections': dict(zip(range(1, fiber_count + 1), outputs)),
+            'fiber_count': fiber_count
+        }
+    check.init_store('memory')
+    names = sorted(check.CONNECTIONS)
+
+    # Nối các măng xông thành từng tuyến cáp để /trace đi qua nhiều chặng
+    for index, mx_name in enumerate(names[:-1]):
+        if (index + 1) % CABLE_ROUTE_LENGTH:
+            check.link_cable_segment(mx_name, names[index + 1])
+    return names
+
+
+def import_csv(names, fiber_count=check.DEFAULT_FIBER_COUNT):
+    """File CSV /importmx cho các măng xông names, đấu thẳng"""
+    lines = ['TenMX,Lat,Long,SoSoi,DauVao,DauRa']
+    for mx_name in names:
+        lines.append(f"{mx_name},10.5,106.5,{fiber_count},1,1")
+        lines.extend(f"{mx_name},,,,{fiber},{fiber}" for fiber in range(2, fiber_count + 1))
+    return "\n".join(lines).encode('utf-8')
+
+
+@contextlib.contextmanager
+def limit_open_files(limit):
+    """Tạm hạ giới hạn số file mở của tiến trình (bỏ qua nếu không hỗ trợ)"""
+    if resource is None:
+        yield
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(limit, soft), hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def make_commands(names, rng):
+    """Các lệnh cần đo: tên -> hàm async chạy một lần lệnh"""
+
+    async def get_mx():
+        await check.handle_get_mx(fake_update(rng.choice(names)), fake_context())
+
+    async def find_mx():
+        await check.handle_find_mx(fake_update(rng.choice(names).lower()), fake_context())
+
+    async def find_mx_fuzzy():
+        # Tên gõ thiếu để đo đường gợi ý tên
+        await check.handle_find_mx(fake_update(rng.choice(names)[:-2]), fake_context())
+
+    async def near_mx():
+        await check.handle_near_mx(
+            fake_update(f"{10 + rng.random() * 2},{106 + rng.random() * 2}"), fake_context())
+
+    async def edit_flow():
+        mx_name = rng.choice(names)
+        context = fake_context()
+        await check.handle_edit_mx(fake_update(mx_name), context)
+        fiber_count = check.get_fiber_count(check.get_store().get(mx_name))
+        pair = f"{rng.randint(1, fiber_count)}:{rng.randint(1, fiber_count)}"
+        await check.handle_edit_mx_connection(fake_update(pair), context)
+        await check.handle_edit_mx_connection(fake_update('done'), context)
+
+    async def trace():
+        mx_name = rng.choice(names)
+        fiber_count = check.get_fiber_count(check.get_store().get(mx_name))
+        await check.trace_mx(fake_update(), fake_context(args=[mx_name, str(rng.randint(1, fiber_count))]))
+
+    async def trace_cold():
+        # Bỏ bộ nhớ đệm trace để đo việc đi hết tuyến cáp
+        check.CABLE_GRAPH.invalidate()
+        await trace()
+
+    async def flush():
+        # Ghi gộp một lô măng xông vừa sửa vào file Excel chính
+        for mx_name in rng.sample(names, min(FLUSH_BATCH, len(names))):
+            check.WORKBOOK_FLUSHER.mark_dirty(mx_name)
+        await check.WORKBOOK_FLUSHER.flush()
+
+    async def download():
+        await check.download(fake_update(), fake_context())
+
+    async def download_cold():
+        # Dữ liệu vừa đổi: phải tạo lại file Excel
+        check.mark_data_changed()
+        await check.download(fake_update(), fake_context())
+
+    added = iter(range(1, sys.maxsize))
+
+    async def add_flow():
+        fiber_count = check.DEFAULT_FIBER_COUNT
+        context = fake_context()
+        await check.handle_add_mx_name(fake_update(f"BENCHADD{next(added)},10.5,106.5"), context)
+        half = fiber_count // 2
+        await check.handle_add_mx_connections(fake_update(f"1-{half}:1-{half}"), context)
+        await check.handle_add_mx_connections(
+            fake_update(f"{half + 1}-{fiber_count}:{half + 1}-{fiber_count}, done"), context)
+
+    async def import_flow():
+        batch = next(added)
+        data = import_csv([f"BENCHIMP{batch}-{index}" for index in range(IMPORT_BATCH)])
+        await check.handle_import_document(
+            fake_update(document=fake_document('bench.csv', data)), fake_context())
+
+    commands = {
+        'getmx': get_mx,
+        'findmx': find_mx,
+        'findmx_fuzzy': find_mx_fuzzy,
+        'nearmx': near_mx,
+        'editmx': edit_flow,
+        'trace': trace,
+        'trace_cold': trace_cold,
+    }
+    if len(names) <= DOWNLOAD_MAX_CLOSURES:
+        commands['flush'] = flush
+        commands['download_cold'] = download_cold
+        commands['download_cached'] = download
+    # Thêm măng xông làm mạng lớn dần: đo sau cùng
+    commands['addmx'] = add_flow
+    commands['importmx'] = import_flow
+    return commands
+
+
+def percentile(samples, fraction):
+    """Phân vị theo nội suy tuyến tính"""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+async def measure(command, iterations):
+    """Đo một lệnh: độ trễ (ms) ở lượt không bật tracemalloc, bộ nhớ ở lượt bật tracemalloc"""
+    await command()  # làm nóng bộ nhớ đệm và import
+
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await command()
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    memory_iterations = max(1, iterations // 10)
+    allocated = []
+    tracemalloc.start()
+    peak = 0
+    try:
+        for _ in range(memory_iterations):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            await command()
+            after, call_peak = tracemalloc.get_traced_memory()
+            allocated.append(max(0, after - before))
+            peak = max(peak, call_peak - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(latencies, 0.50), 4),
+        'p95_ms': round(percentile(latencies, 0.95), 4),
+        'p99_ms': round(percentile(latencies, 0.99), 4),
+        'mean_ms': round(statistics.fmean(latencies), 4),
+        'retained_kib': round(statistics.fmean(allocated) / 1024, 2),
+        'peak_kib': round(peak / 1024, 2),
+    }
+
+
+async def run_size(size, iterations, only=None):
+    """Đo mọi lệnh trên mạng size măng xông"""
+    started = time.perf_counter()
+    names = build_network(size)
+    build_seconds = time.perf_counter() - started
+    print(f"\n== {size} măng xông (dựng mạng {build_seconds:.2f}s) ==")
+
+    results = {}
+    rng = random.Random(size)
+    commands = make_commands(names, rng)
+    if 'flush' in commands and (not only or 'flush' in only):
+        # WORKBOOK_FLUSHER vá file Excel chính nên file phải có sẵn
+        await check.create_excel_file_async(check.MAIN_EXCEL_FILE)
+    for name, command in commands.items():
+        if only and name not in only:
+            continue
+        count = iterations
+        limit = contextlib.nullcontext()
+        if name.startswith('download'):
+            count = DOWNLOAD_ITERATIONS
+            limit = limit_open_files(DOWNLOAD_FD_LIMIT)
+        elif name in ('flush', 'addmx', 'importmx'):
+            count = min(iterations, WRITE_ITERATIONS)
+        with limit:
+            results[name] = await measure(command, count)
+        stats = results[name]
+        print(f"{name:16} p50 {stats['p50_ms']:9.3f} ms  p95 {stats['p95_ms']:9.3f} ms  "
+              f"p99 {stats['p99_ms']:9.3f} ms  giữ lại {stats['retained_kib']:9.2f} KiB  "
+              f"đỉnh {stats['peak_kib']:9.2f} KiB")
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """So sánh p95 với baseline, trả về danh sách các lệnh chậm đi"""
+    regressions = []
+    for size, commands in results.items():
+        for name, stats in commands.items():
+            base = baseline.get('results', {}).get(size, {}).get(name)
+            if not base or not base['p95_ms']:
+                continue
+            ratio = stats['p95_ms'] / base['p95_ms']
+            if ratio > threshold:
+                regressions.append(
+                    f"{size} măng xông / {name}: p95 {base['p95_ms']:.3f} -> {stats['p95_ms']:.3f} ms "
+                    f"(x{ratio:.2f})"
+                )
+    return regressions
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='mx_bench_')
+    check.MAIN_EXCEL_FILE = os.path.join(workdir, 'bench.xlsx')
+    check.PERMISSION_FILE = os.path.join(workdir, 'quyen.xlsx')
+    # Ghi Excel sau các lần sửa được gộp lại, không để chạy giữa các lượt đo
+    check.WORKBOOK_FLUSHER = check.WorkbookFlusher(quiet_delay=3600, max_delay=3600)
+
+    results = {}
+    try:
+        for size in args.sizes:
+            results[str(size)] = await run_size(size, args.iterations, args.only)
+    finally:
+        check.WORKBOOK_FLUSHER._dirty.clear()
+        await check.WORKBOOK_FLUSHER.close()
+        check.shutdown_workbook_executor()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'iterations': args.iterations,
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"\nĐã lưu baseline vào {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nChậm hơn baseline quá {args.threshold}x:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nKhông có lệnh nào chậm hơn baseline quá {args.threshold}x")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo hiệu năng các handler của bot măng xông")
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        type=lambda text: [int(part) for part in text.split(',') if part],
+                        help="Số măng xông của các mạng giả lập, cách nhau bởi dấu phẩy (tối đa 100000)")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help="Số lần đo mỗi lệnh")
+    parser.add_argument('--only', type=lambda text: set(text.split(',')), help="Chỉ đo các lệnh này")
+    parser.add_argument('--save', help="Lưu kết quả thành file baseline JSON")
+    parser.add_argument('--compare', help="So sánh với file baseline JSON, trả mã lỗi 1 nếu chậm đi")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Tỉ lệ p95 so với baseline bị coi là chậm đi")
+    args = parser.parse_args()
+
+    # Chỉ giữ cảnh báo để log không làm sai lệch số đo
+    check.logger.setLevel('WARNING')
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
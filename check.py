@@ -1,16 +1,52 @@
+import time
+
+# Mốc bắt đầu nạp module, dùng cho báo cáo thời gian khởi động
+_STARTUP_STARTED = time.perf_counter()
+
 import os
-import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font
-import openpyxl
-import pytz
+import sys
+import importlib
+import math
+import heapq
+import bisect
+import asyncio
+import functools
+import threading
+import contextlib
+import sqlite3
+from array import array
+import re
+import struct
+import csv
+import io
+import unicodedata
+import html
+import json
+import gzip
+import pickle
+import multiprocessing
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+import zipfile
+import tempfile
+import posixpath
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from telegram import Update
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
+    TypeHandler,
     filters
 )
 import logging
@@ -22,57 +58,487 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Cấu hình timezone
-try:
-    import tzlocal
-
-    TIMEZONE = tzlocal.get_localzone()
-except:
-    TIMEZONE = pytz.timezone('Asia/Ho_Chi_Minh')
-
-# Quy định màu sắc cho từng sợi cáp quang (1-24)
-FIBER_COLORS = {
-    1: ('Xanh dương', '0000FF'),
-    2: ('Cam', 'FFA500'),
-    3: ('Xanh lá', '00FF00'),
-    4: ('Nâu', 'A52A2A'),
-    5: ('Xám', '808080'),
-    6: ('Trắng', 'FFFFFF'),
-    7: ('Đỏ', 'FF0000'),
-    8: ('Đen', '000000'),
-    9: ('Vàng', 'FFFF00'),
-    10: ('Tím', '800080'),
-    11: ('Hồng', 'FFC0CB'),
-    12: ('Xanh ngọc', '00FFFF'),
-    13: ('Xanh dương', '0000FF'),
-    14: ('Cam', 'FFA500'),
-    15: ('Xanh lá', '00FF00'),
-    16: ('Nâu', 'A52A2A'),
-    17: ('Xám', '808080'),
-    18: ('Trắng', 'FFFFFF'),
-    19: ('Đỏ', 'FF0000'),
-    20: ('Đen', '000000'),
-    21: ('Vàng', 'FFFF00'),
-    22: ('Tím', '800080'),
-    23: ('Hồng', 'FFC0CB'),
-    24: ('Xanh ngọc', '00FFFF')
-}
+# Các giai đoạn khởi động (tên, giây), xem trong log khi bot chạy và trong /stats
+STARTUP_PHASES = []
+_STARTUP_MARK = [_STARTUP_STARTED]
+
+
+def record_startup_phase(name):
+    """Ghi thời gian của giai đoạn khởi động vừa xong, tính từ mốc trước đó"""
+    now = time.perf_counter()
+    STARTUP_PHASES.append((name, now - _STARTUP_MARK[0]))
+    _STARTUP_MARK[0] = now
+
+
+def format_startup_report():
+    """Báo cáo thời gian khởi động theo từng giai đoạn"""
+    total = sum(seconds for _, seconds in STARTUP_PHASES)
+    lines = [f"Thời gian khởi động: {total * 1000:.0f} ms"]
+    lines.extend(f"  {name}: {seconds * 1000:.0f} ms" for name, seconds in STARTUP_PHASES)
+    return "\n".join(lines)
+
+
+record_startup_phase('import thư viện')
+
+
+class _LazyModule:
+    """Module nặng chỉ được import ở lần dùng đầu tiên (openpyxl, pytz, tzlocal)"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            started = time.perf_counter()
+            module = self._module = importlib.import_module(self._name)
+            elapsed = time.perf_counter() - started
+            METRICS.observe('mx_lazy_import_seconds', elapsed, module=self._name)
+            logger.info(f"Đã nạp module {self._name} trong {elapsed * 1000:.0f} ms")
+        return getattr(module, attr)
+
+
+openpyxl = _LazyModule('openpyxl')
+
+_TIMEZONE = []
+
+
+def get_timezone():
+    """Múi giờ cục bộ (tzlocal), mặc định Asia/Ho_Chi_Minh; chỉ import thư viện khi cần"""
+    if not _TIMEZONE:
+        try:
+            _TIMEZONE.append(_LazyModule('tzlocal').get_localzone())
+        except Exception:
+            _TIMEZONE.append(_LazyModule('pytz').timezone('Asia/Ho_Chi_Minh'))
+    return _TIMEZONE[0]
+
+# Số đo vận hành: histogram thời gian, bộ đếm và gauge, xem qua /stats hoặc endpoint Prometheus
+# Cổng endpoint /metrics (0 là tắt)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+# Cận trên của các bucket histogram (giây)
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Phân bố thời gian theo bucket cố định, ước lượng phân vị bằng nội suy trong bucket"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        # Phần tử cuối đếm các giá trị lớn hơn bucket lớn nhất
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Ước lượng phân vị q (0..1) theo giây"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = METRICS_BUCKETS[index - 1] if index else 0.0
+                upper = METRICS_BUCKETS[index] if index < len(METRICS_BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+
+class MetricsRegistry:
+    """Kho số đo của tiến trình, dùng được từ event loop lẫn thread pool workbook
+
+    Bộ đếm và histogram được khóa theo (tên, nhãn); gauge là hàm được gọi
+    lúc đọc nên không tốn gì trên đường xử lý.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        """Tăng bộ đếm"""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Ghi một lần đo thời gian vào histogram"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Đo thời gian chạy của khối lệnh vào histogram name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, func):
+        """Đăng ký gauge: func() trả về giá trị hiện tại"""
+        self.gauges[name] = func
+
+    def read_gauges(self):
+        """Giá trị hiện tại của mọi gauge (bỏ qua gauge lỗi)"""
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.warning(f"Không đọc được gauge {name}: {e}")
+        return values
+
+    def snapshot(self):
+        """Bản sao (bộ đếm, histogram) để đọc mà không giữ khóa lâu"""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                copied = Histogram()
+                copied.counts = list(histogram.counts)
+                copied.count, copied.total, copied.max = histogram.count, histogram.total, histogram.max
+                histograms[key] = copied
+        return counters, histograms
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+    def render_prometheus(self):
+        """Toàn bộ số đo theo định dạng văn bản của Prometheus"""
+        counters, histograms = self.snapshot()
+        lines = []
+        typed = set()
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(METRICS_BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram.total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        lines.append("# TYPE mx_uptime_seconds gauge")
+        lines.append(f"mx_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def render_summary(self):
+        """Tóm tắt số đo dễ đọc cho lệnh /stats"""
+        counters, histograms = self.snapshot()
+        uptime = int(time.time() - self.started)
+        lines = [f"Thống kê bot (đã chạy {uptime // 3600}h{uptime % 3600 // 60:02d}m)"]
+
+        gauges = self.read_gauges()
+        if gauges:
+            lines.append("\nHiện tại:")
+            lines.extend(f"  {name}: {value}" for name, value in sorted(gauges.items()))
+
+        if counters:
+            lines.append("\nBộ đếm:")
+            for (name, labels), value in sorted(counters.items()):
+                label_text = ', '.join(f"{key}={label}" for key, label in labels)
+                lines.append(f"  {name}{f' [{label_text}]' if label_text else ''}: {value}")
+
+        if histograms:
+            lines.append("\nThời gian (ms) - số lần, p50 / p95 / p99 / max:")
+            for (name, labels), histogram in sorted(histograms.items()):
+                label_text = ', '.join(f"{label}" for _, label in labels)
+                lines.append(
+                    f"  {name} [{label_text}]: {histogram.count} lần, "
+                    f"{histogram.quantile(0.5) * 1000:.1f} / {histogram.quantile(0.95) * 1000:.1f} / "
+                    f"{histogram.quantile(0.99) * 1000:.1f} / {histogram.max * 1000:.1f}"
+                )
+        return "\n".join(lines)
+
+
+METRICS = MetricsRegistry()
+
+
+class _ErrorCountingHandler(logging.Handler):
+    """Đếm mọi log mức ERROR trở lên theo hàm ghi log (các handler tự bắt lỗi và chỉ ghi log)"""
+
+    def emit(self, record):
+        METRICS.inc('mx_errors_total', where=record.funcName)
+
+
+logger.addHandler(_ErrorCountingHandler(logging.ERROR))
+
+
+def instrument_handler(func):
+    """Đo thời gian xử lý và đếm lỗi chưa bắt của một handler Telegram"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            METRICS.inc('mx_handler_exceptions_total', handler=name)
+            raise
+        finally:
+            METRICS.observe('mx_handler_seconds', time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+def count_cache(cache, hit):
+    """Đếm một lần tra bộ nhớ đệm"""
+    METRICS.inc('mx_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+# Quy định màu sắc sợi cáp quang: 12 màu chuẩn, lặp lại trong từng ống lỏng
+FIBER_COLOR_CYCLE = (
+    ('Xanh dương', '0000FF'),
+    ('Cam', 'FFA500'),
+    ('Xanh lá', '00FF00'),
+    ('Nâu', 'A52A2A'),
+    ('Xám', '808080'),
+    ('Trắng', 'FFFFFF'),
+    ('Đỏ', 'FF0000'),
+    ('Đen', '000000'),
+    ('Vàng', 'FFFF00'),
+    ('Tím', '800080'),
+    ('Hồng', 'FFC0CB'),
+    ('Xanh ngọc', '00FFFF')
+)
+# Số sợi trong một ống lỏng và trong một co nhiệt
+FIBERS_PER_TUBE = 12
+FIBERS_PER_HEAT_SHRINK = 2
+
+# Các loại cáp được hỗ trợ (số sợi)
+CABLE_PROFILES = (24, 48, 96, 144, 288)
+DEFAULT_FIBER_COUNT = 24
+
+
+def _build_fiber_table(fiber_count):
+    """Tạo bảng tra sợi -> (tên màu, mã màu, ống, co nhiệt, vị trí trong co)
+
+    Phần tử 0 để trống để tra trực tiếp bằng số sợi.
+    """
+    table = [None]
+    for fiber_num in range(1, fiber_count + 1):
+        color_name, color_hex = FIBER_COLOR_CYCLE[(fiber_num - 1) % len(FIBER_COLOR_CYCLE)]
+        tube = (fiber_num - 1) // FIBERS_PER_TUBE + 1
+        hs_name = f"HS-{(fiber_num - 1) // FIBERS_PER_HEAT_SHRINK + 1}"
+        hs_pos = f"{(fiber_num - 1) % FIBERS_PER_HEAT_SHRINK + 1}/{FIBERS_PER_HEAT_SHRINK}"
+        table.append((color_name, color_hex, tube, hs_name, hs_pos))
+    return tuple(table)
+
+
+# Bảng tra dựng sẵn cho từng loại cáp
+FIBER_TABLES = {fiber_count: _build_fiber_table(fiber_count) for fiber_count in CABLE_PROFILES}
+
+
+def get_fiber_table(fiber_count):
+    """Lấy bảng tra sợi của một loại cáp"""
+    try:
+        return FIBER_TABLES[fiber_count]
+    except KeyError:
+        raise ValueError(f"Loại cáp {fiber_count} sợi không được hỗ trợ")
+
+
+def get_fiber_count(mx_data):
+    """Số sợi của một măng xông"""
+    return mx_data.get('fiber_count', DEFAULT_FIBER_COUNT)
+
+
+def get_data_version(mx_data):
+    """Phiên bản đấu nối của một măng xông, tăng mỗi lần ghi"""
+    return mx_data.get('version', 1)
+
+
+class SpliceMap:
+    """Bảng đấu nối của một măng xông dạng hoán vị, lưu bằng array('H')
+
+    _forward[i] là đầu ra của sợi đầu vào i, _inverse[o] là sợi đầu vào
+    đang dùng đầu ra o (0 nghĩa là chưa đấu), nên tra cứu theo cả hai chiều,
+    kiểm tra trùng đầu ra và hoán đổi đều là O(1). Hỗ trợ các thao tác kiểu
+    dict (get, items, keys, values, in, len) để dùng thay cho dict cũ.
+    copy() chỉ chép mảng khi một trong hai bản bị sửa (copy-on-write).
+    """
+
+    __slots__ = ('_forward', '_inverse', '_count', '_shared')
+
+    def __init__(self, fiber_count=DEFAULT_FIBER_COUNT, pairs=None):
+        self._forward = array('H', bytes(2 * (fiber_count + 1)))
+        self._inverse = array('H', bytes(2 * (fiber_count + 1)))
+        self._count = 0
+        self._shared = False
+        if pairs:
+            for input_fiber, output_fiber in (pairs.items() if hasattr(pairs, 'items') else pairs):
+                self[input_fiber] = output_fiber
+
+    @property
+    def fiber_count(self):
+        """Số sợi của loại cáp"""
+        return len(self._forward) - 1
+
+    def _check_fiber(self, fiber_num):
+        if not 1 <= fiber_num <= self.fiber_count:
+            raise KeyError(fiber_num)
+
+    def _unshare(self):
+        """Tách mảng dùng chung trước khi sửa"""
+        if self._shared:
+            self._forward = array('H', self._forward)
+            self._inverse = array('H', self._inverse)
+            self._shared = False
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, input_fiber):
+        return isinstance(input_fiber, int) and 1 <= input_fiber <= self.fiber_count \
+            and self._forward[input_fiber] != 0
+
+    def __getitem__(self, input_fiber):
+        self._check_fiber(input_fiber)
+        output_fiber = self._forward[input_fiber]
+        if not output_fiber:
+            raise KeyError(input_fiber)
+        return output_fiber
+
+    def get(self, input_fiber, default=None):
+        """Đầu ra của sợi đầu vào, hoặc default nếu chưa đấu"""
+        if input_fiber in self:
+            return self._forward[input_fiber]
+        return default
+
+    def input_for(self, output_fiber):
+        """Sợi đầu vào đang dùng đầu ra output_fiber, hoặc None"""
+        if not 1 <= output_fiber <= self.fiber_count:
+            return None
+        return self._inverse[output_fiber] or None
+
+    def __setitem__(self, input_fiber, output_fiber):
+        self._check_fiber(input_fiber)
+        self._check_fiber(output_fiber)
+        owner = self._inverse[output_fiber]
+        if owner and owner != input_fiber:
+            raise ValueError(f"Sợi đầu ra {output_fiber} đã được sử dụng bởi sợi đầu vào {owner}")
+
+        self._unshare()
+        old_output = self._forward[input_fiber]
+        if old_output:
+            self._inverse[old_output] = 0
+        else:
+            self._count += 1
+        self._forward[input_fiber] = output_fiber
+        self._inverse[output_fiber] = input_fiber
+
+    def __delitem__(self, input_fiber):
+        output_fiber = self[input_fiber]
+        self._unshare()
+        self._forward[input_fiber] = 0
+        self._inverse[output_fiber] = 0
+        self._count -= 1
+
+    def swap_outputs(self, input_a, input_b):
+        """Hoán đổi đầu ra của hai sợi đầu vào đã đấu"""
+        output_a, output_b = self[input_a], self[input_b]
+        self._unshare()
+        self._forward[input_a], self._forward[input_b] = output_b, output_a
+        self._inverse[output_a], self._inverse[output_b] = input_b, input_a
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        forward = self._forward
+        return (i for i in range(1, len(forward)) if forward[i])
+
+    def values(self):
+        return (o for o in self._forward[1:] if o)
+
+    def items(self):
+        forward = self._forward
+        return ((i, forward[i]) for i in range(1, len(forward)) if forward[i])
+
+    def copy(self):
+        """Bản sao dùng chung mảng cho tới khi một bên bị sửa"""
+        clone = SpliceMap.__new__(SpliceMap)
+        clone._forward = self._forward
+        clone._inverse = self._inverse
+        clone._count = self._count
+        clone._shared = self._shared = True
+        return clone
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, SpliceMap):
+            return self._forward == other._forward
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __reduce__(self):
+        return (_splice_map_from_bytes, (self._forward.tobytes(),))
+
+    def __repr__(self):
+        return f"SpliceMap({self.fiber_count}, {self.to_dict()})"
+
+
+def _splice_map_from_bytes(data):
+    """Dựng lại SpliceMap từ mảng chiều xuôi đã tuần tự hóa"""
+    forward = array('H')
+    forward.frombytes(data)
+    splice_map = SpliceMap(len(forward) - 1)
+    for input_fiber in range(1, len(forward)):
+        if forward[input_fiber]:
+            splice_map[input_fiber] = forward[input_fiber]
+    return splice_map
+
+
+def as_splice_map(connections, fiber_count=DEFAULT_FIBER_COUNT, mx_name=None):
+    """Chuyển dict đấu nối sang SpliceMap, bỏ qua (và ghi log) các cặp trùng đầu ra"""
+    if isinstance(connections, SpliceMap):
+        return connections
+    splice_map = SpliceMap(fiber_count)
+    for input_fiber, output_fiber in connections.items():
+        try:
+            splice_map[input_fiber] = output_fiber
+        except (KeyError, ValueError) as e:
+            logger.warning(f"Bỏ qua cặp đấu nối {input_fiber}:{output_fiber} của {mx_name}: {e}")
+    return splice_map
 
-# Dictionary mẫu cho co nhiệt
-HEAT_SHRINKS = {
-    'HS-1': [1, 2],
-    'HS-2': [3, 4],
-    'HS-3': [5, 6],
-    'HS-4': [7, 8],
-    'HS-5': [9, 10],
-    'HS-6': [11, 12],
-    'HS-7': [13, 14],
-    'HS-8': [15, 16],
-    'HS-9': [17, 18],
-    'HS-10': [19, 20],
-    'HS-11': [21, 22],
-    'HS-12': [23, 24]
-}
 
 # Kết nối mẫu
 CONNECTIONS = {
@@ -97,12 +563,71 @@ PERMISSION_FILE = 'quyen.xlsx'
 # File Excel chính
 MAIN_EXCEL_FILE = 'mang_xong_cap_quang.xlsx'
 
+# Kho lưu trữ mạng măng xông: 'sqlite' (mặc định) hoặc 'memory'
+STORE_BACKEND = os.getenv('MX_STORE_BACKEND', 'sqlite')
+# File cơ sở dữ liệu SQLite
+STORE_FILE = os.getenv('MX_STORE_FILE', 'mang_xong_cap_quang.db')
+
+# Phiên bản dữ liệu, tăng mỗi khi CONNECTIONS thay đổi
+DATA_VERSION = 0
+# Bộ nhớ đệm cho /download: file đã tạo và file_id Telegram theo phiên bản dữ liệu
+_DOWNLOAD_CACHE = {'version': None, 'path': None, 'mtime': None, 'file_id': None}
+
+# Tạo file Excel tổng hợp bằng cách ghi thẳng XML từng sheet vào file zip (không qua openpyxl):
+# không giữ file tạm nào mở theo từng sheet, bộ nhớ chỉ cần đủ cho một sheet
+EXCEL_WRITE_ONLY = os.getenv('EXCEL_WRITE_ONLY', '1') != '0'
+
+# Số job xử lý workbook (openpyxl) được chạy đồng thời
+WORKBOOK_MAX_JOBS = max(1, int(os.getenv('WORKBOOK_MAX_JOBS', '2')))
+_WORKBOOK_EXECUTOR = None
+# Khóa ghi file Excel chính để các job song song không ghi đè lên nhau
+_EXCEL_FILE_LOCK = threading.RLock()
+
 # Thêm trạng thái mới vào các biến trạng thái hiện có
-FIND_MX, GET_MX, ADD_MX_NAME, ADD_MX_CONNECTIONS, EDIT_MX, EDIT_MX_CONNECTION = range(6)
+FIND_MX, GET_MX, ADD_MX_NAME, ADD_MX_CONNECTIONS, EDIT_MX, EDIT_MX_CONNECTION, NEAR_MX, IMPORT_MX = range(8)
+
+
+def get_workbook_executor():
+    """Lấy thread pool dành riêng cho các thao tác đọc/ghi workbook"""
+    global _WORKBOOK_EXECUTOR
+    if _WORKBOOK_EXECUTOR is None:
+        _WORKBOOK_EXECUTOR = ThreadPoolExecutor(
+            max_workers=WORKBOOK_MAX_JOBS,
+            thread_name_prefix='workbook'
+        )
+    return _WORKBOOK_EXECUTOR
+
+
+def shutdown_workbook_executor():
+    """Đợi các job workbook đang chạy xong rồi đóng thread pool"""
+    global _WORKBOOK_EXECUTOR
+    if _WORKBOOK_EXECUTOR is not None:
+        _WORKBOOK_EXECUTOR.shutdown(wait=True)
+        _WORKBOOK_EXECUTOR = None
+
 
+async def run_workbook_job(func, *args, **kwargs):
+    """Chạy một hàm workbook đồng bộ trong thread pool để không chặn event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_workbook_executor(), functools.partial(func, *args, **kwargs))
 
-def create_excel_file(filename=None):
-    """Tạo file Excel mẫu cho quản lý măng xông cáp quang (phiên bản đồng bộ)"""
+
+def create_excel_file(filename=None, write_only=None, closures=None):
+    """Tạo file Excel mẫu cho quản lý măng xông cáp quang (phiên bản đồng bộ)
+
+    closures là danh sách (tên, dữ liệu măng xông) cần ghi, mặc định là toàn bộ kho.
+    """
+    with _EXCEL_FILE_LOCK:
+        return _create_excel_file(filename, write_only, closures)
+
+
+async def create_excel_file_async(filename=None, write_only=None):
+    """Tạo file Excel trong thread pool workbook"""
+    return await run_workbook_job(create_excel_file, filename, write_only)
+
+
+def _create_excel_file(filename=None, write_only=None, closures=None):
+    """Tạo file Excel (gọi khi đã giữ khóa file Excel)"""
     try:
         # Sử dụng filename mặc định nếu không được cung cấp
         if filename is None:
@@ -116,276 +641,2255 @@ def create_excel_file(filename=None):
         os.makedirs(dir_path, exist_ok=True)
 
         logger.info(f"Đang tạo file Excel tại: {abs_path}")
-        print(f"Đang tạo file Excel tại: {abs_path}")
 
-        wb = Workbook()
+        if write_only is None:
+            write_only = EXCEL_WRITE_ONLY
+        if closures is None:
+            closures = get_store().items()
+
+        if write_only:
+            with METRICS.timer('mx_workbook_io_seconds', op='save'):
+                _stream_xlsx(filename, closures)
+            logger.info(f"Đã tạo file Excel thành công tại: {abs_path}")
+            return abs_path
+
+        wb = openpyxl.Workbook()
 
         # Tạo sheet cho từng măng xông
-        for mx_name, mx_data in CONNECTIONS.items():
+        for mx_name, mx_data in closures:
             ws = wb.create_sheet(title=mx_name)
-
-            # Thêm thông tin vị trí
-            ws['A1'] = 'Tên măng xông:'
-            ws['B1'] = mx_name
-            ws['A2'] = 'Vị trí (lat):'
-            ws['B2'] = mx_data['location']['lat']
-            ws['A3'] = 'Vị trí (long):'
-            ws['B3'] = mx_data['location']['long']
-
-            # Tiêu đề các cột
-            headers = ['STT', 'Màu sắc', 'Co nhiệt', 'Vị trí trong co', 'Đầu vào', 'Đầu ra', 'Ghi chú']
-            ws.append(headers)
-
-            # Định dạng tiêu đề
-            for col in range(1, len(headers) + 1):
-                ws.cell(row=4, column=col).font = Font(bold=True)
-
-            # Thêm dữ liệu cho từng sợi
-            for fiber_num in range(1, 25):
-                color_name, color_hex = FIBER_COLORS[fiber_num]
-
-                # Tìm co nhiệt chứa sợi này
-                hs_name = ''
-                hs_pos = ''
-                for hs, fibers in HEAT_SHRINKS.items():
-                    if fiber_num in fibers:
-                        hs_name = hs
-                        pos = fibers.index(fiber_num) + 1
-                        hs_pos = f"{pos}/{len(fibers)}"
-                        break
-
-                # Xác định đầu ra
-                output_fiber = mx_data['connections'].get(fiber_num, fiber_num)
-
-                # Xác định ghi chú
-                note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
-
-                # Thêm dòng dữ liệu
-                ws.append([
-                    fiber_num,
-                    color_name,
-                    hs_name,
-                    hs_pos,
-                    fiber_num,
-                    output_fiber,
-                    note
-                ])
-
-            # Định dạng màu cho các ô
-            for row in range(5, 29):  # Dòng 5-28 tương ứng với sợi 1-24
-                # Màu sợi cáp
-                fiber_num = ws.cell(row=row, column=1).value
-                if fiber_num:
-                    _, color_hex = FIBER_COLORS[fiber_num]
-                    fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid')
-                    ws.cell(row=row, column=2).fill = fill
-
-                    # Màu chữ (đen hoặc trắng tùy vào màu nền)
-                    text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
-                    ws.cell(row=row, column=2).font = Font(color=text_color)
-
-                # Định dạng có điều kiện cho cột đầu vào và đầu ra
-                for col in [5, 6]:  # Cột E (5) và F (6)
-                    cell = ws.cell(row=row, column=col)
-                    if cell.value:
-                        _, color_hex = FIBER_COLORS[cell.value]
-                        fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid')
-                        cell.fill = fill
-                        text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
-                        cell.font = Font(color=text_color)
-
-            # Thiết lập Data Validation cho cột đầu vào và đầu ra
-            dv = openpyxl.worksheet.datavalidation.DataValidation(
-                type="whole",
-                operator="between",
-                formula1="1",
-                formula2="24",
-                showErrorMessage=True,
-                errorTitle="Giá trị không hợp lệ",
-                error="Vui lòng nhập số từ 1 đến 24"
+            _write_mx_sheet(
+                ws,
+                mx_name,
+                mx_data['location']['lat'],
+                mx_data['location']['long'],
+                mx_data['connections'],
+                get_fiber_count(mx_data)
             )
-            ws.add_data_validation(dv)
-            dv.add('E5:E28')  # Cột Đầu vào
-            dv.add('F5:F28')  # Cột Đầu ra
-
-            # Đặt chiều rộng cột
-            column_widths = {'A': 8, 'B': 12, 'C': 10, 'D': 12, 'E': 10, 'F': 10, 'G': 15}
-            for col, width in column_widths.items():
-                ws.column_dimensions[col].width = width
 
         # Xóa sheet mặc định
         if 'Sheet' in wb.sheetnames:
             del wb['Sheet']
 
         # Lưu file với tên chính xác
-        wb.save(filename)
+        with METRICS.timer('mx_workbook_io_seconds', op='save'):
+            wb.save(filename)
         logger.info(f"Đã tạo file Excel thành công tại: {abs_path}")
-        print(f"Đã tạo file Excel thành công tại: {abs_path}")
         return abs_path
     except PermissionError as e:
         error_msg = f"Lỗi quyền khi lưu file tại {abs_path}: {e}"
         logger.error(error_msg)
-        print(error_msg)
         raise Exception("Không có quyền ghi file. Vui lòng kiểm tra quyền thư mục.")
     except Exception as e:
         error_msg = f"Lỗi khi tạo file Excel tại {abs_path}: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        print(error_msg)
         raise Exception(f"Có lỗi xảy ra khi tạo file Excel: {str(e)}")
 
 
+# Bộ nhớ đệm phân quyền: username -> tập quyền, chỉ nạp lại khi file thay đổi
+# Quyền cao bao hàm quyền thấp hơn
+PERMISSION_IMPLIES = {
+    'admin': {'admin', 'write', 'read'},
+    'write': {'write', 'read'},
+    'read': {'read'}
+}
+_PERMISSION_CACHE = {'mtime': None, 'index': {}}
+
+
+def load_permission_index():
+    """Nạp bảng phân quyền vào bộ nhớ (chỉ đọc lại file khi mtime thay đổi)"""
+    try:
+        mtime = os.path.getmtime(PERMISSION_FILE)
+    except OSError:
+        _PERMISSION_CACHE['mtime'] = None
+        _PERMISSION_CACHE['index'] = {}
+        return _PERMISSION_CACHE['index']
+
+    hit = _PERMISSION_CACHE['mtime'] == mtime
+    count_cache('permission', hit)
+    if hit:
+        return _PERMISSION_CACHE['index']
+
+    # Đọc thẳng XML của sheet đầu tiên, không cần pandas/openpyxl cho một file nhỏ
+    with METRICS.timer('mx_workbook_io_seconds', op='read_permission'):
+        rows = read_xlsx_rows(PERMISSION_FILE)
+    header = [(value or '').strip().lower() for value in rows[0]] if rows else []
+    if 'username' not in header:
+        raise ValueError(f"File {PERMISSION_FILE} thiếu cột username")
+    username_column = header.index('username')
+    permission_column = header.index('permission') if 'permission' in header else None
+
+    index = {}
+    for row in rows[1:]:
+        username = row[username_column] if username_column < len(row) else None
+        if username is None or not username.strip():
+            continue
+        username = username.strip()
+
+        # File cũ không có cột permission: mọi user trong file đều có quyền ghi
+        raw = 'write'
+        if permission_column is not None and permission_column < len(row):
+            raw = row[permission_column] or ''
+        if not raw.strip():
+            raw = 'write'
+
+        granted = index.setdefault(username, set())
+        for perm in str(raw).lower().replace(';', ',').split(','):
+            perm = perm.strip()
+            if perm in PERMISSION_IMPLIES:
+                granted |= PERMISSION_IMPLIES[perm]
+            elif perm:
+                logger.warning(f"Quyền không hợp lệ '{perm}' của user {username} trong {PERMISSION_FILE}")
+
+    _PERMISSION_CACHE['mtime'] = mtime
+    _PERMISSION_CACHE['index'] = index
+    logger.info(f"Đã nạp bảng phân quyền: {len(index)} user")
+    return index
+
+
 def check_permission(username, permission_type='write'):
     """Kiểm tra quyền của user"""
-    if not os.path.exists(PERMISSION_FILE):
-        return False
+    if permission_type == 'read':
+        return True
 
     try:
-        df = pd.read_excel(PERMISSION_FILE)
-        if permission_type == 'write':
-            return username in df['username'].values
-        return True
+        index = load_permission_index()
+        return permission_type in index.get(username, ())
     except Exception as e:
         logger.error(f"Error reading permission file: {e}")
         return False
 
 
+async def check_permission_async(username, permission_type='write'):
+    """Kiểm tra quyền của user, chỉ đọc lại file phân quyền trong thread pool khi file đã đổi"""
+    if permission_type == 'read':
+        return True
+
+    try:
+        fresh = os.path.getmtime(PERMISSION_FILE) == _PERMISSION_CACHE['mtime']
+    except OSError:
+        fresh = False
+    if fresh:
+        return check_permission(username, permission_type)
+    return await run_workbook_job(check_permission, username, permission_type)
+
+
+def mark_data_changed(mx_name=None):
+    """Đánh dấu CONNECTIONS đã thay đổi để làm mất hiệu lực các bộ nhớ đệm"""
+    global DATA_VERSION
+    DATA_VERSION += 1
+    _DOWNLOAD_CACHE['version'] = None
+    _DOWNLOAD_CACHE['file_id'] = None
+    CABLE_GRAPH.invalidate(mx_name)
+    if mx_name is None:
+        # Có thể cả kho vừa được thay (phiên bản đánh lại từ đầu): bỏ toàn bộ bảng đã dựng
+        _RENDER_CACHE.clear()
+
+
+def get_cached_download():
+    """Trả về bộ nhớ đệm /download nếu còn khớp với dữ liệu hiện tại, ngược lại None"""
+    if _DOWNLOAD_CACHE['version'] != DATA_VERSION or not _DOWNLOAD_CACHE['path']:
+        return None
+    try:
+        mtime = os.path.getmtime(_DOWNLOAD_CACHE['path'])
+    except OSError:
+        return None
+    # File trên đĩa đã bị ghi đè bởi thao tác khác
+    if mtime != _DOWNLOAD_CACHE['mtime']:
+        return None
+    return _DOWNLOAD_CACHE
+
+
+def remember_download(version, path, file_id=None):
+    """Ghi nhớ file đã tạo cho /download ứng với phiên bản dữ liệu"""
+    _DOWNLOAD_CACHE['version'] = version
+    _DOWNLOAD_CACHE['path'] = path
+    _DOWNLOAD_CACHE['mtime'] = os.path.getmtime(path)
+    _DOWNLOAD_CACHE['file_id'] = file_id
+
+
+class MemoryStore:
+    """Kho lưu măng xông trong bộ nhớ, không bền vững (dùng khi chạy thử)
+
+    CONNECTIONS là bộ nhớ đệm đọc của kho: mọi thao tác ghi đi qua kho
+    rồi mới cập nhật vào CONNECTIONS, các thao tác đọc lấy từ bộ nhớ.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load(self):
+        """Nạp toàn bộ dữ liệu từ kho vào bộ nhớ đệm"""
+        for mx_name, mx_data in self.cache.items():
+            mx_data['connections'] = as_splice_map(mx_data['connections'], get_fiber_count(mx_data), mx_name)
+        return len(self.cache)
+
+    def get(self, mx_name):
+        """Lấy dữ liệu một măng xông theo tên"""
+        return self.cache.get(mx_name)
+
+    def items(self):
+        """Danh sách (tên, dữ liệu) của mọi măng xông"""
+        return list(self.cache.items())
+
+    def __contains__(self, mx_name):
+        return mx_name in self.cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def add(self, mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT, journal=()):
+        """Thêm măng xông mới, trả về False nếu tên đã tồn tại
+
+        journal là các dòng nhật ký thay đổi được ghi cùng transaction.
+        """
+        if mx_name in self.cache:
+            return False
+        connections = as_splice_map(connections, fiber_count, mx_name)
+        if not self._insert(mx_name, lat, long, connections, fiber_count, journal):
+            return False
+        self.cache[mx_name] = {
+            'location': {'lat': lat, 'long': long},
+            'connections': connections,
+            'fiber_count': fiber_count
+        }
+        return True
+
+    def add_many(self, closures, journal=()):
+        """Thêm nhiều măng xông trong một lần ghi: danh sách (tên, lat, long, đấu nối, số sợi)
+
+        Trả về False (và không ghi gì) nếu có tên đã tồn tại hoặc bị trùng.
+        """
+        names = [closure[0] for closure in closures]
+        if len(set(names)) != len(names) or any(name in self.cache for name in names):
+            return False
+        closures = [(name, lat, long, as_splice_map(connections, fiber_count, name), fiber_count)
+                    for name, lat, long, connections, fiber_count in closures]
+        if not self._insert_many(closures, journal):
+            return False
+        for name, lat, long, connections, fiber_count in closures:
+            self.cache[name] = {
+                'location': {'lat': lat, 'long': long},
+                'connections': connections,
+                'fiber_count': fiber_count
+            }
+        return True
+
+    def update_connections(self, mx_name, connections, expected_version=None, journal=()):
+        """Thay toàn bộ đấu nối của một măng xông
+
+        Với expected_version, chỉ ghi khi phiên bản hiện tại còn khớp
+        (compare-and-swap), ngược lại trả về False và không ghi gì.
+        """
+        mx_data = self.cache.get(mx_name)
+        if mx_data is None:
+            return False
+        version = get_data_version(mx_data)
+        if expected_version is not None and version != expected_version:
+            return False
+
+        connections = as_splice_map(connections, get_fiber_count(mx_data), mx_name)
+        if not self._update_connections(mx_name, connections, version, journal):
+            return False
+        # Người đọc không khóa: thay cả bản ghi để luôn thấy đấu nối và phiên bản khớp nhau
+        self.cache[mx_name] = dict(mx_data, connections=connections, version=version + 1)
+        return True
+
+    def set_next(self, mx_name, next_mx, journal=()):
+        """Nối cáp ra của mx_name vào cáp vào của next_mx (None để tháo)"""
+        if mx_name not in self.cache or (next_mx is not None and next_mx not in self.cache):
+            return False
+        self._set_next(mx_name, next_mx, journal)
+        if next_mx is None:
+            self.cache[mx_name].pop('next_mx', None)
+        else:
+            self.cache[mx_name]['next_mx'] = next_mx
+        return True
+
+    def close(self):
+        """Đóng kho"""
+
+    def _insert(self, mx_name, lat, long, connections, fiber_count, journal=()):
+        """Ghi măng xông mới xuống nơi lưu trữ, trả về False nếu tên đã có"""
+        return self._insert_many([(mx_name, lat, long, connections, fiber_count)], journal)
+
+    def _insert_many(self, closures, journal=()):
+        """Ghi nhiều măng xông mới xuống nơi lưu trữ, trả về False (không ghi gì) nếu có tên đã có"""
+        return True
+
+    def _update_connections(self, mx_name, connections, version, journal=()):
+        """Ghi đấu nối mới xuống nơi lưu trữ nếu phiên bản đã lưu vẫn là version"""
+        return True
+
+    def _set_next(self, mx_name, next_mx, journal=()):
+        """Ghi đoạn cáp nối tiếp xuống nơi lưu trữ"""
+
+
+class SQLiteStore(MemoryStore):
+    """Kho lưu măng xông trong SQLite: ghi theo transaction, đánh chỉ mục theo tên"""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS closures (
+            name TEXT PRIMARY KEY,
+            lat REAL NOT NULL,
+            long REAL NOT NULL,
+            fiber_count INTEGER NOT NULL DEFAULT 24,
+            version INTEGER NOT NULL DEFAULT 1
+        )""",
+        """CREATE TABLE IF NOT EXISTS splices (
+            mx_name TEXT NOT NULL REFERENCES closures(name) ON DELETE CASCADE,
+            input_fiber INTEGER NOT NULL,
+            output_fiber INTEGER NOT NULL,
+            PRIMARY KEY (mx_name, input_fiber)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS cable_segments (
+            from_mx TEXT PRIMARY KEY REFERENCES closures(name) ON DELETE CASCADE,
+            to_mx TEXT NOT NULL UNIQUE REFERENCES closures(name) ON DELETE CASCADE
+        )""",
+        # Nhật ký thay đổi để các worker khác dùng chung kho nạp lại bộ nhớ đệm
+        """CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            mx_name TEXT NOT NULL,
+            origin TEXT NOT NULL
+        )""",
+        # Nhật ký thay đổi chưa chép sang file nhật ký, ghi cùng transaction với thay đổi:
+        # seq là thứ tự commit giữa mọi worker và không mất dòng nào khi tiến trình dừng giữa chừng
+        """CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entry TEXT NOT NULL
+        )""",
+        # Quyền có thời hạn giữa các worker (ví dụ worker được ghi file Excel chung)
+        """CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        )""",
+    )
+
+    def __init__(self, cache, path):
+        super().__init__(cache)
+        self.path = path
+        # Tên worker ghi nhật ký thay đổi; None khi chỉ có một tiến trình dùng kho
+        self.origin = None
+        # Kết nối dùng chung cho event loop và thread pool workbook, bảo vệ bằng khóa
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+            # Cơ sở dữ liệu cũ chưa có cột số sợi
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(closures)')}
+            if 'fiber_count' not in columns:
+                self._conn.execute('ALTER TABLE closures ADD COLUMN fiber_count INTEGER NOT NULL DEFAULT 24')
+            if 'version' not in columns:
+                self._conn.execute('ALTER TABLE closures ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+    def load(self):
+        """Nạp toàn bộ măng xông từ SQLite vào bộ nhớ đệm"""
+        with self._lock:
+            closures = {
+                name: {'location': {'lat': lat, 'long': long}, 'connections': {},
+                       'fiber_count': fiber_count, 'version': version}
+                for name, lat, long, fiber_count, version in self._conn.execute(
+                    'SELECT name, lat, long, fiber_count, version FROM closures')
+            }
+            for mx_name, input_fiber, output_fiber in self._conn.execute(
+                    'SELECT mx_name, input_fiber, output_fiber FROM splices ORDER BY mx_name, input_fiber'):
+                closures[mx_name]['connections'][input_fiber] = output_fiber
+            for from_mx, to_mx in self._conn.execute('SELECT from_mx, to_mx FROM cable_segments'):
+                closures[from_mx]['next_mx'] = to_mx
+        for mx_name, mx_data in closures.items():
+            mx_data['connections'] = as_splice_map(mx_data['connections'], mx_data['fiber_count'], mx_name)
+        self.cache.clear()
+        self.cache.update(closures)
+        return len(closures)
+
+    def is_empty(self):
+        """Kiểm tra kho chưa có măng xông nào"""
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM closures LIMIT 1').fetchone() is None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _insert_many(self, closures, journal=()):
+        # Một transaction cho cả lô: lỗi ở bất kỳ măng xông nào thì không ghi gì
+        try:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    'INSERT INTO closures (name, lat, long, fiber_count) VALUES (?, ?, ?, ?)',
+                    [(mx_name, lat, long, fiber_count) for mx_name, lat, long, _, fiber_count in closures]
+                )
+                self._conn.executemany(
+                    'INSERT INTO splices (mx_name, input_fiber, output_fiber) VALUES (?, ?, ?)',
+                    [(mx_name, i, o) for mx_name, _, _, connections, _ in closures for i, o in connections.items()]
+                )
+                self._log_changes([closure[0] for closure in closures])
+                self._log_journal(journal)
+        except sqlite3.IntegrityError:
+            # Worker khác đã thêm măng xông cùng tên: cập nhật bộ nhớ đệm cho lần kiểm tra sau
+            self.reload([closure[0] for closure in closures])
+            return False
+        return True
+
+    def _update_connections(self, mx_name, connections, version, journal=()):
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                'UPDATE closures SET version = version + 1 WHERE name = ? AND version = ?',
+                (mx_name, version)
+            ).rowcount
+            if updated:
+                self._conn.execute('DELETE FROM splices WHERE mx_name = ?', (mx_name,))
+                self._conn.executemany(
+                    'INSERT INTO splices (mx_name, input_fiber, output_fiber) VALUES (?, ?, ?)',
+                    [(mx_name, i, o) for i, o in connections.items()]
+                )
+                self._log_changes([mx_name])
+                self._log_journal(journal)
+        if not updated and self.origin is not None:
+            # Bộ nhớ đệm cũ hơn bản đã lưu (worker khác vừa ghi): nạp lại để lần thử sau dùng bản mới
+            self.reload([mx_name])
+        return bool(updated)
+
+    def _set_next(self, mx_name, next_mx, journal=()):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM cable_segments WHERE from_mx = ?', (mx_name,))
+            if next_mx is not None:
+                self._conn.execute('INSERT INTO cable_segments (from_mx, to_mx) VALUES (?, ?)', (mx_name, next_mx))
+            self._log_changes([mx_name])
+            self._log_journal(journal)
+
+    def _log_journal(self, entries):
+        """Ghi các dòng nhật ký thay đổi trong transaction đang mở
+
+        Thời điểm được lấy khi đã giữ khóa ghi của cơ sở dữ liệu nên tăng
+        dần theo seq, kể cả khi nhiều worker cùng ghi.
+        """
+        if entries:
+            now = math.floor(time.time() * 1000) / 1000
+            self._conn.executemany(
+                'INSERT INTO journal (entry) VALUES (?)',
+                [(json.dumps({'t': now, **entry}, ensure_ascii=False, separators=(',', ':')),)
+                 for entry in entries]
+            )
+
+    def drain_journal(self, export):
+        """Chuyển các dòng nhật ký đã commit cho export([(seq, dòng JSON)]) theo thứ tự seq rồi xóa khỏi kho
+
+        Giữ khóa ghi của cơ sở dữ liệu trong lúc export để các worker không
+        chép chen vào nhau; export lỗi thì các dòng được giữ lại cho lần sau.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute('SELECT seq, entry FROM journal ORDER BY seq').fetchall()
+                if rows:
+                    export(rows)
+                    self._conn.execute('DELETE FROM journal WHERE seq <= ?', (rows[-1][0],))
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return len(rows)
+
+    def reserve_journal_seq(self, seq):
+        """Đảm bảo seq của dòng nhật ký tiếp theo lớn hơn seq (khi file nhật ký cũ hơn cơ sở dữ liệu)"""
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'journal'", (seq,)).rowcount
+            if not updated and seq:
+                self._conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('journal', ?)", (seq,))
+
+    def _log_changes(self, mx_names):
+        """Ghi nhật ký thay đổi trong transaction đang mở (chỉ khi chạy nhiều worker)"""
+        if self.origin is not None:
+            self._conn.executemany('INSERT INTO changes (mx_name, origin) VALUES (?, ?)',
+                                   [(mx_name, self.origin) for mx_name in mx_names])
+
+    def last_change(self):
+        """Số thứ tự của thay đổi mới nhất trong nhật ký"""
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def changes_since(self, seq):
+        """Các thay đổi sau seq: [(seq, tên măng xông, worker đã ghi)]"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT seq, mx_name, origin FROM changes WHERE seq > ? ORDER BY seq', (seq,)).fetchall()
+
+    def prune_changes(self, keep):
+        """Chỉ giữ lại keep thay đổi mới nhất trong nhật ký"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?', (keep,))
+
+    def reload(self, mx_names):
+        """Nạp lại một số măng xông từ SQLite vào bộ nhớ đệm (sau khi tiến trình khác ghi)"""
+        records = {}
+        with self._lock:
+            for mx_name in mx_names:
+                row = self._conn.execute(
+                    'SELECT lat, long, fiber_count, version FROM closures WHERE name = ?', (mx_name,)).fetchone()
+                if row is None:
+                    records[mx_name] = None
+                    continue
+                lat, long, fiber_count, version = row
+                connections = dict(self._conn.execute(
+                    'SELECT input_fiber, output_fiber FROM splices WHERE mx_name = ?', (mx_name,)))
+                next_mx = self._conn.execute(
+                    'SELECT to_mx FROM cable_segments WHERE from_mx = ?', (mx_name,)).fetchone()
+                records[mx_name] = {'location': {'lat': lat, 'long': long}, 'connections': connections,
+                                    'fiber_count': fiber_count, 'version': version}
+                if next_mx:
+                    records[mx_name]['next_mx'] = next_mx[0]
+
+        for mx_name, mx_data in records.items():
+            if mx_data is None:
+                self.cache.pop(mx_name, None)
+                continue
+            mx_data['connections'] = as_splice_map(mx_data['connections'], mx_data['fiber_count'], mx_name)
+            # Thay cả bản ghi như update_connections để người đọc không khóa luôn thấy dữ liệu khớp
+            self.cache[mx_name] = mx_data
+
+    def acquire_lease(self, name, owner, ttl):
+        """Giữ hoặc gia hạn quyền name cho owner trong ttl giây, trả về True nếu owner đang giữ quyền"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                (name, owner, now + ttl, now)
+            )
+            row = self._conn.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()
+        return row is not None and row[0] == owner
+
+    def release_lease(self, name, owner):
+        """Trả quyền name nếu owner đang giữ"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+
+_STORE = None
+
+
+def init_store(backend=None, path=None):
+    """Khởi tạo kho lưu trữ và nạp dữ liệu vào CONNECTIONS
+
+    Kho SQLite mới tạo sẽ được ghi sẵn các măng xông mẫu trong CONNECTIONS.
+    """
+    global _STORE
+    backend = backend or STORE_BACKEND
+    if _STORE is not None:
+        _STORE.close()
+
+    if backend == 'memory':
+        _STORE = MemoryStore(CONNECTIONS)
+    elif backend == 'sqlite':
+        store = SQLiteStore(CONNECTIONS, path or STORE_FILE)
+        if store.is_empty():
+            store._insert_many([
+                (mx_name, mx_data['location']['lat'], mx_data['location']['long'],
+                 mx_data['connections'], get_fiber_count(mx_data))
+                for mx_name, mx_data in CONNECTIONS.items()
+            ])
+            logger.info(f"Đã ghi {len(CONNECTIONS)} măng xông mẫu vào {store.path}")
+        _STORE = store
+    else:
+        raise ValueError(f"Kho lưu trữ không được hỗ trợ: {backend}")
+
+    count = _STORE.load()
+    rebuild_indexes()
+    mark_data_changed()
+    logger.info(f"Đã nạp {count} măng xông từ kho {backend}")
+    return _STORE
+
+
+def get_store():
+    """Lấy kho lưu trữ hiện tại (khởi tạo nếu chưa có)"""
+    if _STORE is None:
+        init_store()
+    return _STORE
+
+
+# Bán kính trung bình của Trái Đất (km)
+EARTH_RADIUS_KM = 6371.0088
+# Số km trên một độ vĩ
+KM_PER_DEG_LAT = math.pi * EARTH_RADIUS_KM / 180
+# Kích thước ô lưới (độ) của chỉ mục không gian
+SPATIAL_CELL_DEG = float(os.getenv('SPATIAL_CELL_DEG', '0.01'))
+# Số măng xông gần nhất trả về mặc định cho /nearmx
+NEAR_MX_DEFAULT_K = 5
+NEAR_MX_MAX_K = 20
+# Bán kính tìm kiếm tối đa (km) cho /nearmx
+NEAR_MX_MAX_RADIUS_KM = float(os.getenv('NEAR_MX_MAX_RADIUS_KM', '100'))
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """Khoảng cách đường tròn lớn giữa hai toạ độ (km)"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(long2 - long1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+    """Chỉ mục lưới theo toạ độ cho truy vấn k măng xông gần nhất và theo bán kính
+
+    Mỗi ô lưới rộng cell_deg độ; truy vấn chỉ duyệt các ô quanh điểm cần
+    tìm theo từng vòng, dừng khi không ô nào ở xa hơn có thể gần hơn kết quả
+    thứ k. Khi số ô phải duyệt vượt quá số điểm thì quét tuyến tính.
+    """
+
+    def __init__(self, cell_deg=SPATIAL_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells = {}
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell_of(self, lat, long):
+        return math.floor(lat / self.cell_deg), math.floor(long / self.cell_deg)
+
+    def add(self, mx_name, lat, long):
+        """Thêm hoặc cập nhật vị trí một măng xông"""
+        self.remove(mx_name)
+        cell = self._cell_of(lat, long)
+        self._points[mx_name] = (lat, long, cell)
+        self._cells.setdefault(cell, {})[mx_name] = (lat, long)
+
+    def remove(self, mx_name):
+        """Xóa một măng xông khỏi chỉ mục"""
+        point = self._points.pop(mx_name, None)
+        if point is not None:
+            bucket = self._cells[point[2]]
+            del bucket[mx_name]
+            if not bucket:
+                del self._cells[point[2]]
+
+    def rebuild(self, items):
+        """Dựng lại chỉ mục từ danh sách (tên, dữ liệu măng xông)"""
+        self._cells = {}
+        self._points = {}
+        for mx_name, mx_data in items:
+            self.add(mx_name, mx_data['location']['lat'], mx_data['location']['long'])
+
+    def _scan_all(self, lat, long):
+        return ((haversine_km(lat, long, p_lat, p_long), name)
+                for name, (p_lat, p_long, _) in self._points.items())
+
+    def _ring_min_km(self, lat, ring):
+        """Khoảng cách nhỏ nhất từ điểm truy vấn tới các ô ở vòng thứ ring trở ra"""
+        if ring <= 0:
+            return 0.0
+        # Theo kinh độ, một độ ngắn nhất ở vĩ độ xa xích đạo nhất mà vòng này chạm tới
+        far_lat = min(90.0, abs(lat) + (ring + 1) * self.cell_deg)
+        deg_km = KM_PER_DEG_LAT * min(1.0, math.cos(math.radians(far_lat)))
+        return (ring - 1) * self.cell_deg * deg_km
+
+    def nearest(self, lat, long, k=NEAR_MX_DEFAULT_K):
+        """k măng xông gần nhất: danh sách (khoảng cách km, tên) tăng dần"""
+        if not self._points or k <= 0:
+            return []
+
+        row, col = self._cell_of(lat, long)
+        best = []  # heap cực đại theo khoảng cách: (-khoảng cách, tên)
+        cells_seen = 0
+        ring = 0
+        while True:
+            if cells_seen > len(self._points):
+                return heapq.nsmallest(k, self._scan_all(lat, long))
+
+            if ring == 0:
+                ring_cells = [(row, col)]
+            else:
+                ring_cells = [(row + dr, col + dc)
+                              for dr in range(-ring, ring + 1)
+                              for dc in (-ring, ring)]
+                ring_cells += [(row + dr, col + dc)
+                               for dr in (-ring, ring)
+                               for dc in range(-ring + 1, ring)]
+            cells_seen += len(ring_cells)
+
+            for cell in ring_cells:
+                for name, (p_lat, p_long) in self._cells.get(cell, {}).items():
+                    distance = haversine_km(lat, long, p_lat, p_long)
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, name))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, name))
+
+            ring += 1
+            if len(best) == k and -best[0][0] <= self._ring_min_km(lat, ring):
+                break
+        return sorted((-d, name) for d, name in best)
+
+    def within(self, lat, long, radius_km):
+        """Các măng xông trong bán kính radius_km: danh sách (khoảng cách km, tên) tăng dần"""
+        d_lat = radius_km / KM_PER_DEG_LAT
+        cos_lat = math.cos(math.radians(min(89.9, abs(lat) + d_lat)))
+        d_long = min(180.0, d_lat / max(cos_lat, 1e-6))
+        row_min, col_min = self._cell_of(lat - d_lat, long - d_long)
+        row_max, col_max = self._cell_of(lat + d_lat, long + d_long)
+
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self._points):
+            candidates = self._scan_all(lat, long)
+        else:
+            candidates = (
+                (haversine_km(lat, long, p_lat, p_long), name)
+                for r in range(row_min, row_max + 1)
+                for c in range(col_min, col_max + 1)
+                for name, (p_lat, p_long) in self._cells.get((r, c), {}).items()
+            )
+        return sorted(item for item in candidates if item[0] <= radius_km)
+
+
+SPATIAL_INDEX = SpatialIndex()
+
+# Số gợi ý tên măng xông tối đa
+NAME_SUGGESTION_LIMIT = 5
+# Độ giống tối thiểu (theo trigram) để gợi ý tên gần đúng
+NAME_FUZZY_MIN_SCORE = 0.3
+# Trigram xuất hiện trong quá nhiều tên (vd. tiền tố chung "MX") không dùng để chọn ứng viên
+NAME_COMMON_TRIGRAM_RATIO = 0.1
+
+
+def normalize_mx_name(text):
+    """Chuẩn hoá tên măng xông: bỏ khoảng trắng, viết hoa"""
+    return ''.join(text.split()).upper()
+
+
+# Tên măng xông là tên sheet trong file Excel nên phải theo giới hạn tên sheet của Excel
+MX_NAME_MAX_LENGTH = 31
+MX_NAME_FORBIDDEN_CHARS = '[]:*?/\\'
+# Ký tự không được phép trong XML 1.0
+_XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+
+def validate_mx_name(mx_name):
+    """Kiểm tra tên măng xông dùng được làm tên sheet Excel, ValueError nếu không"""
+    if not mx_name:
+        raise ValueError("Tên măng xông không được để trống")
+    if len(mx_name) > MX_NAME_MAX_LENGTH:
+        raise ValueError(f"Tên măng xông dài tối đa {MX_NAME_MAX_LENGTH} ký tự ({mx_name[:40]}...)")
+    forbidden = sorted({ch for ch in mx_name if ch in MX_NAME_FORBIDDEN_CHARS})
+    if forbidden:
+        raise ValueError(f"Tên măng xông {mx_name} không được chứa ký tự {' '.join(forbidden)}")
+    if _XML_ILLEGAL_CHARS.search(mx_name):
+        raise ValueError(f"Tên măng xông {mx_name!r} chứa ký tự điều khiển")
+    if mx_name.startswith("'") or mx_name.endswith("'"):
+        raise ValueError(f"Tên măng xông {mx_name} không được bắt đầu hoặc kết thúc bằng dấu '")
+
+
+def _name_trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Chỉ mục tên măng xông: tìm theo tiền tố và gần đúng (trigram)
+
+    Tên được chia theo độ dài, mỗi nhóm là một mảng đã sắp xếp: tìm tiền tố
+    duyệt các nhóm từ ngắn tới dài nên tên ngắn (thường là tên cần tìm)
+    luôn được gợi ý trước, không bị các tên dài cùng tiền tố che mất.
+    """
+
+    def __init__(self):
+        self._lengths = {}
+        self._names = {}
+        self._grams = {}
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, mx_name):
+        """Thêm một tên măng xông vào chỉ mục"""
+        key = normalize_mx_name(mx_name)
+        if key in self._names:
+            return
+        bisect.insort(self._lengths.setdefault(len(key), []), key)
+        self._names[key] = mx_name
+        self._grams[key] = grams = frozenset(_name_trigrams(key))
+        for gram in grams:
+            self._trigrams.setdefault(gram, set()).add(key)
+
+    def remove(self, mx_name):
+        """Xóa một tên măng xông khỏi chỉ mục"""
+        key = normalize_mx_name(mx_name)
+        if self._names.pop(key, None) is None:
+            return
+        bucket = self._lengths[len(key)]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if not bucket:
+            del self._lengths[len(key)]
+        for gram in self._grams.pop(key):
+            keys = self._trigrams[gram]
+            keys.discard(key)
+            if not keys:
+                del self._trigrams[gram]
+
+    def rebuild(self, names):
+        """Dựng lại chỉ mục từ danh sách tên"""
+        self._lengths = {}
+        self._names = {}
+        self._grams = {}
+        self._trigrams = {}
+        for mx_name in names:
+            self.add(mx_name)
+
+    def lookup(self, text):
+        """Tên măng xông khớp chính xác (sau khi chuẩn hoá), hoặc None"""
+        return self._names.get(normalize_mx_name(text))
+
+    def prefix(self, text, limit=NAME_SUGGESTION_LIMIT):
+        """Tối đa limit tên bắt đầu bằng tiền tố, tên ngắn trước rồi theo thứ tự từ điển"""
+        key = normalize_mx_name(text)
+        if not key:
+            return []
+        keys = []
+        for length in sorted(self._lengths):
+            if length < len(key):
+                continue
+            bucket = self._lengths[length]
+            start = bisect.bisect_left(bucket, key)
+            for candidate in bucket[start:start + limit - len(keys)]:
+                if not candidate.startswith(key):
+                    break
+                keys.append(candidate)
+            if len(keys) >= limit:
+                break
+        return [self._names[k] for k in keys]
+
+    def fuzzy(self, text, limit=NAME_SUGGESTION_LIMIT, min_score=NAME_FUZZY_MIN_SCORE):
+        """Các tên gần giống nhất theo hệ số Jaccard trên trigram: (điểm, tên)"""
+        key = normalize_mx_name(text)
+        if not key:
+            return []
+        grams = _name_trigrams(key)
+        postings = [self._trigrams[gram] for gram in grams if gram in self._trigrams]
+        common_size = max(50, len(self._names) * NAME_COMMON_TRIGRAM_RATIO)
+        candidates = set().union(*(keys for keys in postings if len(keys) <= common_size))
+
+        scored = []
+        for candidate in candidates:
+            candidate_grams = self._grams[candidate]
+            common = len(grams & candidate_grams)
+            score = common / (len(grams) + len(candidate_grams) - common)
+            if score >= min_score:
+                scored.append((-score, candidate))
+        return [(-score, self._names[k]) for score, k in heapq.nsmallest(limit, scored)]
+
+    def resolve(self, text, limit=NAME_SUGGESTION_LIMIT):
+        """Tìm tên măng xông từ chuỗi người dùng nhập -> (tên hoặc None, danh sách gợi ý)
+
+        Khớp chính xác hoặc tiền tố duy nhất thì trả về tên; ngược lại trả về
+        các gợi ý theo tiền tố trước, sau đó theo độ giống.
+        """
+        exact = self.lookup(text)
+        if exact is not None:
+            return exact, []
+
+        prefixed = self.prefix(text, limit + 1)
+        if len(prefixed) == 1:
+            return prefixed[0], []
+
+        suggestions = prefixed[:limit]
+        if len(suggestions) < limit:
+            for _, mx_name in self.fuzzy(text, limit):
+                if mx_name not in suggestions:
+                    suggestions.append(mx_name)
+        return None, suggestions[:limit]
+
+
+NAME_INDEX = NameIndex()
+
+
+class FiberTrace:
+    """Đường đi của một sợi quang: các chặng (măng xông, sợi vào, sợi ra) theo chiều xuôi"""
+
+    __slots__ = ('hops', 'loop')
+
+    def __init__(self, hops, loop=False):
+        self.hops = hops
+        self.loop = loop
+
+
+class CableGraph:
+    """Đồ thị đoạn cáp giữa các măng xông và bộ nhớ đệm kết quả trace
+
+    Mỗi măng xông có tối đa một cáp ra, nối vào cáp vào của măng xông kế
+    tiếp; sợi thứ n của cáp ra là sợi thứ n của cáp vào phía sau. Một lần
+    trace được lưu cho mọi chặng trên đường đi, và khi một măng xông thay
+    đổi thì chỉ các đường đi qua măng xông đó bị xóa khỏi bộ nhớ đệm.
+    """
+
+    def __init__(self):
+        self._next = {}
+        self._prev = {}
+        self._traces = {}
+        self._touching = {}
+
+    def rebuild(self, items):
+        """Dựng lại đồ thị từ danh sách (tên, dữ liệu măng xông)"""
+        self._next = {}
+        self._prev = {}
+        for mx_name, mx_data in items:
+            if mx_data.get('next_mx'):
+                self._next[mx_name] = mx_data['next_mx']
+                self._prev[mx_data['next_mx']] = mx_name
+        self.invalidate()
+
+    def next_of(self, mx_name):
+        """Măng xông nhận cáp ra của mx_name, hoặc None"""
+        return self._next.get(mx_name)
+
+    def prev_of(self, mx_name):
+        """Măng xông có cáp ra nối vào mx_name, hoặc None"""
+        return self._prev.get(mx_name)
+
+    def link(self, from_mx, to_mx):
+        """Nối cáp ra của from_mx vào cáp vào của to_mx (to_mx None để tháo)"""
+        old_to = self._next.pop(from_mx, None)
+        if old_to is not None:
+            del self._prev[old_to]
+            self.invalidate(old_to)
+        if to_mx is not None:
+            self._next[from_mx] = to_mx
+            self._prev[to_mx] = from_mx
+            self.invalidate(to_mx)
+        self.invalidate(from_mx)
+
+    def invalidate(self, mx_name=None):
+        """Xóa các trace đi qua mx_name (mọi trace nếu mx_name là None)"""
+        if mx_name is None:
+            self._traces = {}
+            self._touching = {}
+            return
+        for trace in self._touching.pop(mx_name, ()):
+            for hop_mx, input_fiber, _ in trace.hops:
+                if self._traces.get((hop_mx, input_fiber)) is trace:
+                    del self._traces[(hop_mx, input_fiber)]
+                touching = self._touching.get(hop_mx)
+                if touching is not None:
+                    touching.discard(trace)
+
+    def trace(self, mx_name, fiber):
+        """Đường đi đầy đủ của sợi vào fiber tại mx_name, từ đầu cáp tới cuối cáp"""
+        cached = self._traces.get((mx_name, fiber))
+        count_cache('trace', cached is not None)
+        if cached is not None:
+            return cached
+
+        store = get_store()
+        seen = {(mx_name, fiber)}
+        loop = False
+
+        # Đi ngược về phía đầu cáp
+        upstream = []
+        current, current_fiber = mx_name, fiber
+        while True:
+            prev_mx = self._prev.get(current)
+            if prev_mx is None:
+                break
+            prev_input = store.get(prev_mx)['connections'].input_for(current_fiber)
+            if prev_input is not None and (prev_mx, prev_input) in seen:
+                loop = True
+                break
+            upstream.append((prev_mx, prev_input, current_fiber))
+            if prev_input is None:
+                break
+            seen.add((prev_mx, prev_input))
+            current, current_fiber = prev_mx, prev_input
+        upstream.reverse()
+
+        # Đi xuôi về phía cuối cáp
+        hops = upstream
+        current, current_fiber = mx_name, fiber
+        while True:
+            output_fiber = store.get(current)['connections'].get(current_fiber)
+            hops.append((current, current_fiber, output_fiber))
+            next_mx = self._next.get(current)
+            if output_fiber is None or next_mx is None:
+                break
+            if (next_mx, output_fiber) in seen:
+                loop = True
+                break
+            seen.add((next_mx, output_fiber))
+            current, current_fiber = next_mx, output_fiber
+
+        trace = FiberTrace(tuple(hops), loop)
+        for hop_mx, input_fiber, _ in trace.hops:
+            if input_fiber is not None:
+                self._traces[(hop_mx, input_fiber)] = trace
+            self._touching.setdefault(hop_mx, set()).add(trace)
+        return trace
+
+
+CABLE_GRAPH = CableGraph()
+
+
+def rebuild_indexes():
+    """Dựng lại các chỉ mục trong bộ nhớ từ kho lưu trữ"""
+    store = get_store()
+    SPATIAL_INDEX.rebuild(store.items())
+    NAME_INDEX.rebuild(name for name, _ in store.items())
+    CABLE_GRAPH.rebuild(store.items())
+
+
+def index_closure(mx_name, mx_data):
+    """Cập nhật các chỉ mục trong bộ nhớ khi một măng xông được thêm"""
+    SPATIAL_INDEX.add(mx_name, mx_data['location']['lat'], mx_data['location']['long'])
+    NAME_INDEX.add(mx_name)
+
+
+def find_nearest_mx(lat, long, k=NEAR_MX_DEFAULT_K, radius_km=None):
+    """Tìm măng xông gần một toạ độ: k gần nhất hoặc mọi măng xông trong bán kính"""
+    if radius_km is not None:
+        return SPATIAL_INDEX.within(lat, long, radius_km)
+    return SPATIAL_INDEX.nearest(lat, long, k)
+
+
+def resolve_mx_name(text):
+    """Đổi chuỗi người dùng nhập thành tên măng xông -> (tên hoặc None, gợi ý)"""
+    mx_name = normalize_mx_name(text)
+    if mx_name in get_store():
+        return mx_name, []
+    return NAME_INDEX.resolve(text)
+
+
+def format_name_suggestions(text, suggestions):
+    """Thông báo không tìm thấy kèm các tên gợi ý"""
+    message = f"Không tìm thấy măng xông {text.strip().upper()} trong hệ thống."
+    if suggestions:
+        message += "\n\nCó phải bạn muốn tìm:\n" + "\n".join(f"- {name}" for name in suggestions)
+        message += "\n\nNhập lại tên măng xông hoặc /cancel để hủy."
+    return message
+
+
+# Nhật ký thay đổi: mỗi lần thêm măng xông, sửa đấu nối hoặc nối cáp được ghi thêm
+# một dòng JSON (ai, lúc nào, sợi nào đổi) vào cuối file, không bao giờ ghi đè.
+# File nhật ký ('' để tắt, kho bộ nhớ không dùng nhật ký vì dữ liệu không giữ qua lần chạy)
+JOURNAL_FILE = os.getenv('MX_JOURNAL_FILE', 'mang_xong_journal.jsonl')
+# Cứ mỗi chừng này byte nhật ký lại chụp toàn bộ mạng, để dựng lại mạng chỉ cần đọc từ ảnh chụp gần nhất
+JOURNAL_SNAPSHOT_BYTES = int(os.getenv('MX_JOURNAL_SNAPSHOT_BYTES', str(4 * 1024 * 1024)))
+# Số thay đổi hiển thị tối đa trong /history
+HISTORY_MAX_ENTRIES = 20
+
+
+class ChangeJournal:
+    """Nhật ký thay đổi chỉ ghi thêm, kèm ảnh chụp định kỳ để dựng lại mạng tại một thời điểm
+
+    Mỗi dòng là một thay đổi: t (thời điểm), u (user), op ('add', 'set' hoặc
+    'link'), mx (tên măng xông), s (thứ tự commit trong kho) và phần thay
+    đổi: 'add' có lat/long/n (số sợi)/c (đấu nối), 'set' có d = {sợi: [đầu
+    ra cũ, đầu ra mới]}, 'link' có next. Ảnh chụp nằm trong thư mục
+    <file>.snapshots, tên <vị trí byte trong nhật ký>-<thời điểm>.json.gz.
+
+    Thay đổi được ghi vào bảng journal của kho cùng transaction với dữ liệu,
+    sync() chép chúng sang file theo đúng thứ tự commit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_dir = f"{path}.snapshots"
+        self._lock = threading.Lock()
+        self._fd = None
+        self._snapshot_offset = self._latest_snapshot_offset()
+        self._snapshotting = False
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    @staticmethod
+    def add_entry(mx_name, lat, long, connections, fiber_count, user=None):
+        return {'u': user, 'op': 'add', 'mx': mx_name, 'lat': lat, 'long': long, 'n': fiber_count,
+                'c': {str(fiber): output_fiber for fiber, output_fiber in connections.items()}}
+
+    @staticmethod
+    def connections_entry(mx_name, old, new, user=None):
+        """Thay đổi gồm các sợi có đầu ra khác nhau giữa old và new (None nếu không đổi)"""
+        diff = {}
+        for fiber in sorted(set(old.keys()) | set(new.keys())):
+            if old.get(fiber) != new.get(fiber):
+                diff[str(fiber)] = [old.get(fiber), new.get(fiber)]
+        return {'u': user, 'op': 'set', 'mx': mx_name, 'd': diff} if diff else None
+
+    @staticmethod
+    def link_entry(mx_name, next_mx, user=None):
+        return {'u': user, 'op': 'link', 'mx': mx_name, 'next': next_mx}
+
+    def sync(self, store):
+        """Chép các thay đổi đã commit trong kho sang cuối file nhật ký"""
+        return store.drain_journal(self.export)
+
+    def export(self, rows):
+        """Ghi thêm các thay đổi [(seq, dòng JSON)] vào cuối file, bỏ qua các seq đã có trong file"""
+        with self._lock:
+            last_seq, complete = self._tail()
+            lines = [] if complete else [b'\n']  # kết thúc dòng ghi dở để dòng mới không dính vào
+            for seq, data in rows:
+                if seq <= last_seq:
+                    # Đã chép rồi nhưng chưa kịp xóa khỏi kho (tiến trình dừng giữa chừng)
+                    continue
+                entry = json.loads(data)
+                entry['s'] = seq
+                lines.append((json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8'))
+                METRICS.inc('mx_journal_entries_total', op=entry['op'])
+            if len(lines) <= (0 if complete else 1):
+                return
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, b''.join(lines))
+            end = os.lseek(self._fd, 0, os.SEEK_CUR)
+
+        if end - self._snapshot_offset >= JOURNAL_SNAPSHOT_BYTES and not self._snapshotting:
+            # Worker khác có thể đã chụp rồi
+            self._snapshot_offset = self._latest_snapshot_offset()
+            if end - self._snapshot_offset >= JOURNAL_SNAPSHOT_BYTES and is_workbook_exporter():
+                self._snapshotting = True
+                get_workbook_executor().submit(self.snapshot)
+
+    def _tail(self):
+        """(seq của dòng đầy đủ cuối cùng có seq, file có kết thúc bằng xuống dòng không)"""
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return 0, True
+        with file:
+            size = file.seek(0, os.SEEK_END)
+            if not size:
+                return 0, True
+            block = 4096
+            while True:
+                start = max(0, size - block)
+                file.seek(start)
+                data = file.read(size - start)
+                lines = data.split(b'\n')
+                complete = data.endswith(b'\n')
+                # Dòng đầu của khối có thể bị cắt, trừ khi khối bắt đầu từ đầu file
+                candidates = lines[:-1] if start == 0 else lines[1:-1]
+                for line in reversed(candidates):
+                    try:
+                        seq = json.loads(line).get('s')
+                    except ValueError:
+                        continue
+                    if seq is not None:
+                        return seq, complete
+                if start == 0:
+                    return 0, complete
+                block *= 4
+
+    def iter_entries(self, offset=0, needle=None):
+        """Duyệt (vị trí byte sau dòng, thay đổi) từ offset; needle lọc nhanh dòng trước khi giải mã"""
+        try:
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            file.seek(offset)
+            position = offset
+            for line in file:
+                position += len(line)
+                if not line.endswith(b'\n'):
+                    # Dòng đang được ghi dở
+                    break
+                if needle is not None and needle not in line:
+                    continue
+                try:
+                    yield position, json.loads(line)
+                except ValueError:
+                    logger.warning(f"Bỏ qua dòng hỏng trong nhật ký {self.path} tại byte {position - len(line)}")
+
+    def history(self, mx_name, limit=HISTORY_MAX_ENTRIES):
+        """Các thay đổi gần nhất của một măng xông, mới nhất trước"""
+        needle = json.dumps(mx_name, ensure_ascii=False).encode('utf-8')
+        recent = []
+        for _, entry in self.iter_entries(needle=needle):
+            if entry.get('mx') == mx_name:
+                recent.append(entry)
+                if len(recent) > limit:
+                    del recent[0]
+        recent.reverse()
+        return recent
+
+    def snapshots(self):
+        """Các ảnh chụp đã có: danh sách (vị trí byte, thời điểm, đường dẫn) theo thứ tự ghi"""
+        try:
+            names = os.listdir(self.snapshot_dir)
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            if not name.endswith('.json.gz'):
+                continue
+            try:
+                offset, timestamp = name[:-len('.json.gz')].split('-', 1)
+                result.append((int(offset), float(timestamp), os.path.join(self.snapshot_dir, name)))
+            except ValueError:
+                continue
+        result.sort()
+        return result
+
+    def _latest_snapshot_offset(self):
+        snapshots = self.snapshots()
+        return snapshots[-1][0] if snapshots else 0
+
+    def rebuild(self, as_of=None):
+        """Dựng lại mạng tại thời điểm as_of (None: mới nhất) -> (mạng, vị trí byte, thời điểm)
+
+        Mạng có dạng {tên: {'lat', 'long', 'n', 'c': {sợi: đầu ra}, 'next'}}. Chỉ
+        đọc nhật ký từ ảnh chụp gần nhất trước as_of, dừng ở thay đổi đầu tiên
+        sau as_of.
+        """
+        candidates = [snapshot for snapshot in self.snapshots() if as_of is None or snapshot[1] <= as_of]
+        if not candidates:
+            raise ValueError("Nhật ký không có dữ liệu trước thời điểm này")
+        offset, timestamp, path = candidates[-1]
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            network = json.load(file)['network']
+        for mx_data in network.values():
+            mx_data['c'] = {int(fiber): output_fiber for fiber, output_fiber in mx_data['c'].items()}
+
+        replayed = 0
+        for position, entry in self.iter_entries(offset):
+            if as_of is not None and entry['t'] > as_of:
+                break
+            self._apply(network, entry)
+            offset, timestamp = position, entry['t']
+            replayed += 1
+        METRICS.inc('mx_journal_replayed_total', replayed)
+        return network, offset, timestamp
+
+    @staticmethod
+    def _apply(network, entry):
+        op, mx_name = entry['op'], entry['mx']
+        if op == 'add':
+            network[mx_name] = {
+                'lat': entry['lat'], 'long': entry['long'], 'n': entry['n'],
+                'c': {int(fiber): output_fiber for fiber, output_fiber in entry['c'].items()},
+            }
+        elif op == 'set' and mx_name in network:
+            connections = network[mx_name]['c']
+            for fiber, (_, output_fiber) in entry['d'].items():
+                if output_fiber is None:
+                    connections.pop(int(fiber), None)
+                else:
+                    connections[int(fiber)] = output_fiber
+        elif op == 'link' and mx_name in network:
+            if entry['next'] is None:
+                network[mx_name].pop('next', None)
+            else:
+                network[mx_name]['next'] = entry['next']
+
+    def _write_snapshot(self, network, offset, timestamp):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = os.path.join(self.snapshot_dir, f"{offset:015d}-{timestamp:.3f}.json.gz")
+        temp_path = f"{path}.tmp{os.getpid()}"
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as file:
+            json.dump({'t': timestamp, 'offset': offset, 'network': network}, file,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, path)
+        self._snapshot_offset = max(self._snapshot_offset, offset)
+        return path
+
+    def snapshot(self):
+        """Chụp mạng tại cuối nhật ký (dựng từ ảnh chụp trước, không đọc kho đang thay đổi)"""
+        try:
+            started = time.perf_counter()
+            network, offset, timestamp = self.rebuild()
+            path = self._write_snapshot(network, offset, timestamp)
+            METRICS.observe('mx_journal_snapshot_seconds', time.perf_counter() - started)
+            logger.info(f"Đã chụp {len(network)} măng xông vào {path}")
+        except Exception as e:
+            logger.error(f"Lỗi khi chụp nhật ký thay đổi: {e}")
+        finally:
+            self._snapshotting = False
+
+    def ensure_baseline(self, store):
+        """Chụp kho hiện tại làm điểm bắt đầu nếu nhật ký chưa có ảnh chụp nào"""
+        if self.snapshots():
+            return None
+        network = {}
+        for mx_name, mx_data in store.items():
+            network[mx_name] = {
+                'lat': mx_data['location']['lat'], 'long': mx_data['location']['long'],
+                'n': get_fiber_count(mx_data), 'c': dict(mx_data['connections'].items()),
+            }
+            if mx_data.get('next_mx'):
+                network[mx_name]['next'] = mx_data['next_mx']
+        offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return self._write_snapshot(network, offset, time.time())
+
+
+JOURNAL = None
+
+
+def init_journal(store):
+    """Mở nhật ký thay đổi cho kho bền vững và chụp điểm bắt đầu nếu cần"""
+    global JOURNAL
+    if JOURNAL is not None:
+        JOURNAL.close()
+    JOURNAL = None
+    if JOURNAL_FILE and isinstance(store, SQLiteStore):
+        JOURNAL = ChangeJournal(JOURNAL_FILE)
+        # Cơ sở dữ liệu mới đi với file nhật ký cũ: seq mới phải lớn hơn seq đã có trong file
+        store.reserve_journal_seq(JOURNAL._tail()[0])
+        # Các thay đổi đã commit nhưng chưa kịp chép sang file trước khi tiến trình dừng
+        count = JOURNAL.sync(store)
+        if count:
+            logger.info(f"Đã chép {count} thay đổi còn lại vào nhật ký {JOURNAL_FILE}")
+        if JOURNAL.ensure_baseline(store):
+            logger.info(f"Đã chụp {len(store)} măng xông làm điểm bắt đầu nhật ký {JOURNAL_FILE}")
+    return JOURNAL
+
+
+def journal_entries(*entries):
+    """Các dòng nhật ký cần ghi cùng thay đổi (không ghi gì khi không dùng nhật ký)"""
+    if JOURNAL is None:
+        return ()
+    return [entry for entry in entries if entry]
+
+
+def sync_journal():
+    """Chép các thay đổi vừa commit sang file nhật ký, lỗi thì giữ trong kho cho lần sau"""
+    if JOURNAL is None:
+        return
+    try:
+        JOURNAL.sync(get_store())
+    except Exception as e:
+        logger.error(f"Lỗi khi ghi nhật ký thay đổi {JOURNAL.path}: {e}")
+
+
+def journal_user(update):
+    """Tên ghi vào nhật ký cho người gửi update"""
+    user = update.effective_user
+    if user is None:
+        return None
+    return user.username or str(user.id)
+
+
+def parse_as_of(text):
+    """Đọc thời điểm dạng ISO (YYYY-MM-DD[ HH:MM[:SS]]), không có múi giờ thì hiểu theo giờ địa phương"""
+    moment = datetime.fromisoformat(text.strip())
+    if moment.tzinfo is None:
+        timezone = get_timezone()
+        moment = timezone.localize(moment) if hasattr(timezone, 'localize') else moment.replace(tzinfo=timezone)
+    return moment.timestamp()
+
+
+def format_journal_entry(entry):
+    """Một dòng /history: thời điểm, người sửa và nội dung thay đổi"""
+    moment = datetime.fromtimestamp(entry['t'], get_timezone()).strftime('%Y-%m-%d %H:%M:%S')
+    user = entry.get('u') or 'hệ thống'
+    op = entry['op']
+    if op == 'add':
+        change = f"thêm mới ({entry['n']} sợi, {len(entry['c'])} cặp đấu nối)"
+    elif op == 'link':
+        change = f"nối cáp ra vào {entry['next']}" if entry['next'] else "tháo cáp ra"
+    else:
+        pairs = [f"{fiber}: {old if old is not None else '-'} -> {new if new is not None else '-'}"
+                 for fiber, (old, new) in entry['d'].items()]
+        change = f"sửa {len(pairs)} sợi: " + ", ".join(pairs[:12])
+        if len(pairs) > 12:
+            change += f" ... (+{len(pairs) - 12})"
+    return f"{moment} · {user} · {change}"
+
+
+def rebuild_workbook_as_of(as_of, filename):
+    """Dựng lại mạng tại thời điểm as_of từ nhật ký và ghi ra file Excel filename"""
+    journal = ChangeJournal(JOURNAL_FILE)
+    network, _, timestamp = journal.rebuild(as_of)
+    closures = [
+        (mx_name, {
+            'location': {'lat': mx_data['lat'], 'long': mx_data['long']},
+            'connections': as_splice_map(mx_data['c'], mx_data['n'], mx_name),
+            'fiber_count': mx_data['n'],
+        })
+        for mx_name, mx_data in network.items()
+    ]
+    path = create_excel_file(filename, closures=closures)
+    logger.info(f"Mạng tại {datetime.fromtimestamp(timestamp, get_timezone())}: {len(closures)} măng xông -> {path}")
+    return path
+
+
+def link_cable_segment(from_mx, to_mx, user=None):
+    """Nối cáp ra của from_mx vào cáp vào của to_mx (to_mx None để tháo), lỗi báo bằng ValueError"""
+    store = get_store()
+    from_data = store.get(from_mx)
+    if from_data is None:
+        raise ValueError(f"Không tìm thấy măng xông {from_mx}")
+
+    if to_mx is not None:
+        to_data = store.get(to_mx)
+        if to_data is None:
+            raise ValueError(f"Không tìm thấy măng xông {to_mx}")
+        if to_mx == from_mx:
+            raise ValueError("Không thể nối măng xông vào chính nó")
+        if get_fiber_count(from_data) != get_fiber_count(to_data):
+            raise ValueError(
+                f"Số sợi không khớp: {from_mx} {get_fiber_count(from_data)} sợi, "
+                f"{to_mx} {get_fiber_count(to_data)} sợi"
+            )
+        upstream = CABLE_GRAPH.prev_of(to_mx)
+        if upstream is not None and upstream != from_mx:
+            raise ValueError(f"Cáp vào của {to_mx} đang nối với {upstream}, hãy tháo trước")
+
+    store.set_next(from_mx, to_mx, journal_entries(ChangeJournal.link_entry(from_mx, to_mx, user)))
+    CABLE_GRAPH.link(from_mx, to_mx)
+    mark_data_changed(from_mx)
+    sync_journal()
+
+
+def trace_fiber(mx_name, fiber):
+    """Theo dấu một sợi vào của măng xông qua các măng xông nối tiếp"""
+    return CABLE_GRAPH.trace(mx_name, fiber)
+
+
+def render_fiber_trace(mx_name, fiber, trace):
+    """Tạo nội dung hiển thị kết quả trace"""
+    lines = [f"Đường đi sợi {fiber} tại {mx_name}:", ""]
+    first_mx, first_input, first_output = trace.hops[0]
+    if first_input is None:
+        lines.append(f"Bắt đầu: sợi ra {first_output} của {first_mx} chưa đấu với đầu vào nào")
+    else:
+        lines.append(f"Bắt đầu: cáp vào của {first_mx}")
+
+    for position, (hop_mx, input_fiber, output_fiber) in enumerate(trace.hops, start=1):
+        fiber_count = get_fiber_count(get_store().get(hop_mx))
+        input_label = format_fiber_label(input_fiber, fiber_count) if input_fiber else "-"
+        output_label = format_fiber_label(output_fiber, fiber_count) if output_fiber else "chưa đấu"
+        lines.append(f"{position}. {hop_mx}: {input_label} -> {output_label}")
+
+    last_mx, _, last_output = trace.hops[-1]
+    if trace.loop:
+        lines.append("Kết thúc: đường đi khép kín (quay lại chặng đã đi qua)")
+    elif last_output is None:
+        lines.append(f"Kết thúc: sợi chưa được đấu tại {last_mx}")
+    else:
+        lines.append(f"Kết thúc: cáp ra của {last_mx}, sợi {last_output}")
+    return "\n".join(lines)
+
+
 def find_mx_location(mx_name):
     """Tìm vị trí của măng xông"""
-    return CONNECTIONS.get(mx_name.upper(), {}).get('location', None)
+    mx_data = get_store().get(mx_name.upper())
+    return mx_data['location'] if mx_data else None
 
 
 def get_mx_connections(mx_name):
     """Lấy thông tin đấu nối của măng xông"""
-    return CONNECTIONS.get(mx_name.upper(), {}).get('connections', None)
+    mx_data = get_store().get(mx_name.upper())
+    return mx_data['connections'] if mx_data else None
+
+
+def register_new_mx(mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT, user=None):
+    """Ghi măng xông mới vào kho lưu trữ, trả về False nếu tên đã tồn tại"""
+    journal = journal_entries(ChangeJournal.add_entry(mx_name, lat, long, connections, fiber_count, user))
+    if not get_store().add(mx_name, lat, long, connections, fiber_count, journal):
+        return False
 
+    index_closure(mx_name, get_store().get(mx_name))
+    mark_data_changed(mx_name)
+    sync_journal()
+    return True
 
-def add_new_mx(mx_name, lat, long, connections):
+
+def add_new_mx(mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT, user=None):
     """Thêm măng xông mới vào hệ thống"""
     try:
         mx_name = mx_name.upper()
-        if mx_name in CONNECTIONS:
+        if not register_new_mx(mx_name, lat, long, connections, fiber_count, user):
             return False
 
-        CONNECTIONS[mx_name] = {
-            'location': {'lat': lat, 'long': long},
-            'connections': connections
-        }
-
         # Cập nhật file Excel
-        update_excel_with_new_mx(mx_name, lat, long, connections)
+        update_excel_with_new_mx(mx_name, lat, long, connections, fiber_count)
+        return True
+    except Exception as e:
+        logger.error(f"Error in add_new_mx: {e}")
+        return False
+
+
+async def add_new_mx_async(mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT, user=None):
+    """Thêm măng xông mới, file Excel được ghi gộp sau bởi WORKBOOK_FLUSHER"""
+    try:
+        mx_name = mx_name.upper()
+        if not register_new_mx(mx_name, lat, long, connections, fiber_count, user):
+            return False
+
+        # Ghi file Excel sau, gộp cùng các thay đổi khác
+        WORKBOOK_FLUSHER.mark_dirty(mx_name)
         return True
     except Exception as e:
         logger.error(f"Error in add_new_mx: {e}")
         return False
 
 
-def update_excel_with_new_mx(mx_name, lat, long, connections):
+# Nhập hàng loạt: mỗi dòng là một cặp đấu nối, các dòng cùng tên thuộc một măng xông
+# Tên cột (đã bỏ dấu, khoảng trắng) -> trường
+IMPORT_COLUMNS = {
+    'tenmx': 'name', 'mx': 'name', 'name': 'name', 'mxname': 'name',
+    'lat': 'lat', 'latitude': 'lat', 'vido': 'lat',
+    'long': 'long', 'lon': 'long', 'lng': 'long', 'longitude': 'long', 'kinhdo': 'long',
+    'sosoi': 'fiber_count', 'fibercount': 'fiber_count',
+    'dauvao': 'input', 'input': 'input', 'inputfiber': 'input',
+    'daura': 'output', 'output': 'output', 'outputfiber': 'output',
+}
+IMPORT_EXTENSIONS = ('.csv', '.xlsx')
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+# Số lỗi tối đa hiển thị trực tiếp trong tin nhắn, phần còn lại gửi kèm file
+IMPORT_REPORT_MAX_LINES = 40
+
+
+def _import_column_key(header):
+    """Chuẩn hoá tên cột: bỏ dấu tiếng Việt, khoảng trắng và ký tự phân cách"""
+    text = unicodedata.normalize('NFD', str(header or '')).replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(ch for ch in text.lower() if ch.isalnum() and not unicodedata.combining(ch))
+
+
+def iter_import_rows(filename, data):
+    """Đọc lần lượt các dòng của file CSV/XLSX -> (số dòng, danh sách ô)"""
+    if filename.lower().endswith('.xlsx'):
+        with METRICS.timer('mx_workbook_io_seconds', op='load_workbook'):
+            wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            for row_number, values in enumerate(wb.active.iter_rows(values_only=True), start=1):
+                yield row_number, list(values)
+        finally:
+            wb.close()
+        return
+
+    text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for row_number, values in enumerate(csv.reader(text, dialect), start=1):
+        yield row_number, values
+
+
+def _import_cell(values, column):
+    if column is None or column >= len(values) or values[column] is None:
+        return ''
+    return str(values[column]).strip()
+
+
+def _import_number(text, cast, label):
+    try:
+        value = float(text)
+    except ValueError:
+        raise ValueError(f"{label} '{text}' không hợp lệ")
+    if cast is int:
+        if not value.is_integer():
+            raise ValueError(f"{label} '{text}' không phải số nguyên")
+        return int(value)
+    return value
+
+
+def validate_import_rows(rows, existing=()):
+    """Kiểm tra toàn bộ file nhập hàng loạt trong một lượt đọc
+
+    Trả về (danh sách (tên, lat, long, SpliceMap, số sợi) hợp lệ, danh sách
+    (số dòng, tên, lỗi)). Mỗi măng xông phải khai báo đủ đầu ra cho mọi sợi
+    đầu vào; một măng xông có bất kỳ lỗi nào sẽ bị bỏ qua cả măng xông.
+    """
+    errors = []
+    columns = None
+    closures = {}
+
+    for row_number, values in rows:
+        if columns is None:
+            columns = {}
+            for index, header in enumerate(values):
+                field = IMPORT_COLUMNS.get(_import_column_key(header))
+                if field and field not in columns:
+                    columns[field] = index
+            missing = [header for field, header in (('name', 'TenMX'), ('lat', 'Lat'), ('long', 'Long'))
+                       if field not in columns]
+            if missing:
+                errors.append((row_number, '', f"Thiếu cột bắt buộc: {', '.join(missing)}"))
+                return [], errors
+            continue
+
+        name = normalize_mx_name(_import_cell(values, columns['name']))
+        if not name:
+            if any(_import_cell(values, index) for index in columns.values()):
+                errors.append((row_number, '', "Thiếu tên măng xông"))
+            continue
+
+        closure = closures.get(name)
+        if closure is None:
+            closure = closures[name] = {
+                'row': row_number, 'lat': None, 'long': None, 'fiber_count': None,
+                'connections': None, 'input_rows': {}, 'valid': True
+            }
+            if name in existing:
+                errors.append((row_number, name, "măng xông đã tồn tại"))
+                closure['valid'] = False
+            try:
+                validate_mx_name(name)
+            except ValueError as e:
+                errors.append((row_number, name, str(e)))
+                closure['valid'] = False
+
+        try:
+            for field, cast, label in (('lat', float, 'Latitude'), ('long', float, 'Longitude'),
+                                       ('fiber_count', int, 'Số sợi')):
+                text = _import_cell(values, columns.get(field))
+                if not text:
+                    continue
+                value = _import_number(text, cast, label)
+                if closure[field] is not None and closure[field] != value:
+                    raise ValueError(f"{label} {text} khác với dòng {closure['row']}")
+                closure[field] = value
+
+            if closure['connections'] is None:
+                fiber_count = closure['fiber_count'] or DEFAULT_FIBER_COUNT
+                if fiber_count not in CABLE_PROFILES:
+                    raise ValueError(
+                        f"Số sợi {fiber_count} không được hỗ trợ ({', '.join(map(str, CABLE_PROFILES))})"
+                    )
+                closure['fiber_count'] = fiber_count
+                closure['connections'] = SpliceMap(fiber_count)
+
+            input_text = _import_cell(values, columns.get('input'))
+            output_text = _import_cell(values, columns.get('output'))
+            if not input_text and not output_text:
+                continue
+            if not input_text or not output_text:
+                raise ValueError("Cần có cả đầu vào và đầu ra")
+
+            connections = closure['connections']
+            input_fiber = _import_number(input_text, int, 'Đầu vào')
+            output_fiber = _import_number(output_text, int, 'Đầu ra')
+            for fiber in (input_fiber, output_fiber):
+                if not 1 <= fiber <= connections.fiber_count:
+                    raise ValueError(f"Sợi {fiber} nằm ngoài khoảng 1-{connections.fiber_count}")
+            if input_fiber in connections:
+                raise ValueError(
+                    f"Sợi đầu vào {input_fiber} đã khai báo ở dòng {closure['input_rows'][input_fiber]}"
+                )
+            owner = connections.input_for(output_fiber)
+            if owner is not None:
+                raise ValueError(
+                    f"Sợi đầu ra {output_fiber} đã được dùng cho đầu vào {owner} "
+                    f"ở dòng {closure['input_rows'][owner]}"
+                )
+            connections[input_fiber] = output_fiber
+            closure['input_rows'][input_fiber] = row_number
+        except ValueError as e:
+            errors.append((row_number, name, str(e)))
+            closure['valid'] = False
+
+    valid = []
+    for name, closure in closures.items():
+        if closure['valid'] and (closure['lat'] is None or closure['long'] is None):
+            errors.append((closure['row'], name, "thiếu toạ độ"))
+            closure['valid'] = False
+        elif closure['valid'] and not (-90 <= closure['lat'] <= 90 and -180 <= closure['long'] <= 180):
+            errors.append((closure['row'], name, "toạ độ không hợp lệ"))
+            closure['valid'] = False
+        if closure['valid']:
+            # Như /addmx: mọi sợi đầu vào phải có đầu ra để bảng đấu nối là một hoán vị đầy đủ
+            connections = closure['connections']
+            missing = [fiber for fiber in range(1, connections.fiber_count + 1) if fiber not in connections]
+            if missing:
+                errors.append((closure['row'], name,
+                               f"thiếu đấu nối {len(missing)}/{connections.fiber_count} sợi đầu vào: "
+                               f"{format_fiber_ranges(missing)}"))
+                closure['valid'] = False
+        if closure['valid']:
+            valid.append((name, closure['lat'], closure['long'], closure['connections'], closure['fiber_count']))
+
+    if columns is None:
+        errors.append((1, '', "File trống"))
+    errors.sort()
+    return valid, errors
+
+
+def parse_import_document(filename, data):
+    """Đọc và kiểm tra file nhập hàng loạt (chạy trong thread pool)"""
+    return validate_import_rows(iter_import_rows(filename, data), get_store())
+
+
+def import_closures(closures, user=None):
+    """Ghi các măng xông đã kiểm tra trong một transaction, trả về False nếu không ghi được"""
+    if not write_closures(closures, user):
+        return False
+    index_closures(closures)
+    return True
+
+
+async def import_closures_async(closures, user=None):
+    """Như import_closures, transaction chạy trong thread pool workbook để không chặn event loop
+
+    Chỉ mục trong bộ nhớ vẫn được cập nhật trên event loop, nơi các handler đọc chúng.
+    """
+    if not await run_workbook_job(write_closures, closures, user):
+        return False
+    index_closures(closures)
+    return True
+
+
+def write_closures(closures, user=None):
+    """Ghi các măng xông mới vào kho (và nhật ký) trong một transaction"""
+    if not closures:
+        return True
+    journal = journal_entries(*(ChangeJournal.add_entry(*closure, user) for closure in closures))
+    if not get_store().add_many(closures, journal):
+        return False
+    sync_journal()
+    return True
+
+
+def index_closures(closures):
+    """Đưa các măng xông vừa ghi vào chỉ mục trong bộ nhớ"""
+    if not closures:
+        return
+    for mx_name, *_ in closures:
+        index_closure(mx_name, get_store().get(mx_name))
+    mark_data_changed()
+
+
+def format_import_report(filename, closures, errors):
+    """Tạo báo cáo nhập hàng loạt -> (tin nhắn, toàn bộ danh sách lỗi hoặc None)"""
+    rejected = len({mx_name for _, mx_name, _ in errors if mx_name})
+    lines = [
+        f"Kết quả nhập hàng loạt từ {filename}:",
+        f"✅ Đã thêm {len(closures)} măng xông "
+        f"({sum(len(connections) for _, _, _, connections, _ in closures)} cặp đấu nối)",
+    ]
+    if not errors:
+        return "\n".join(lines), None
+
+    lines.append(f"❌ {len(errors)} lỗi, {rejected} măng xông bị bỏ qua:")
+    error_lines = [f"Dòng {row_number}: {f'{mx_name}: ' if mx_name else ''}{message}"
+                   for row_number, mx_name, message in errors]
+    lines.extend(error_lines[:IMPORT_REPORT_MAX_LINES])
+    if len(error_lines) > IMPORT_REPORT_MAX_LINES:
+        lines.append(f"... và {len(error_lines) - IMPORT_REPORT_MAX_LINES} lỗi khác (xem file đính kèm)")
+        return "\n".join(lines), "\n".join(error_lines)
+    return "\n".join(lines), None
+
+
+# Bố cục sheet của một măng xông
+SHEET_HEADERS = ['STT', 'Màu sắc', 'Co nhiệt', 'Vị trí trong co', 'Đầu vào', 'Đầu ra', 'Ghi chú']
+SHEET_COLUMN_WIDTHS = {'A': 8, 'B': 12, 'C': 10, 'D': 12, 'E': 10, 'F': 10, 'G': 15}
+
+# Style dùng chung theo màu sợi: (fill nền, font chữ tương phản)
+_FIBER_STYLES = {}
+
+
+def get_fiber_style(color_hex):
+    """Lấy cặp (PatternFill, Font) dùng chung cho một màu sợi"""
+    style = _FIBER_STYLES.get(color_hex)
+    if style is None:
+        # Màu chữ (đen hoặc trắng tùy vào màu nền)
+        text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
+        style = (
+            openpyxl.styles.PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid'),
+            openpyxl.styles.Font(color=text_color)
+        )
+        _FIBER_STYLES[color_hex] = style
+    return style
+
+
+def _fiber_rows(connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Sinh các dòng dữ liệu (theo thứ tự cột SHEET_HEADERS) cho từng sợi"""
+    table = get_fiber_table(fiber_count)
+    for fiber_num in range(1, fiber_count + 1):
+        # Màu sợi và co nhiệt chứa sợi này lấy từ bảng tra dựng sẵn
+        color_name, _, _, hs_name, hs_pos = table[fiber_num]
+
+        # Xác định đầu ra
+        output_fiber = connections.get(fiber_num, fiber_num)
+
+        # Xác định ghi chú
+        note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
+
+        yield [fiber_num, color_name, hs_name, hs_pos, fiber_num, output_fiber, note]
+
+
+def _fiber_data_validation(fiber_count=DEFAULT_FIBER_COUNT):
+    """Data Validation cho cột đầu vào và đầu ra"""
+    dv = openpyxl.worksheet.datavalidation.DataValidation(
+        type="whole",
+        operator="between",
+        formula1="1",
+        formula2=str(fiber_count),
+        showErrorMessage=True,
+        errorTitle="Giá trị không hợp lệ",
+        error=f"Vui lòng nhập số từ 1 đến {fiber_count}"
+    )
+    last_row = fiber_count + 4
+    dv.add(f'E5:E{last_row}')  # Cột Đầu vào
+    dv.add(f'F5:F{last_row}')  # Cột Đầu ra
+    return dv
+
+
+def _write_mx_sheet(ws, mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Ghi toàn bộ nội dung sheet của một măng xông vào worksheet trống"""
+    table = get_fiber_table(fiber_count)
+
+    # Thêm thông tin vị trí
+    ws['A1'] = 'Tên măng xông:'
+    ws['B1'] = mx_name
+    ws['A2'] = 'Vị trí (lat):'
+    ws['B2'] = lat
+    ws['A3'] = 'Vị trí (long):'
+    ws['B3'] = long
+
+    # Tiêu đề các cột
+    ws.append(SHEET_HEADERS)
+
+    # Định dạng tiêu đề
+    header_font = openpyxl.styles.Font(bold=True)
+    for col in range(1, len(SHEET_HEADERS) + 1):
+        ws.cell(row=4, column=col).font = header_font
+
+    # Thêm dữ liệu cho từng sợi
+    for row_values in _fiber_rows(connections, fiber_count):
+        ws.append(row_values)
+
+        # Định dạng màu cho ô màu sợi, đầu vào và đầu ra
+        row = row_values[0] + 4  # Dòng bắt đầu từ 5
+        for col_num, fiber in ((2, row_values[0]), (5, row_values[4]), (6, row_values[5])):
+            fill, font = get_fiber_style(table[fiber][1])
+            cell = ws.cell(row=row, column=col_num)
+            cell.fill = fill
+            cell.font = font
+
+    # Thiết lập Data Validation cho cột đầu vào và đầu ra
+    ws.add_data_validation(_fiber_data_validation(fiber_count))
+
+    # Đặt chiều rộng cột
+    for col, width in SHEET_COLUMN_WIDTHS.items():
+        ws.column_dimensions[col].width = width
+
+
+_XLSX_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_XLSX_PACKAGE_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_XLSX_CONTENT_TYPES = 'http://schemas.openxmlformats.org/package/2006/content-types'
+_XLSX_SHEET_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+_XML_ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+
+def _xlsx_cell(ref, value, style=0):
+    """XML của một ô: số ghi dạng số, còn lại ghi dạng inline string
+
+    ValueError nếu nội dung có ký tự không ghi được vào XML.
+    """
+    style = f' s="{style}"' if style else ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"{style} t="n"><v>{value}</v></c>'
+    text = str(value)
+    if _XML_ILLEGAL_CHARS.search(text):
+        raise ValueError(f"Ô {ref} chứa ký tự điều khiển: {text!r}")
+    return f'<c r="{ref}"{style} t="inlineStr"><is><t>{escape(text)}</t></is></c>'
+
+
+def _mx_sheet_xml(mx_name, lat, long, connections, fiber_count, styles):
+    """XML của sheet một măng xông, cùng bố cục với _write_mx_sheet
+
+    styles ánh xạ 'header' hoặc mã màu sợi -> chỉ số style trong styles.xml,
+    màu mới được cấp chỉ số tiếp theo khi gặp lần đầu.
+    """
+    table = get_fiber_table(fiber_count)
+
+    def style_for(key):
+        return styles.setdefault(key, len(styles) + 1)
+
+    parts = [
+        f'<worksheet xmlns="{_XLSX_MAIN_NS}" xmlns:r="{_XLSX_REL_NS}"><cols>',
+        ''.join(f'<col min="{index}" max="{index}" width="{width}" customWidth="1"/>'
+                for index, width in enumerate(SHEET_COLUMN_WIDTHS.values(), 1)),
+        '</cols><sheetData>',
+        f'<row r="1">{_xlsx_cell("A1", "Tên măng xông:")}{_xlsx_cell("B1", mx_name)}</row>',
+        f'<row r="2">{_xlsx_cell("A2", "Vị trí (lat):")}{_xlsx_cell("B2", lat)}</row>',
+        f'<row r="3">{_xlsx_cell("A3", "Vị trí (long):")}{_xlsx_cell("B3", long)}</row>',
+        '<row r="4">',
+        ''.join(_xlsx_cell(f'{column}4', title, style_for('header'))
+                for column, title in zip('ABCDEFG', SHEET_HEADERS)),
+        '</row>',
+    ]
+    for fiber_num, color_name, hs_name, hs_pos, input_fiber, output_fiber, note in _fiber_rows(connections, fiber_count):
+        row = fiber_num + 4
+        parts.append(
+            f'<row r="{row}">'
+            f'{_xlsx_cell(f"A{row}", fiber_num)}'
+            f'{_xlsx_cell(f"B{row}", color_name, style_for(table[fiber_num][1]))}'
+            f'{_xlsx_cell(f"C{row}", hs_name)}'
+            f'{_xlsx_cell(f"D{row}", hs_pos)}'
+            f'{_xlsx_cell(f"E{row}", input_fiber, style_for(table[input_fiber][1]))}'
+            f'{_xlsx_cell(f"F{row}", output_fiber, style_for(table[output_fiber][1]))}'
+            f'{_xlsx_cell(f"G{row}", note)}'
+            '</row>'
+        )
+    last_row = fiber_count + 4
+    parts.append(
+        '</sheetData><dataValidations count="1">'
+        f'<dataValidation type="whole" operator="between" allowBlank="1" showErrorMessage="1" '
+        f'errorTitle="Giá trị không hợp lệ" error="Vui lòng nhập số từ 1 đến {fiber_count}" '
+        f'sqref="E5:E{last_row} F5:F{last_row}"><formula1>1</formula1><formula2>{fiber_count}</formula2>'
+        '</dataValidation></dataValidations></worksheet>'
+    )
+    return ''.join(parts)
+
+
+def _xlsx_styles_xml(styles):
+    """styles.xml cho các chỉ số style đã cấp trong _mx_sheet_xml"""
+    fills = ['<fill><patternFill patternType="none"/></fill>', '<fill><patternFill patternType="gray125"/></fill>']
+    # Font 0 mặc định, 1 đậm (tiêu đề), 2 chữ đen, 3 chữ trắng
+    xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+    for key, _ in sorted(styles.items(), key=lambda item: item[1]):
+        if key == 'header':
+            xfs.append('<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>')
+            continue
+        # Màu chữ (đen hoặc trắng tùy vào màu nền), như get_fiber_style
+        font_id = 2 if key in ['FFFFFF', '00FFFF', 'FFFF00'] else 3
+        fills.append(f'<fill><patternFill patternType="solid"><fgColor rgb="00{key}"/>'
+                     f'<bgColor rgb="00{key}"/></patternFill></fill>')
+        xfs.append(f'<xf numFmtId="0" fontId="{font_id}" fillId="{len(fills) - 1}" borderId="0" xfId="0" '
+                   'applyFont="1" applyFill="1"/>')
+    fonts = ''.join(f'<font><sz val="11"/>{extra}<name val="Calibri"/><family val="2"/></font>'
+                    for extra in ('', '<b/>', '<color rgb="00000000"/>', '<color rgb="00FFFFFF"/>'))
+    return (
+        f'<styleSheet xmlns="{_XLSX_MAIN_NS}">'
+        f'<fonts count="4">{fonts}</fonts>'
+        f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        f'<cellXfs count="{len(xfs)}">{"".join(xfs)}</cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    )
+
+
+def _stream_xlsx(filename, closures):
+    """Ghi file xlsx tổng hợp, mỗi sheet được dựng thành XML rồi ghi thẳng vào file zip
+
+    closures là danh sách (tên, dữ liệu măng xông). Chỉ giữ trong bộ nhớ XML
+    của sheet đang ghi cùng tên các sheet; file được ghi ra file tạm rồi thay
+    thế file cũ để người đọc không thấy file ghi dở.
+    """
+    dir_path = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(suffix='.xlsx', dir=dir_path)
+    styles = {}
+    names = []
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file, \
+                zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+            for mx_name, mx_data in closures:
+                # Tên sheet sai làm hỏng cả file: dừng lại, giữ nguyên file cũ
+                validate_mx_name(mx_name)
+                names.append(mx_name)
+                zout.writestr(f'xl/worksheets/sheet{len(names)}.xml', _mx_sheet_xml(
+                    mx_name,
+                    mx_data['location']['lat'],
+                    mx_data['location']['long'],
+                    mx_data['connections'],
+                    get_fiber_count(mx_data),
+                    styles
+                ))
+
+            zout.writestr('xl/styles.xml', _xlsx_styles_xml(styles))
+            zout.writestr('xl/workbook.xml', (
+                f'<workbook xmlns="{_XLSX_MAIN_NS}" xmlns:r="{_XLSX_REL_NS}"><sheets>'
+                + ''.join(f'<sheet name="{escape(name, _XML_ATTRIBUTE_ENTITIES)}" sheetId="{index}" r:id="rId{index}"/>'
+                          for index, name in enumerate(names, 1))
+                + '</sheets></workbook>'
+            ))
+            zout.writestr('xl/_rels/workbook.xml.rels', (
+                f'<Relationships xmlns="{_XLSX_PACKAGE_REL_NS}">'
+                + ''.join(f'<Relationship Id="rId{index}" Target="worksheets/sheet{index}.xml" '
+                          f'Type="{_XLSX_REL_NS}/worksheet"/>' for index in range(1, len(names) + 1))
+                + f'<Relationship Id="rId{len(names) + 1}" Target="styles.xml" Type="{_XLSX_REL_NS}/styles"/>'
+                '</Relationships>'
+            ))
+            zout.writestr('_rels/.rels', (
+                f'<Relationships xmlns="{_XLSX_PACKAGE_REL_NS}"><Relationship Id="rId1" '
+                f'Target="xl/workbook.xml" Type="{_XLSX_REL_NS}/officeDocument"/></Relationships>'
+            ))
+            zout.writestr('[Content_Types].xml', (
+                f'<Types xmlns="{_XLSX_CONTENT_TYPES}">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                '<Override PartName="/xl/styles.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+                + ''.join(f'<Override PartName="/xl/worksheets/sheet{index}.xml" ContentType="{_XLSX_SHEET_TYPE}"/>'
+                          for index in range(1, len(names) + 1))
+                + '</Types>'
+            ))
+        os.replace(tmp_path, filename)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_excel_with_new_mx(mx_name, lat, long, connections, fiber_count=DEFAULT_FIBER_COUNT):
     """Cập nhật file Excel với măng xông mới"""
+    with _EXCEL_FILE_LOCK:
+        _update_excel_with_new_mx(mx_name, lat, long, connections, fiber_count)
+
+
+def _update_excel_with_new_mx(mx_name, lat, long, connections, fiber_count):
+    """Thêm sheet măng xông mới vào file Excel (gọi khi đã giữ khóa file Excel)"""
     try:
         # Mở file Excel hiện có
         if not os.path.exists(MAIN_EXCEL_FILE):
+            # File mới được tạo từ kho lưu trữ đã có sẵn măng xông này
             create_excel_file(MAIN_EXCEL_FILE)
+            return
 
-        wb = openpyxl.load_workbook(MAIN_EXCEL_FILE)
+        with METRICS.timer('mx_workbook_io_seconds', op='load_workbook'):
+            wb = openpyxl.load_workbook(MAIN_EXCEL_FILE)
 
         # Tạo sheet mới cho măng xông
         ws = wb.create_sheet(title=mx_name)
-
-        # Thêm thông tin vị trí
-        ws['A1'] = 'Tên măng xông:'
-        ws['B1'] = mx_name
-        ws['A2'] = 'Vị trí (lat):'
-        ws['B2'] = lat
-        ws['A3'] = 'Vị trí (long):'
-        ws['B3'] = long
-
-        # Tiêu đề các cột
-        headers = ['STT', 'Màu sắc', 'Co nhiệt', 'Vị trí trong co', 'Đầu vào', 'Đầu ra', 'Ghi chú']
-        ws.append(headers)
-
-        # Định dạng tiêu đề
-        for col in range(1, len(headers) + 1):
-            ws.cell(row=4, column=col).font = Font(bold=True)
-
-        # Thêm dữ liệu cho từng sợi
-        for fiber_num in range(1, 25):
-            color_name, color_hex = FIBER_COLORS[fiber_num]
-
-            # Tìm co nhiệt chứa sợi này
-            hs_name = ''
-            hs_pos = ''
-            for hs, fibers in HEAT_SHRINKS.items():
-                if fiber_num in fibers:
-                    hs_name = hs
-                    pos = fibers.index(fiber_num) + 1
-                    hs_pos = f"{pos}/{len(fibers)}"
-                    break
-
-            # Xác định đầu ra
-            output_fiber = connections.get(fiber_num, fiber_num)
-
-            # Xác định ghi chú
-            note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
-
-            # Thêm dòng dữ liệu
-            ws.append([
-                fiber_num,
-                color_name,
-                hs_name,
-                hs_pos,
-                fiber_num,
-                output_fiber,
-                note
-            ])
-
-            # Định dạng màu cho các ô
-            row = fiber_num + 4  # Dòng bắt đầu từ 5
-            # Màu sợi cáp
-            _, color_hex = FIBER_COLORS[fiber_num]
-            fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid')
-            ws.cell(row=row, column=2).fill = fill
-
-            # Màu chữ (đen hoặc trắng tùy vào màu nền)
-            text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
-            ws.cell(row=row, column=2).font = Font(color=text_color)
-
-            # Định dạng có điều kiện cho cột đầu vào và đầu ra
-            for col_num in [5, 6]:  # Cột E (5) và F (6)
-                cell = ws.cell(row=row, column=col_num)
-                if cell.value:
-                    _, color_hex = FIBER_COLORS[cell.value]
-                    fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid')
-                    cell.fill = fill
-                    text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
-                    cell.font = Font(color=text_color)
-
-        # Thiết lập Data Validation cho cột đầu vào và đầu ra
-        dv = openpyxl.worksheet.datavalidation.DataValidation(
-            type="whole",
-            operator="between",
-            formula1="1",
-            formula2="24",
-            showErrorMessage=True,
-            errorTitle="Giá trị không hợp lệ",
-            error="Vui lòng nhập số từ 1 đến 24"
-        )
-        ws.add_data_validation(dv)
-        dv.add('E5:E28')  # Cột Đầu vào
-        dv.add('F5:F28')  # Cột Đầu ra
-
-        # Đặt chiều rộng cột
-        column_widths = {'A': 8, 'B': 12, 'C': 10, 'D': 12, 'E': 10, 'F': 10, 'G': 15}
-        for col, width in column_widths.items():
-            ws.column_dimensions[col].width = width
+        _write_mx_sheet(ws, mx_name, lat, long, connections, fiber_count)
 
         # Lưu file
-        wb.save(MAIN_EXCEL_FILE)
+        with METRICS.timer('mx_workbook_io_seconds', op='save'):
+            wb.save(MAIN_EXCEL_FILE)
         logger.info(f"Đã cập nhật file Excel với măng xông mới {mx_name}")
 
     except Exception as e:
         logger.error(f"Error updating Excel with new MX: {e}")
         raise
 
+def format_fiber_label(fiber_num, fiber_count=DEFAULT_FIBER_COUNT):
+    """Nhãn hiển thị của một sợi: số sợi, màu (và ống với cáp nhiều sợi)"""
+    color_name, _, tube, _, _ = get_fiber_table(fiber_count)[fiber_num]
+    if fiber_count <= DEFAULT_FIBER_COUNT:
+        return f"{fiber_num:2} ({color_name:10})"
+    return f"{fiber_num:3} (Ống {tube:2} {color_name:10})"
+
+
+def render_connection_lines(connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Tạo bảng đấu nối dạng văn bản, mỗi sợi một dòng"""
+    lines = []
+    for input_fiber, output_fiber in connections.items():
+        note = "Thẳng" if input_fiber == output_fiber else "Chéo"
+        lines.append(f"{format_fiber_label(input_fiber, fiber_count)} -> {output_fiber:2} | {note}\n")
+    return ''.join(lines)
+
+
+# Bộ nhớ đệm bảng đấu nối đã dựng sẵn: (tên măng xông, phiên bản) -> các trang nội dung (LRU)
+# Khoá theo phiên bản nên mọi đường ghi (kể cả nạp lại từ worker khác) đều tự làm cũ bản đã dựng
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '256'))
+# Cáp tới số sợi này hiển thị mỗi sợi một dòng, cáp lớn hơn hiển thị gọn mỗi ống một dòng
+RENDER_FULL_MAX_FIBERS = 48
+RENDER_TUBES_PER_PAGE = 12
+_RENDER_CACHE = OrderedDict()
+
+
+def _render_splice_pages(connections, fiber_count):
+    """Dựng các trang bảng đấu nối của một măng xông"""
+    if fiber_count <= RENDER_FULL_MAX_FIBERS:
+        return (
+            "Sợi | Đầu vào -> Đầu ra | Ghi chú\n"
+            "---------------------------\n"
+            + render_connection_lines(connections, fiber_count),
+        )
+
+    header = "Ống (màu): Đầu vào→Đầu ra (* = chéo, - = chưa đấu)\n"
+    tube_lines = []
+    for first_fiber in range(1, fiber_count + 1, FIBERS_PER_TUBE):
+        tube = (first_fiber - 1) // FIBERS_PER_TUBE + 1
+        color_name = FIBER_COLOR_CYCLE[(tube - 1) % len(FIBER_COLOR_CYCLE)][0]
+        pairs = []
+        for input_fiber in range(first_fiber, min(first_fiber + FIBERS_PER_TUBE, fiber_count + 1)):
+            output_fiber = connections.get(input_fiber)
+            if output_fiber is None:
+                pairs.append(f"{input_fiber}→-")
+            else:
+                pairs.append(f"{input_fiber}→{output_fiber}{'' if output_fiber == input_fiber else '*'}")
+        tube_lines.append(f"Ống {tube} ({color_name}): {' '.join(pairs)}\n")
+
+    return tuple(
+        header + ''.join(tube_lines[start:start + RENDER_TUBES_PER_PAGE])
+        for start in range(0, len(tube_lines), RENDER_TUBES_PER_PAGE)
+    )
+
+
+def render_splice_table(mx_name, page=1):
+    """Bảng đấu nối của một măng xông -> (nội dung trang, số trang), dựng lại chỉ khi phiên bản đổi"""
+    mx_data = get_store().get(mx_name)
+    key = (mx_name, get_data_version(mx_data))
+    pages = _RENDER_CACHE.get(key)
+    count_cache('render', pages is not None)
+    if pages is None:
+        pages = _render_splice_pages(mx_data['connections'], get_fiber_count(mx_data))
+        _RENDER_CACHE[key] = pages
+        if len(_RENDER_CACHE) > RENDER_CACHE_SIZE:
+            _RENDER_CACHE.popitem(last=False)
+    else:
+        _RENDER_CACHE.move_to_end(key)
+
+    page = min(max(page, 1), len(pages))
+    return pages[page - 1], len(pages)
+
+
+# Mẫu đấu nối nhập nhanh: tên -> hàm tạo các cặp trên một dãy sợi
+CONNECTION_TEMPLATES = {
+    'straight': lambda fibers: [(f, f) for f in fibers],
+    'thang': lambda fibers: [(f, f) for f in fibers],
+    'pairswap': lambda fibers: [pair for a, b in zip(fibers[::2], fibers[1::2]) for pair in ((a, b), (b, a))],
+    'doicap': lambda fibers: [pair for a, b in zip(fibers[::2], fibers[1::2]) for pair in ((a, b), (b, a))],
+}
+
+
+def _parse_fiber_range(text, fiber_count):
+    """Đọc 'n' hoặc 'a-b' (có thể giảm dần) -> danh sách sợi"""
+    bounds = [part.strip() for part in text.split('-')]
+    if len(bounds) not in (1, 2) or not all(part.isdigit() for part in bounds):
+        raise ValueError(f"'{text.strip()}' không phải số sợi hoặc dãy sợi")
+    start, end = int(bounds[0]), int(bounds[-1])
+    for fiber in (start, end):
+        if not 1 <= fiber <= fiber_count:
+            raise ValueError(f"Số sợi phải từ 1 đến {fiber_count} ('{text.strip()}')")
+    step = 1 if end >= start else -1
+    return list(range(start, end + step, step))
+
+
+def split_done_token(text):
+    """Tách 'done' ở cuối tin nhắn -> (phần còn lại, có kết thúc hay không)"""
+    match = re.fullmatch(r'(.*?)[\s,;]*\bdone', text.strip(), re.IGNORECASE | re.DOTALL)
+    if match:
+        return match.group(1).strip(), True
+    return text.strip(), False
+
+
+def parse_connection_spec(text, fiber_count=DEFAULT_FIBER_COUNT):
+    """Đọc nhiều cặp đấu nối trong một tin nhắn -> danh sách (đầu vào, đầu ra)
+
+    Mỗi dòng hoặc mỗi phần cách nhau bởi dấu phẩy là một trong các dạng:
+    '1:2', dãy '1-12:13-24' (hai dãy cùng độ dài), hoặc mẫu 'straight'/'pairswap'
+    (áp dụng cho mọi sợi hoặc cho một dãy, ví dụ 'pairswap 1-12').
+    """
+    pairs = []
+    for token in re.split(r'[\n,;]+', text.strip().lower()):
+        token = token.strip()
+        if not token:
+            continue
+
+        name, _, fiber_range = token.partition(' ')
+        if name in CONNECTION_TEMPLATES:
+            fibers = _parse_fiber_range(fiber_range, fiber_count) if fiber_range.strip() \
+                else list(range(1, fiber_count + 1))
+            if name in ('pairswap', 'doicap') and len(fibers) % 2:
+                raise ValueError(f"Mẫu {name} cần một số chẵn sợi ('{token}')")
+            pairs.extend(CONNECTION_TEMPLATES[name](fibers))
+            continue
+
+        if token.count(':') != 1:
+            raise ValueError(f"'{token}' không đúng định dạng ĐầuVào:ĐầuRa")
+        left, right = token.split(':')
+        inputs = _parse_fiber_range(left, fiber_count)
+        outputs = _parse_fiber_range(right, fiber_count)
+        if len(inputs) != len(outputs):
+            raise ValueError(f"Hai dãy sợi trong '{token}' không cùng độ dài")
+        pairs.extend(zip(inputs, outputs))
+
+    if not pairs:
+        raise ValueError("Không có cặp đấu nối nào")
+    return pairs
+
+
+def _duplicate_fiber_errors(pairs):
+    """Lỗi khi cùng một sợi đầu vào hoặc đầu ra xuất hiện nhiều lần trong một lần nhập"""
+    errors = []
+    seen_inputs, seen_outputs = {}, {}
+    for input_fiber, output_fiber in pairs:
+        if input_fiber in seen_inputs:
+            errors.append(f"Sợi đầu vào {input_fiber} được nhập nhiều lần")
+        elif output_fiber in seen_outputs:
+            errors.append(
+                f"Sợi đầu ra {output_fiber} được dùng cho cả đầu vào "
+                f"{seen_outputs[output_fiber]} và {input_fiber}"
+            )
+        seen_inputs[input_fiber] = output_fiber
+        seen_outputs.setdefault(output_fiber, input_fiber)
+    return errors
+
+
+def apply_new_pairs(connections, pairs):
+    """Thêm các cặp đấu nối mới (luồng /addmx) -> (bảng đấu nối mới, danh sách lỗi)
+
+    Chỉ áp dụng khi mọi cặp hợp lệ; có lỗi thì trả về bảng cũ.
+    """
+    errors = _duplicate_fiber_errors(pairs)
+    for input_fiber, output_fiber in pairs:
+        if input_fiber in connections:
+            errors.append(f"Sợi đầu vào {input_fiber} đã được nhập trước đó")
+        owner = connections.input_for(output_fiber)
+        if owner is not None:
+            errors.append(f"Sợi đầu ra {output_fiber} đã được sử dụng bởi sợi đầu vào {owner}")
+    if errors:
+        return connections, errors
+
+    updated = connections.copy()
+    for input_fiber, output_fiber in pairs:
+        updated[input_fiber] = output_fiber
+    return updated, []
+
+
+def apply_edit_pairs(connections, pairs):
+    """Sửa đầu ra của các sợi (luồng /editmx) -> (bảng đấu nối mới, sợi bị hoán đổi, lỗi)
+
+    Đầu ra đang được sợi khác dùng thì hai sợi hoán đổi đầu ra cho nhau để
+    bảng đấu nối vẫn là một hoán vị. Chỉ áp dụng khi mọi cặp hợp lệ.
+    """
+    errors = _duplicate_fiber_errors(pairs)
+    errors += [f"Sợi đầu vào {input_fiber} không tồn tại trong măng xông"
+               for input_fiber, _ in pairs if input_fiber not in connections]
+    if errors:
+        return connections, {}, errors
+
+    updated = connections.copy()
+    for input_fiber, output_fiber in pairs:
+        owner = updated.input_for(output_fiber)
+        if owner is not None and owner != input_fiber:
+            updated.swap_outputs(input_fiber, owner)
+        else:
+            updated[input_fiber] = output_fiber
+
+    # Các sợi không được nhập nhưng bị đổi đầu ra do hoán đổi
+    requested = {input_fiber for input_fiber, _ in pairs}
+    swapped = {fiber: updated[fiber] for fiber in connections.keys()
+               if fiber not in requested and updated[fiber] != connections[fiber]}
+    return updated, swapped, []
+
+
+def format_fiber_ranges(fibers):
+    """Rút gọn danh sách sợi thành các dãy: [1, 2, 3, 5] -> '1-3, 5'"""
+    parts = []
+    fibers = sorted(fibers)
+    start = previous = None
+    for fiber in fibers + [None]:
+        if start is not None and fiber == previous + 1:
+            previous = fiber
+            continue
+        if start is not None:
+            parts.append(str(start) if start == previous else f"{start}-{previous}")
+        start = previous = fiber
+    return ', '.join(parts) if parts else 'không có'
+
+
+@instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh /start"""
     try:
@@ -396,10 +2900,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/start - Hiển thị thông tin này\n"
             "/help - Hướng dẫn sử dụng\n"
             "/findmx - Tìm vị trí măng xông\n"
+            "/nearmx - Tìm măng xông gần vị trí của bạn\n"
+            "/trace - Theo dấu sợi quang qua các măng xông\n"
+            "/linkmx - Nối cáp giữa hai măng xông\n"
+            "/history - Lịch sử thay đổi của măng xông\n"
+            "/importmx - Nhập hàng loạt măng xông từ file CSV/Excel\n"
             "/getmx - Xem thông tin đấu nối măng xông\n"
             "/addmx - Thêm măng xông mới (cần quyền ghi)\n"
             "/editmx - Sửa đấu nối măng xông (cần quyền ghi)\n"  # Thêm dòng mới
-            "/download - Tải file Excel tổng hợp"
+            "/download - Tải file Excel tổng hợp\n"
+            "/stats - Số đo vận hành của bot (quản trị viên)"
         )
     except Exception as e:
         logger.error(f"Error in start command: {e}")
@@ -407,6 +2917,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Có lỗi xảy ra khi xử lý lệnh /start.")
 
 
+@instrument_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh /help"""
     try:
@@ -421,7 +2932,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "4. Sửa đấu nối măng xông (cần quyền):\n"  # Thêm mục mới
             "   Gõ /editmx sau đó nhập tên măng xông và các cặp đấu nối cần sửa\n\n"
             "5. Tải file Excel tổng hợp:\n"
-            "   Gõ /download để nhận file mới nhất"
+            "   Gõ /download để nhận file mới nhất\n\n"
+            "6. Tìm măng xông gần nhất:\n"
+            "   Gõ /nearmx rồi gửi vị trí hoặc nhập Lat,Long (thêm ,2km để tìm theo bán kính)\n\n"
+            "7. Theo dấu sợi quang:\n"
+            "   Gõ /linkmx MX1 MX2 để khai báo cáp ra của MX1 nối vào MX2\n"
+            "   Gõ /trace MX1 5 để xem đường đi của sợi 5 từ đầu cáp tới cuối cáp\n\n"
+            "8. Nhập hàng loạt:\n"
+            "   Gõ /importmx rồi gửi file CSV/Excel các cột TenMX, Lat, Long, SoSoi, DauVao, DauRa\n\n"
+            "9. Lịch sử thay đổi:\n"
+            "   Gõ /history MX1 để xem ai đã sửa đấu nối nào của MX1 và lúc nào"
         )
     except Exception as e:
         logger.error(f"Error in help command: {e}")
@@ -429,6 +2949,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Có lỗi xảy ra khi xử lý lệnh /help.")
 
 
+@instrument_handler
 async def find_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh tìm măng xông"""
     try:
@@ -443,13 +2964,14 @@ async def find_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 
+@instrument_handler
 async def handle_find_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý tên măng xông được nhập"""
     try:
-        mx_name = update.message.text.upper()
-        location = find_mx_location(mx_name)
+        mx_name, suggestions = resolve_mx_name(update.message.text)
 
-        if location:
+        if mx_name:
+            location = find_mx_location(mx_name)
             await update.message.reply_text(
                 f"Vị trí măng xông {mx_name}:\n"
                 f"Latitude: {location['lat']}\n"
@@ -457,9 +2979,9 @@ async def handle_find_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Bạn có thể copy toạ độ này để sử dụng."
             )
         else:
-            await update.message.reply_text(
-                f"Không tìm thấy măng xông {mx_name} trong hệ thống."
-            )
+            await update.message.reply_text(format_name_suggestions(update.message.text, suggestions))
+            if suggestions:
+                return FIND_MX
     except Exception as e:
         logger.error(f"Error in handle_find_mx: {e}")
         if update.message:
@@ -468,9 +2990,259 @@ async def handle_find_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+def parse_near_query(text):
+    """Đọc truy vấn 'lat,long[,k hoặc bán kính km]' -> (lat, long, k, radius_km)"""
+    parts = [part.strip() for part in text.replace(';', ',').split(',') if part.strip()]
+    if len(parts) == 1 and ' ' in parts[0]:
+        parts = parts[0].split()
+    if len(parts) not in (2, 3):
+        raise ValueError("Định dạng không đúng")
+
+    lat, long = float(parts[0]), float(parts[1])
+    if not (-90 <= lat <= 90 and -180 <= long <= 180):
+        raise ValueError("Toạ độ không hợp lệ")
+
+    k, radius_km = NEAR_MX_DEFAULT_K, None
+    if len(parts) == 3:
+        option = parts[2].lower()
+        if option.endswith('km'):
+            radius_km = float(option[:-2])
+            # float() nhận cả 'nan' và 'inf'
+            if not (math.isfinite(radius_km) and 0 < radius_km <= NEAR_MX_MAX_RADIUS_KM):
+                raise ValueError(f"Bán kính phải lớn hơn 0 và không quá {NEAR_MX_MAX_RADIUS_KM:g} km")
+        else:
+            k = int(option)
+            if not 1 <= k <= NEAR_MX_MAX_K:
+                raise ValueError(f"Số măng xông phải từ 1 đến {NEAR_MX_MAX_K}")
+    return lat, long, k, radius_km
+
+
+async def reply_nearest_mx(update: Update, lat, long, k=NEAR_MX_DEFAULT_K, radius_km=None):
+    """Gửi danh sách măng xông gần một toạ độ"""
+    results = find_nearest_mx(lat, long, k, radius_km)
+    if radius_km is not None:
+        title = f"{len(results)} măng xông trong bán kính {radius_km:g} km quanh ({lat}, {long})"
+        if len(results) > NEAR_MX_MAX_K:
+            title += f", chỉ hiển thị {NEAR_MX_MAX_K} măng xông gần nhất"
+            results = results[:NEAR_MX_MAX_K]
+        title += ":"
+    else:
+        title = f"{len(results)} măng xông gần ({lat}, {long}) nhất:"
+
+    if not results:
+        await update.message.reply_text("Không tìm thấy măng xông nào gần vị trí này.")
+        return
+
+    lines = [title, ""]
+    for position, (distance, mx_name) in enumerate(results, start=1):
+        location = find_mx_location(mx_name)
+        lines.append(f"{position}. {mx_name} - {distance:.2f} km ({location['lat']}, {location['long']})")
+    await update.message.reply_text("\n".join(lines))
+
+
+@instrument_handler
+async def near_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh tìm măng xông gần vị trí"""
+    try:
+        if context.args:
+            try:
+                lat, long, k, radius_km = parse_near_query(' '.join(context.args))
+            except ValueError as e:
+                await update.message.reply_text(f"{e}. Ví dụ: /nearmx 10.12,106.12 hoặc /nearmx 10.12,106.12,2km")
+                return ConversationHandler.END
+            await reply_nearest_mx(update, lat, long, k, radius_km)
+            return ConversationHandler.END
+
+        await update.message.reply_text(
+            "Vui lòng gửi vị trí hiện tại hoặc nhập toạ độ theo định dạng:\n"
+            f"Lat,Long[,Số măng xông (mặc định {NEAR_MX_DEFAULT_K})]\n"
+            "hoặc Lat,Long,BánKínhkm (ví dụ: 10.12345,106.12345,2km)"
+        )
+        return NEAR_MX
+    except Exception as e:
+        logger.error(f"Error in near_mx command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi xử lý lệnh /nearmx.")
+        return ConversationHandler.END
+
+
+@instrument_handler
+async def handle_near_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý toạ độ (hoặc vị trí Telegram) để tìm măng xông gần nhất"""
+    try:
+        if update.message.location:
+            await reply_nearest_mx(update, update.message.location.latitude, update.message.location.longitude)
+            return ConversationHandler.END
+
+        try:
+            lat, long, k, radius_km = parse_near_query(update.message.text)
+        except ValueError as e:
+            await update.message.reply_text(f"{e}. Vui lòng nhập lại theo định dạng: Lat,Long[,k hoặc bán kính km]")
+            return NEAR_MX
+
+        await reply_nearest_mx(update, lat, long, k, radius_km)
+    except Exception as e:
+        logger.error(f"Error in handle_near_mx: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi tìm măng xông gần vị trí.")
+
+    return ConversationHandler.END
+
+
+async def reply_long_text(update: Update, text, limit=4000):
+    """Gửi văn bản dài thành nhiều tin nhắn, cắt theo dòng"""
+    chunk = []
+    for line in text.split("\n"):
+        if sum(len(part) + 1 for part in chunk) + len(line) > limit:
+            await update.message.reply_text("\n".join(chunk))
+            chunk = []
+        chunk.append(line)
+    await update.message.reply_text("\n".join(chunk))
+
+
+@instrument_handler
+async def trace_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh theo dấu sợi quang qua các măng xông"""
+    try:
+        if len(context.args) != 2:
+            await update.message.reply_text("Cú pháp: /trace TênMX Sợi (ví dụ: /trace MX1 5)")
+            return
+
+        mx_name, suggestions = resolve_mx_name(context.args[0])
+        if not mx_name:
+            await update.message.reply_text(format_name_suggestions(context.args[0], suggestions))
+            return
+
+        fiber_count = get_fiber_count(get_store().get(mx_name))
+        try:
+            fiber = int(context.args[1])
+        except ValueError:
+            fiber = 0
+        if not 1 <= fiber <= fiber_count:
+            await update.message.reply_text(f"Số sợi phải từ 1 đến {fiber_count}")
+            return
+
+        # Đường đi dài trên ring có thể vượt giới hạn độ dài một tin nhắn
+        await reply_long_text(update, render_fiber_trace(mx_name, fiber, trace_fiber(mx_name, fiber)))
+    except Exception as e:
+        logger.error(f"Error in trace command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi theo dấu sợi quang.")
+
+
+@instrument_handler
+async def link_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh nối cáp ra của một măng xông vào măng xông kế tiếp"""
+    try:
+        user = update.effective_user
+
+        # Kiểm tra quyền
+        if not await check_permission_async(user.username, 'write'):
+            await update.message.reply_text(
+                "Bạn không có quyền nối cáp giữa các măng xông. "
+                "Liên hệ quản trị viên để được cấp quyền."
+            )
+            return
+
+        if len(context.args) not in (1, 2):
+            await update.message.reply_text(
+                "Cú pháp: /linkmx MXĐầu MXSau để nối cáp ra của MXĐầu vào cáp vào của MXSau\n"
+                "hoặc /linkmx MXĐầu để tháo cáp ra"
+            )
+            return
+
+        from_mx = normalize_mx_name(context.args[0])
+        to_mx = normalize_mx_name(context.args[1]) if len(context.args) == 2 else None
+        try:
+            link_cable_segment(from_mx, to_mx, journal_user(update))
+        except ValueError as e:
+            await update.message.reply_text(str(e))
+            return
+
+        if to_mx:
+            await update.message.reply_text(f"Đã nối cáp ra của {from_mx} vào cáp vào của {to_mx}.")
+        else:
+            await update.message.reply_text(f"Đã tháo cáp ra của {from_mx}.")
+    except Exception as e:
+        logger.error(f"Error in link_mx command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi nối cáp giữa các măng xông.")
+
+
+@instrument_handler
+async def history_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh /history: các thay đổi gần nhất của một măng xông"""
+    try:
+        if len(context.args) != 1:
+            await update.message.reply_text("Cú pháp: /history TênMX (ví dụ: /history MX1)")
+            return
+        if JOURNAL is None:
+            await update.message.reply_text("Nhật ký thay đổi chưa được bật trên bot này.")
+            return
+
+        mx_name, suggestions = resolve_mx_name(context.args[0])
+        if not mx_name:
+            await update.message.reply_text(format_name_suggestions(context.args[0], suggestions))
+            return
+
+        # Đọc nhật ký trong thread pool để không chặn event loop
+        entries = await run_workbook_job(JOURNAL.history, mx_name)
+        if not entries:
+            await update.message.reply_text(f"Măng xông {mx_name} chưa có thay đổi nào trong nhật ký.")
+            return
+        await reply_long_text(
+            update,
+            f"Lịch sử thay đổi măng xông {mx_name} ({len(entries)} thay đổi gần nhất):\n\n"
+            + "\n".join(format_journal_entry(entry) for entry in entries)
+        )
+    except Exception as e:
+        logger.error(f"Error in history command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi đọc lịch sử thay đổi.")
+
+
+@instrument_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh /stats: số đo vận hành của bot (chỉ admin)"""
+    try:
+        user = update.effective_user
+        if not await check_permission_async(user.username, 'admin'):
+            await update.message.reply_text("Lệnh /stats chỉ dành cho quản trị viên.")
+            return
+
+        await reply_long_text(update, METRICS.render_summary() + "\n\n" + format_startup_report())
+    except Exception as e:
+        logger.error(f"Error in stats command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi lấy số đo của bot.")
+
+
+async def reply_splice_table(update: Update, mx_name, page=1):
+    """Gửi một trang bảng đấu nối của măng xông"""
+    table, page_count = render_splice_table(mx_name, page)
+    page = min(max(page, 1), page_count)
+    message = f"Thông tin đấu nối măng xông {mx_name}"
+    message += f" (trang {page}/{page_count}):\n\n" if page_count > 1 else ":\n\n"
+    message += table
+    if page < page_count:
+        message += f"\nGõ /getmx {mx_name} {page + 1} để xem trang tiếp theo."
+    await update.message.reply_text(message)
+
+
+@instrument_handler
 async def get_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh xem thông tin măng xông"""
     try:
+        if context.args:
+            # /getmx TênMX [trang]
+            mx_name, suggestions = resolve_mx_name(context.args[0])
+            if not mx_name:
+                await update.message.reply_text(format_name_suggestions(context.args[0], suggestions))
+                return ConversationHandler.END
+            page = int(context.args[1]) if len(context.args) > 1 and context.args[1].isdigit() else 1
+            await reply_splice_table(update, mx_name, page)
+            return ConversationHandler.END
+
         await update.message.reply_text(
             "Vui lòng nhập tên măng xông cần xem thông tin đấu nối (ví dụ: MX1):"
         )
@@ -482,27 +3254,18 @@ async def get_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 
+@instrument_handler
 async def handle_get_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý thông tin đấu nối măng xông"""
     try:
-        mx_name = update.message.text.upper()
-        connections = get_mx_connections(mx_name)
-
-        if not connections:
-            await update.message.reply_text(f"Không tìm thấy măng xông {mx_name} trong hệ thống.")
-            return ConversationHandler.END
+        mx_name, suggestions = resolve_mx_name(update.message.text)
+        mx_data = get_store().get(mx_name) if mx_name else None
 
-        # Tạo thông điệp hiển thị
-        message = f"Thông tin đấu nối măng xông {mx_name}:\n\n"
-        message += "Sợi | Đầu vào -> Đầu ra | Ghi chú\n"
-        message += "---------------------------\n"
+        if not mx_data:
+            await update.message.reply_text(format_name_suggestions(update.message.text, suggestions))
+            return GET_MX if suggestions else ConversationHandler.END
 
-        for input_fiber, output_fiber in connections.items():
-            note = "Thẳng" if input_fiber == output_fiber else "Chéo"
-            color_name, _ = FIBER_COLORS[input_fiber]
-            message += f"{input_fiber:2} ({color_name:10}) -> {output_fiber:2} | {note}\n"
-
-        await update.message.reply_text(message)
+        await reply_splice_table(update, mx_name)
     except Exception as e:
         logger.error(f"Error in handle_get_mx: {e}")
         if update.message:
@@ -511,13 +3274,14 @@ async def handle_get_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@instrument_handler
 async def add_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh thêm măng xông mới"""
     try:
         user = update.effective_user
 
         # Kiểm tra quyền
-        if not check_permission(user.username, 'write'):
+        if not await check_permission_async(user.username, 'write'):
             await update.message.reply_text(
                 "Bạn không có quyền thêm măng xông mới. "
                 "Liên hệ quản trị viên để được cấp quyền."
@@ -526,7 +3290,8 @@ async def add_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text(
             "Vui lòng nhập thông tin măng xông mới theo định dạng sau:\n\n"
-            "TênMX,Latitude,Longitude\n"
+            "TênMX,Latitude,Longitude[,Số sợi]\n"
+            f"(Số sợi: {', '.join(map(str, CABLE_PROFILES))}; mặc định {DEFAULT_FIBER_COUNT})\n"
             "Sau đó nhập lần lượt các cặp đấu nối (Đầu vào:Đầu ra), mỗi cặp trên 1 dòng.\n"
             "Nhập 'done' khi hoàn tất.\n\n"
             "Ví dụ:\n"
@@ -535,7 +3300,9 @@ async def add_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "2:2\n"
             "...\n"
             "24:24\n"
-            "done"
+            "done\n\n"
+            "Hoặc nhập nhanh trong một tin nhắn:\n"
+            "1-12:1-12, 13-24:24-13, done"
         )
 
         context.user_data['adding_mx'] = True
@@ -547,16 +3314,35 @@ async def add_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 
+@instrument_handler
 async def handle_add_mx_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý thông tin cơ bản của măng xông mới"""
     try:
         data = update.message.text.split(',')
-        if len(data) != 3:
-            await update.message.reply_text("Định dạng không đúng. Vui lòng nhập lại theo định dạng: TênMX,Lat,Long")
+        if len(data) not in (3, 4):
+            await update.message.reply_text(
+                "Định dạng không đúng. Vui lòng nhập lại theo định dạng: TênMX,Lat,Long[,Số sợi]")
             return ADD_MX_NAME
 
-        mx_name, lat, long = data
+        mx_name, lat, long = data[:3]
         mx_name = mx_name.strip().upper()
+        try:
+            validate_mx_name(mx_name)
+        except ValueError as e:
+            await update.message.reply_text(f"{e}. Vui lòng nhập lại.")
+            return ADD_MX_NAME
+
+        fiber_count = DEFAULT_FIBER_COUNT
+        if len(data) == 4:
+            try:
+                fiber_count = int(data[3].strip())
+            except ValueError:
+                fiber_count = None
+            if fiber_count not in CABLE_PROFILES:
+                await update.message.reply_text(
+                    f"Số sợi phải là một trong các giá trị: {', '.join(map(str, CABLE_PROFILES))}. "
+                    "Vui lòng nhập lại.")
+                return ADD_MX_NAME
 
         try:
             lat = float(lat.strip())
@@ -565,7 +3351,7 @@ async def handle_add_mx_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("Latitude và Longitude phải là số. Vui lòng nhập lại.")
             return ADD_MX_NAME
 
-        if mx_name in CONNECTIONS:
+        if mx_name in get_store():
             await update.message.reply_text(f"Măng xông {mx_name} đã tồn tại. Vui lòng chọn tên khác.")
             return ADD_MX_NAME
 
@@ -574,13 +3360,15 @@ async def handle_add_mx_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
             'name': mx_name,
             'lat': lat,
             'long': long,
-            'connections': {}
+            'fiber_count': fiber_count,
+            'connections': SpliceMap(fiber_count)
         }
 
         await update.message.reply_text(
             f"Đã nhận thông tin măng xông {mx_name} tại vị trí ({lat}, {long}).\n"
-            "Vui lòng nhập các cặp đấu nối (Đầu vào:Đầu ra), mỗi cặp trên 1 dòng.\n"
-            "Nhập 'done' khi hoàn tất."
+            "Vui lòng nhập các cặp đấu nối (Đầu vào:Đầu ra), mỗi cặp trên 1 dòng hoặc cách nhau bởi dấu phẩy.\n"
+            "Có thể dùng dãy sợi (1-12:13-24) hoặc mẫu straight / pairswap cho mọi sợi.\n"
+            "Nhập 'done' khi hoàn tất (có thể thêm 'done' ở cuối tin nhắn)."
         )
         return ADD_MX_CONNECTIONS
     except Exception as e:
@@ -590,24 +3378,61 @@ async def handle_add_mx_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
 
+@instrument_handler
 async def handle_add_mx_connections(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý các cặp đấu nối của măng xông mới"""
     try:
-        text = update.message.text.strip().lower()
+        text, done = split_done_token(update.message.text.lower())
+        fiber_count = context.user_data['new_mx'].get('fiber_count', DEFAULT_FIBER_COUNT)
+
+        if text:
+            # Một tin nhắn có thể chứa nhiều cặp, dãy sợi hoặc mẫu; chỉ lưu khi tất cả hợp lệ
+            try:
+                pairs = parse_connection_spec(text, fiber_count)
+            except ValueError as e:
+                await update.message.reply_text(
+                    f"{e}. Vui lòng nhập lại theo định dạng: ĐầuVào:ĐầuRa (ví dụ: 1:1, 1-12:13-24 hoặc straight)")
+                return ADD_MX_CONNECTIONS
+
+            connections, errors = apply_new_pairs(context.user_data['new_mx']['connections'], pairs)
+            if errors:
+                await update.message.reply_text(
+                    "Không lưu cặp đấu nối nào trong tin nhắn này:\n"
+                    + "\n".join(f"❌ {error}" for error in errors[:20])
+                    + (f"\n... và {len(errors) - 20} lỗi khác" if len(errors) > 20 else "")
+                    + "\n\nVui lòng nhập lại."
+                )
+                return ADD_MX_CONNECTIONS
+            context.user_data['new_mx']['connections'] = connections
+
+            if not done:
+                missing_fibers = [f for f in range(1, fiber_count + 1) if f not in connections]
+                message = (
+                    f"✅ Đã nhận {len(pairs)} cặp đấu nối"
+                    + (f" {pairs[0][0]}:{pairs[0][1]}" if len(pairs) == 1 else "") + "\n"
+                    f"📊 Tiến độ: {len(connections)}/{fiber_count} sợi đã nhập\n\n"
+                    f"📌 Các sợi đã nhập: {format_fiber_ranges(connections.keys())}\n\n"
+                    f"🔍 Các sợi còn thiếu: {format_fiber_ranges(missing_fibers)}\n\n"
+                    "Vui lòng nhập tiếp hoặc gõ 'done' để kết thúc"
+                )
+                # Message.reply_text không nhận rate_limit_args, phải gửi qua ExtBot
+                await context.bot.send_message(update.effective_chat.id, message,
+                                               rate_limit_args=PROGRESS_RATE_LIMIT)
+                return ADD_MX_CONNECTIONS
 
-        if text == 'done':
-            # Kiểm tra đã có đủ 24 sợi chưa
+        if done:
+            # Kiểm tra đã có đủ số sợi chưa
             connections = context.user_data['new_mx']['connections']
-            if len(connections) != 24:
+            if len(connections) != fiber_count:
                 # Tạo danh sách các sợi đã nhập và chưa nhập
                 entered_fibers = sorted(connections.keys())
-                missing_fibers = [f for f in range(1, 25) if f not in connections]
+                missing_fibers = [f for f in range(1, fiber_count + 1) if f not in connections]
 
                 # Tạo thông báo chi tiết
                 message = (
-                    f"Bạn mới nhập được {len(connections)}/24 sợi.\n\n"
-                    f"✅ Các sợi đã nhập: {', '.join(map(str, entered_fibers))}\n\n"
-                    f"❌ Các sợi còn thiếu: {', '.join(map(str, missing_fibers))}\n\n"
+                    f"Bạn mới nhập được {len(connections)}/{fiber_count} sợi.\n\n"
+                    f"✅ Các sợi đã nhập: {format_fiber_ranges(entered_fibers)}\n\n"
+                    f"❌ Các sợi còn thiếu: {format_fiber_ranges(missing_fibers)}\n\n"
                     "Vui lòng nhập tiếp các sợi còn thiếu hoặc nhập 'done' nếu muốn hủy."
                 )
 
@@ -620,7 +3445,7 @@ async def handle_add_mx_connections(update: Update, context: ContextTypes.DEFAUL
             long = context.user_data['new_mx']['long']
             connections = context.user_data['new_mx']['connections']
 
-            success = add_new_mx(mx_name, lat, long, connections)
+            success = await add_new_mx_async(mx_name, lat, long, connections, fiber_count, journal_user(update))
 
             if success:
                 await update.message.reply_text(
@@ -639,61 +3464,8 @@ async def handle_add_mx_connections(update: Update, context: ContextTypes.DEFAUL
 
             return ConversationHandler.END
 
-        # Xử lý cặp đấu nối
-        if ':' not in text:
-            await update.message.reply_text(
-                "Định dạng không đúng. Vui lòng nhập theo định dạng: ĐầuVào:ĐầuRa (ví dụ: 1:1)")
-            return ADD_MX_CONNECTIONS
-
-        try:
-            input_fiber, output_fiber = map(int, text.split(':'))
-            if not (1 <= input_fiber <= 24 and 1 <= output_fiber <= 24):
-                raise ValueError
-        except ValueError:
-            await update.message.reply_text("Số sợi phải từ 1 đến 24. Vui lòng nhập lại.")
-            return ADD_MX_CONNECTIONS
-
-        # Kiểm tra trùng lặp
-        connections = context.user_data['new_mx']['connections']
-
-        # Kiểm tra trùng sợi đầu vào
-        if input_fiber in connections:
-            await update.message.reply_text(
-                f"Sợi đầu vào {input_fiber} đã được nhập trước đó. Vui lòng nhập lại."
-            )
-            return ADD_MX_CONNECTIONS
-
-        # Kiểm tra trùng sợi đầu ra (trừ trường hợp đấu thẳng)
-        if output_fiber in connections.values() and input_fiber != output_fiber:
-            # Tìm sợi đầu vào nào đang sử dụng đầu ra này
-            conflicting_input = next(
-                (in_fib for in_fib, out_fib in connections.items() if out_fib == output_fiber),
-                None
-            )
-            await update.message.reply_text(
-                f"Sợi đầu ra {output_fiber} đã được sử dụng bởi sợi đầu vào {conflicting_input}. "
-                "Vui lòng nhập lại."
-            )
-            return ADD_MX_CONNECTIONS
-
-        # Lưu cặp đấu nối
-        context.user_data['new_mx']['connections'][input_fiber] = output_fiber
-        remaining = 24 - len(context.user_data['new_mx']['connections'])
-
-        # Tạo danh sách cập nhật
-        entered_fibers = sorted(context.user_data['new_mx']['connections'].keys())
-        missing_fibers = [f for f in range(1, 25) if f not in context.user_data['new_mx']['connections']]
-
-        # Tạo thông báo chi tiết
-        message = (
-            f"✅ Đã nhận cặp đấu nối {input_fiber}:{output_fiber}\n"
-            f"📊 Tiến độ: {len(entered_fibers)}/24 sợi đã nhập\n\n"
-            f"📌 Các sợi đã nhập: {', '.join(map(str, entered_fibers))}\n\n"
-            f"🔍 Các sợi còn thiếu: {', '.join(map(str, missing_fibers))}\n\n"
-            "Vui lòng nhập tiếp hoặc gõ 'done' để kết thúc"
-        )
-
-        await update.message.reply_text(message)
+        await update.message.reply_text(
+            "Vui lòng nhập các cặp đấu nối (ví dụ: 1:1, 1-12:13-24 hoặc straight) hoặc gõ 'done' để kết thúc")
         return ADD_MX_CONNECTIONS
     except Exception as e:
         logger.error(f"Error in handle_add_mx_connections: {e}")
@@ -702,52 +3474,404 @@ async def handle_add_mx_connections(update: Update, context: ContextTypes.DEFAUL
         return ConversationHandler.END
 
 
-# Thêm hàm cập nhật đấu nối trong dictionary CONNECTIONS
-def update_mx_connections(mx_name, connections):
+# Thêm hàm cập nhật đấu nối trong kho lưu trữ
+def update_mx_connections(mx_name, connections, expected_version=None, user=None):
     """Cập nhật thông tin đấu nối của măng xông"""
     try:
         mx_name = mx_name.upper()
-        if mx_name not in CONNECTIONS:
+        store = get_store()
+        old = store.get(mx_name)
+        # Phiên bản trong kho chỉ được ghi khi còn khớp với old nên phần thay đổi tính từ old là đúng
+        journal = journal_entries(ChangeJournal.connections_entry(
+            mx_name, old['connections'] if old else {}, connections, user))
+        if not store.update_connections(mx_name, connections, expected_version, journal):
             return False
 
-        CONNECTIONS[mx_name]['connections'] = connections
+        mark_data_changed(mx_name)
+        sync_journal()
         return True
     except Exception as e:
         logger.error(f"Error in update_mx_connections: {e}")
         return False
 
 
+class EditSession:
+    """Phiên sửa đấu nối riêng của một user
+
+    Giữ bản nháp (bản sao copy-on-write của đấu nối lúc bắt đầu) và phiên
+    bản gốc; bảng đấu nối dùng chung chỉ thay đổi khi commit thành công.
+    """
+
+    def __init__(self, mx_name, mx_data):
+        self.mx_name = mx_name
+        self.fiber_count = get_fiber_count(mx_data)
+        self.rebase(mx_data)
+
+    def rebase(self, mx_data):
+        """Bắt đầu lại từ dữ liệu mới nhất, bỏ bản nháp hiện tại"""
+        self.base_version = get_data_version(mx_data)
+        self.base = mx_data['connections']
+        self.draft = self.base.copy()
+        # Sợi user không nhập nhưng bị đổi đầu ra do hoán đổi -> sợi user nhập gây ra hoán đổi
+        self.swap_causes = {}
+
+    def apply(self, draft, pairs, swapped):
+        """Nhận bản nháp mới từ apply_edit_pairs và ghi nhớ sợi nào đổi do hoán đổi"""
+        before = self.draft
+        self.draft = draft
+        for input_fiber, _ in pairs:
+            self.swap_causes.pop(input_fiber, None)
+        for fiber in swapped:
+            old_output = before.get(fiber)
+            self.swap_causes[fiber] = draft.input_for(old_output) if old_output is not None else None
+
+    def changed_fibers(self):
+        """Các sợi đầu vào có đầu ra trong bản nháp khác bản gốc"""
+        return [fiber for fiber in range(1, self.fiber_count + 1)
+                if self.draft.get(fiber) != self.base.get(fiber)]
+
+
+def commit_edit_session(session, user=None):
+    """Ghi bản nháp bằng compare-and-swap -> (đã ghi, sợi xung đột, sợi hoán đổi đã gộp)
+
+    Nếu người khác đã ghi sau khi phiên bắt đầu, các sợi chỉ một bên sửa được
+    gộp tự động; sợi cả hai bên cùng sửa khác nhau (hoặc kết quả gộp làm trùng
+    đầu ra) được trả về dưới dạng (sợi, đầu ra của mình, đầu ra hiện tại, sợi
+    gây hoán đổi hoặc None). Khi gộp thành công, các sợi chỉ đổi do hoán đổi
+    được trả về dạng (sợi, đầu ra mới, sợi gây hoán đổi) để báo lại cho user,
+    vì chúng được tính trên dữ liệu cũ.
+    """
+    current_data = get_store().get(session.mx_name)
+    if current_data is None:
+        return False, [], []
+
+    ours = session.changed_fibers()
+    if not ours:
+        return True, [], []
+
+    def clash_report(fibers, theirs):
+        return [(fiber, session.draft.get(fiber), theirs.get(fiber), session.swap_causes.get(fiber))
+                for fiber in fibers]
+
+    current_version = get_data_version(current_data)
+    if current_version == session.base_version:
+        merged = session.draft
+    else:
+        current = current_data['connections']
+        clashes = [fiber for fiber in ours
+                   if current.get(fiber) != session.base.get(fiber)
+                   and current.get(fiber) != session.draft.get(fiber)]
+        if not clashes:
+            forward = current.to_dict()
+            for fiber in ours:
+                output_fiber = session.draft.get(fiber)
+                if output_fiber is None:
+                    forward.pop(fiber, None)
+                else:
+                    forward[fiber] = output_fiber
+            owners = {}
+            for input_fiber, output_fiber in forward.items():
+                owners.setdefault(output_fiber, []).append(input_fiber)
+            clashes = sorted(fiber for inputs in owners.values() if len(inputs) > 1 for fiber in inputs)
+        if clashes:
+            return False, clash_report(clashes, current), []
+        merged = SpliceMap(session.fiber_count, forward)
+
+    if not update_mx_connections(session.mx_name, merged, current_version, user):
+        # Bị ghi chen giữa lúc kiểm tra và lúc ghi: báo như xung đột để user thử lại
+        return False, clash_report(ours, get_store().get(session.mx_name)['connections']), []
+    if current_version == session.base_version:
+        return True, [], []
+    return True, [], [(fiber, merged.get(fiber), session.swap_causes[fiber])
+                      for fiber in ours if fiber in session.swap_causes]
+
+
 # Thêm hàm cập nhật file Excel khi đấu nối mới
-def update_excel_connections(mx_name, connections):
+def _write_connection_cells(ws, connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Ghi lại cột đầu ra và ghi chú trong sheet của một măng xông"""
+    table = get_fiber_table(fiber_count)
+    # Cập nhật các cột đầu ra và ghi chú
+    for fiber_num in range(1, fiber_count + 1):
+        output_fiber = connections.get(fiber_num, fiber_num)
+        note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
+
+        # Cập nhật cột đầu ra (F) và ghi chú (G)
+        ws.cell(row=fiber_num + 4, column=6).value = output_fiber  # Cột F
+        ws.cell(row=fiber_num + 4, column=7).value = note  # Cột G
+
+        # Định dạng lại màu cho ô đầu ra
+        fill, font = get_fiber_style(table[output_fiber][1])
+        ws.cell(row=fiber_num + 4, column=6).fill = fill
+        ws.cell(row=fiber_num + 4, column=6).font = font
+
+
+# Namespace dùng trong các phần XML của file xlsx
+_XLSX_NS = {
+    'main': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+    'rel': 'http://schemas.openxmlformats.org/package/2006/relationships',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+}
+
+
+def _xlsx_sheet_parts(zin):
+    """Ánh xạ tên sheet -> đường dẫn phần XML của sheet trong file xlsx"""
+    root_rels = ET.fromstring(zin.read('_rels/.rels'))
+    workbook_part = next(
+        rel.get('Target').lstrip('/')
+        for rel in root_rels.findall('rel:Relationship', _XLSX_NS)
+        if rel.get('Type', '').endswith('/officeDocument')
+    )
+    workbook_dir = posixpath.dirname(workbook_part)
+    rels_part = posixpath.join(workbook_dir, '_rels', posixpath.basename(workbook_part) + '.rels')
+
+    targets = {}
+    for rel in ET.fromstring(zin.read(rels_part)).findall('rel:Relationship', _XLSX_NS):
+        target = rel.get('Target')
+        if target.startswith('/'):
+            targets[rel.get('Id')] = target.lstrip('/')
+        else:
+            targets[rel.get('Id')] = posixpath.normpath(posixpath.join(workbook_dir, target))
+
+    workbook = ET.fromstring(zin.read(workbook_part))
+    return {
+        sheet.get('name'): targets[sheet.get('{%s}id' % _XLSX_NS['r'])]
+        for sheet in workbook.iterfind('main:sheets/main:sheet', _XLSX_NS)
+    }
+
+
+def _xlsx_column_index(ref):
+    """Chỉ số cột (từ 0) của địa chỉ ô, ví dụ 'B3' -> 1"""
+    column = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        column = column * 26 + ord(char.upper()) - ord('A') + 1
+    return column - 1
+
+
+def _xlsx_shared_strings(zin):
+    """Bảng chuỗi dùng chung của file xlsx (rỗng nếu file không có)"""
+    main_ns = '{%s}' % _XLSX_NS['main']
+    shared_part = next((name for name in zin.namelist() if name.lower().endswith('sharedstrings.xml')), None)
+    if not shared_part:
+        return []
+    return [
+        ''.join(text.text or '' for text in item.iter(f'{main_ns}t'))
+        for item in ET.fromstring(zin.read(shared_part)).iterfind('main:si', _XLSX_NS)
+    ]
+
+
+def _iter_xlsx_rows(file, shared_strings):
+    """Duyệt từng dòng XML của một sheet bằng iterparse -> (số dòng, danh sách ô)
+
+    Mỗi ô là chuỗi hoặc None; dòng đã đọc được giải phóng ngay nên bộ nhớ
+    không phụ thuộc kích thước sheet.
+    """
+    main_ns = '{%s}' % _XLSX_NS['main']
+    row_tag = f'{main_ns}row'
+    row_count = 0
+    for _, element in ET.iterparse(file):
+        if element.tag != row_tag:
+            continue
+        row_count += 1
+        values = []
+        for cell in element.iterfind('main:c', _XLSX_NS):
+            ref = cell.get('r')
+            column = _xlsx_column_index(ref) if ref else len(values)
+            values.extend([None] * (column - len(values)))
+
+            cell_type = cell.get('t')
+            if cell_type == 'inlineStr':
+                value = ''.join(text.text or '' for text in cell.iter(f'{main_ns}t'))
+            else:
+                value = cell.findtext('main:v', None, _XLSX_NS)
+                if value is not None and cell_type == 's':
+                    value = shared_strings[int(value)]
+                elif value is not None and cell_type == 'b':
+                    value = 'TRUE' if value == '1' else 'FALSE'
+            values.append(value)
+        yield int(element.get('r') or row_count), values
+        element.clear()
+
+
+def read_xlsx_rows(filename):
+    """Đọc sheet đầu tiên của file xlsx thành danh sách dòng, mỗi ô là chuỗi hoặc None
+
+    Chỉ dùng zipfile và ElementTree nên nhẹ hơn nhiều so với pandas/openpyxl,
+    phù hợp với các file nhỏ như file phân quyền.
+    """
+    with zipfile.ZipFile(filename) as zin:
+        sheet_part = next(iter(_xlsx_sheet_parts(zin).values()))
+        shared_strings = _xlsx_shared_strings(zin)
+        with zin.open(sheet_part) as file:
+            return [values for _, values in _iter_xlsx_rows(file, shared_strings)]
+
+
+def _xlsx_cell_pattern(ref):
+    """Biểu thức tìm một ô theo địa chỉ trong XML của sheet"""
+    return re.compile(r'<c\b(?=[^>]*\br="%s")([^>]*?)(?:/>|>.*?</c>)' % ref, re.DOTALL)
+
+
+def _patch_sheet_xml(xml, connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Ghi lại cột đầu ra (F) và ghi chú (G) trực tiếp trong XML của sheet
+
+    Ô đầu ra dùng lại style của ô đầu vào có cùng số sợi (cột E) nên không
+    cần sửa styles.xml; ghi chú được ghi dạng inline string để không phải
+    đụng tới sharedStrings.xml.
+    """
+    for fiber_num in range(1, fiber_count + 1):
+        row = fiber_num + 4
+        output_fiber = connections.get(fiber_num, fiber_num)
+        note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
+
+        style_match = re.search(r'<c\b(?=[^>]*\br="E%d")[^>]*?\bs="(\d+)"' % (output_fiber + 4), xml)
+        if style_match is None:
+            raise ValueError(f"Không tìm thấy style cho sợi {output_fiber}")
+
+        f_pattern = _xlsx_cell_pattern(f'F{row}')
+        if not f_pattern.search(xml):
+            raise ValueError(f"Không tìm thấy ô F{row}")
+        xml = f_pattern.sub(
+            f'<c r="F{row}" s="{style_match.group(1)}" t="n"><v>{output_fiber}</v></c>', xml, count=1)
+
+        g_pattern = _xlsx_cell_pattern(f'G{row}')
+        g_match = g_pattern.search(xml)
+        if g_match is None:
+            raise ValueError(f"Không tìm thấy ô G{row}")
+        g_style = re.search(r'\bs="\d+"', g_match.group(1))
+        g_style = f' {g_style.group(0)}' if g_style else ''
+        xml = g_pattern.sub(
+            f'<c r="G{row}"{g_style} t="inlineStr"><is><t>{escape(note)}</t></is></c>', xml, count=1)
+    return xml
+
+
+# Chép thẳng dữ liệu đã nén cần tới phần nội bộ của zipfile (fp, FileHeader, _didModify):
+# chỉ bật trên các phiên bản CPython đã kiểm tra, phiên bản khác giải nén rồi nén lại
+_ZIP_RAW_COPY = (
+    sys.implementation.name == 'cpython'
+    and (3, 8) <= sys.version_info[:2] <= (3, 13)
+    and hasattr(zipfile, 'sizeFileHeader')
+    and hasattr(zipfile.ZipInfo, 'FileHeader')
+)
+
+
+def _copy_zip_member(zin, zout, info):
+    """Chép một phần của file zip sang file zip mới, giữ nguyên tên và cách nén"""
+    if _ZIP_RAW_COPY:
+        _copy_zip_member_raw(zin, zout, info)
+        return
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    zout.writestr(new_info, zin.read(info))
+
+
+def _copy_zip_member_raw(zin, zout, info):
+    """Chép nguyên dữ liệu đã nén của một phần trong file zip, không giải nén/nén lại"""
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    raw = zin.fp.read(info.compress_size)
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.create_system = info.create_system
+    new_info.external_attr = info.external_attr
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    # Kích thước và CRC đã ghi trong header nên không cần data descriptor
+    new_info.flag_bits = info.flag_bits & ~0x08
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    zout.fp.write(raw)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def patch_excel_connections(filename, updates):
+    """Sửa đấu nối của các măng xông trong file xlsx mà không nạp toàn bộ workbook
+
+    updates ánh xạ tên măng xông -> (đấu nối, số sợi). Chỉ phần XML của
+    các sheet bị ảnh hưởng được viết lại, các phần khác được chép nguyên
+    trạng. Trả về tập tên măng xông đã sửa; những tên không có sheet trong
+    file sẽ không có trong kết quả.
+    """
+    dir_path = os.path.dirname(os.path.abspath(filename))
+    with zipfile.ZipFile(filename) as zin:
+        sheet_parts = _xlsx_sheet_parts(zin)
+        patched_parts = {}
+        for mx_name, (connections, fiber_count) in updates.items():
+            part = sheet_parts.get(mx_name)
+            if part is None:
+                continue
+            xml = zin.read(part).decode('utf-8')
+            patched_parts[part] = (mx_name, _patch_sheet_xml(xml, connections, fiber_count).encode('utf-8'))
+
+        if not patched_parts:
+            return set()
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.xlsx', dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file, zipfile.ZipFile(tmp_file, 'w') as zout:
+                for info in zin.infolist():
+                    if info.filename in patched_parts:
+                        new_info = zipfile.ZipInfo(info.filename, info.date_time)
+                        new_info.compress_type = zipfile.ZIP_DEFLATED
+                        new_info.external_attr = info.external_attr
+                        zout.writestr(new_info, patched_parts[info.filename][1])
+                    else:
+                        _copy_zip_member(zin, zout, info)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    os.replace(tmp_path, filename)
+    return {mx_name for mx_name, _ in patched_parts.values()}
+
+
+def update_excel_connections(mx_name, connections, fiber_count=DEFAULT_FIBER_COUNT):
     """Cập nhật file Excel với thông tin đấu nối mới"""
+    with _EXCEL_FILE_LOCK:
+        return _update_excel_connections(mx_name, connections, fiber_count)
+
+
+async def update_excel_connections_async(mx_name, connections, fiber_count=DEFAULT_FIBER_COUNT):
+    """Cập nhật đấu nối trong file Excel bằng thread pool workbook"""
+    return await run_workbook_job(update_excel_connections, mx_name, connections, fiber_count)
+
+
+def _update_excel_connections(mx_name, connections, fiber_count):
+    """Ghi đấu nối mới vào sheet của măng xông (gọi khi đã giữ khóa file Excel)"""
     try:
         if not os.path.exists(MAIN_EXCEL_FILE):
             create_excel_file(MAIN_EXCEL_FILE)
 
-        wb = openpyxl.load_workbook(MAIN_EXCEL_FILE)
+        # Đường nhanh: chỉ viết lại phần XML của sheet này
+        try:
+            with METRICS.timer('mx_workbook_io_seconds', op='patch'):
+                patched = patch_excel_connections(MAIN_EXCEL_FILE, {mx_name: (connections, fiber_count)})
+            if patched:
+                logger.info(f"Đã cập nhật file Excel với thông tin đấu nối mới cho {mx_name}")
+                return True
+        except Exception as e:
+            logger.warning(f"Không sửa trực tiếp được sheet {mx_name}, nạp lại toàn bộ workbook: {e}")
+
+        with METRICS.timer('mx_workbook_io_seconds', op='load_workbook'):
+            wb = openpyxl.load_workbook(MAIN_EXCEL_FILE)
 
         if mx_name not in wb.sheetnames:
             return False
 
         ws = wb[mx_name]
 
-        # Cập nhật các cột đầu ra và ghi chú
-        for fiber_num in range(1, 25):
-            output_fiber = connections.get(fiber_num, fiber_num)
-            note = 'Đấu thẳng' if fiber_num == output_fiber else 'Đấu chéo'
-
-            # Cập nhật cột đầu ra (F) và ghi chú (G)
-            ws.cell(row=fiber_num + 4, column=6).value = output_fiber  # Cột F
-            ws.cell(row=fiber_num + 4, column=7).value = note  # Cột G
+        _write_connection_cells(ws, connections, fiber_count)
 
-            # Định dạng lại màu cho ô đầu ra
-            _, color_hex = FIBER_COLORS[output_fiber]
-            fill = PatternFill(start_color=color_hex, end_color=color_hex, fill_type='solid')
-            ws.cell(row=fiber_num + 4, column=6).fill = fill
-            text_color = '000000' if color_hex in ['FFFFFF', '00FFFF', 'FFFF00'] else 'FFFFFF'
-            ws.cell(row=fiber_num + 4, column=6).font = Font(color=text_color)
-
-        wb.save(MAIN_EXCEL_FILE)
+        with METRICS.timer('mx_workbook_io_seconds', op='save'):
+            wb.save(MAIN_EXCEL_FILE)
         logger.info(f"Đã cập nhật file Excel với thông tin đấu nối mới cho {mx_name}")
         return True
     except Exception as e:
@@ -755,14 +3879,433 @@ def update_excel_connections(mx_name, connections):
         return False
 
 
+def flush_closures_to_excel(mx_names):
+    """Ghi một loạt măng xông đã thay đổi vào file Excel trong một lần load/save"""
+    with _EXCEL_FILE_LOCK:
+        if not os.path.exists(MAIN_EXCEL_FILE):
+            # File mới được tạo từ kho lưu trữ đã chứa mọi thay đổi
+            create_excel_file(MAIN_EXCEL_FILE)
+            return len(mx_names)
+
+        # Măng xông đã có sheet: sửa trực tiếp phần XML, không nạp toàn bộ workbook
+        updates = {}
+        for mx_name in mx_names:
+            mx_data = get_store().get(mx_name)
+            if mx_data:
+                updates[mx_name] = (mx_data['connections'], get_fiber_count(mx_data))
+        try:
+            with METRICS.timer('mx_workbook_io_seconds', op='patch'):
+                patched = patch_excel_connections(MAIN_EXCEL_FILE, updates)
+        except Exception as e:
+            logger.warning(f"Không sửa trực tiếp được file Excel, nạp lại toàn bộ workbook: {e}")
+            patched = set()
+
+        remaining = [mx_name for mx_name in updates if mx_name not in patched]
+        if not remaining:
+            logger.info(f"Đã ghi {len(patched)} măng xông vào file Excel trong một lần lưu")
+            return len(patched)
+
+        with METRICS.timer('mx_workbook_io_seconds', op='load_workbook'):
+            wb = openpyxl.load_workbook(MAIN_EXCEL_FILE)
+        written = len(patched)
+        for mx_name in remaining:
+            mx_data = get_store().get(mx_name)
+            if not mx_data:
+                continue
+
+            if mx_name in wb.sheetnames:
+                _write_connection_cells(wb[mx_name], mx_data['connections'], get_fiber_count(mx_data))
+            else:
+                ws = wb.create_sheet(title=mx_name)
+                _write_mx_sheet(
+                    ws,
+                    mx_name,
+                    mx_data['location']['lat'],
+                    mx_data['location']['long'],
+                    mx_data['connections'],
+                    get_fiber_count(mx_data)
+                )
+            written += 1
+
+        with METRICS.timer('mx_workbook_io_seconds', op='save'):
+            wb.save(MAIN_EXCEL_FILE)
+        logger.info(f"Đã ghi {written} măng xông vào file Excel trong một lần lưu")
+        return written
+
+
+# Nạp lại mạng măng xông từ file Excel khi khởi động (0 để tắt)
+WORKBOOK_LOAD_ON_START = os.getenv('WORKBOOK_LOAD_ON_START', '1') != '0'
+# Số tiến trình đọc sheet song song; file ít sheet được đọc ngay trong tiến trình chính
+WORKBOOK_LOAD_WORKERS = max(1, int(os.getenv('WORKBOOK_LOAD_WORKERS', str(min(4, os.cpu_count() or 1)))))
+WORKBOOK_LOAD_PARALLEL_MIN_SHEETS = 200
+
+
+# Ô cần đọc trong sheet măng xông: cột B (tên, vị trí), E (đầu vào) và F (đầu ra)
+_MX_SHEET_CELL = re.compile(rb'<c\b([^>]*?\br="([BEF])(\d+)"[^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+_XLSX_CELL_TYPE = re.compile(rb'\bt="(\w+)"')
+_XLSX_CELL_VALUE = re.compile(rb'<v>([^<]*)</v>')
+_XLSX_CELL_TEXT = re.compile(rb'<t\b[^>]*>([^<]*)</t>')
+_MX_SHEET_COLUMNS = {b'B': 1, b'E': 4, b'F': 5}
+
+
+def _scan_mx_sheet(xml, shared_strings):
+    """Đọc nhanh các ô B, E, F trong XML của sheet măng xông -> (số dòng, danh sách ô) theo thứ tự dòng
+
+    Chỉ quét các ô cần dùng bằng biểu thức chính quy, nhanh hơn nhiều so với
+    dựng cây XML cho mỗi sheet khi file có hàng nghìn sheet.
+    """
+    row_number = None
+    values = None
+    for match in _MX_SHEET_CELL.finditer(xml):
+        attributes, column, row, content = match.groups()
+        row = int(row)
+        if row != row_number:
+            if values is not None:
+                yield row_number, values
+            row_number = row
+            values = [None] * 6
+
+        content = content or b''
+        cell_type = _XLSX_CELL_TYPE.search(attributes)
+        cell_type = cell_type.group(1) if cell_type else b'n'
+        if cell_type == b'inlineStr':
+            value = html.unescape(b''.join(_XLSX_CELL_TEXT.findall(content)).decode('utf-8'))
+        else:
+            value = _XLSX_CELL_VALUE.search(content)
+            value = html.unescape(value.group(1).decode('utf-8')) if value else None
+            if value is not None and cell_type == b's':
+                value = shared_strings[int(value)]
+        values[_MX_SHEET_COLUMNS[column]] = value
+    if values is not None:
+        yield row_number, values
+
+
+def _parse_mx_sheet(title, rows):
+    """Đọc một sheet măng xông -> (tên, lat, long, đấu nối, số sợi), ValueError nếu sai định dạng
+
+    Bố cục như _write_mx_sheet: B1 tên, B2 lat, B3 long, dòng 4 tiêu đề,
+    từ dòng 5 mỗi dòng một sợi với đầu vào ở cột E và đầu ra ở cột F.
+    """
+    info = {}
+    connections = {}
+    for row_number, values in rows:
+        if row_number <= 3:
+            info[row_number] = values[1] if len(values) > 1 else None
+            continue
+        if row_number == 4 or not any(values):
+            continue
+        try:
+            input_fiber = int(float(values[4]))
+            output_fiber = int(float(values[5]))
+        except (IndexError, TypeError, ValueError):
+            raise ValueError(f"dòng {row_number}: đầu vào/đầu ra không phải số")
+        if input_fiber in connections:
+            raise ValueError(f"dòng {row_number}: sợi {input_fiber} bị lặp")
+        connections[input_fiber] = output_fiber
+
+    mx_name = (info.get(1) or title).strip()
+    validate_mx_name(mx_name)
+    try:
+        lat = float(info.get(2))
+        long = float(info.get(3))
+    except (TypeError, ValueError):
+        raise ValueError("thiếu hoặc sai vị trí (B2, B3)")
+    if not (-90 <= lat <= 90 and -180 <= long <= 180):
+        raise ValueError(f"vị trí {lat},{long} nằm ngoài phạm vi")
+
+    fiber_count = len(connections)
+    if fiber_count not in CABLE_PROFILES:
+        raise ValueError(f"có {fiber_count} sợi, không phải loại cáp được hỗ trợ")
+    if set(connections) != set(range(1, fiber_count + 1)):
+        raise ValueError(f"đầu vào phải là các sợi 1-{fiber_count}")
+    if set(connections.values()) != set(range(1, fiber_count + 1)):
+        raise ValueError(f"đầu ra phải là các sợi 1-{fiber_count}, mỗi sợi một lần")
+    return mx_name, lat, long, connections, fiber_count
+
+
+def _load_workbook_sheets(filename, sheets):
+    """Đọc một nhóm sheet [(tên sheet, phần XML)], chạy được trong tiến trình con
+
+    Trả về [(tên sheet, măng xông hoặc None, lỗi hoặc None)].
+    """
+    results = []
+    with zipfile.ZipFile(filename) as zin:
+        shared_strings = _xlsx_shared_strings(zin)
+        for title, part in sheets:
+            try:
+                rows = _scan_mx_sheet(zin.read(part), shared_strings)
+                results.append((title, _parse_mx_sheet(title, rows), None))
+            except Exception as e:
+                results.append((title, None, str(e)))
+    return results
+
+
+def load_network_from_workbook(filename=None, workers=None, skip=()):
+    """Đọc các sheet măng xông của file Excel -> (danh sách măng xông, [(tên sheet, lỗi)])
+
+    Bỏ qua các sheet có tên trong skip.
+
+    Chỉ đọc XML của từng sheet (không dựng workbook openpyxl), chia thành
+    nhiều nhóm cho các tiến trình con khi file có nhiều sheet.
+    """
+    filename = filename or MAIN_EXCEL_FILE
+    workers = workers or WORKBOOK_LOAD_WORKERS
+    with zipfile.ZipFile(filename) as zin:
+        sheets = [(title, part) for title, part in _xlsx_sheet_parts(zin).items() if title not in skip]
+
+    if workers <= 1 or len(sheets) < WORKBOOK_LOAD_PARALLEL_MIN_SHEETS:
+        results = _load_workbook_sheets(filename, sheets)
+    else:
+        # Chia nhỏ hơn số tiến trình để các tiến trình xong gần như cùng lúc
+        chunk_size = math.ceil(len(sheets) / (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_load_workbook_sheets, filename, sheets[start:start + chunk_size])
+                for start in range(0, len(sheets), chunk_size)
+            ]
+            results = [result for future in futures for result in future.result()]
+
+    closures = []
+    errors = []
+    names = set()
+    for title, closure, error in results:
+        if error:
+            errors.append((title, error))
+        elif closure[0] in names:
+            errors.append((title, f"trùng tên măng xông {closure[0]}"))
+        else:
+            names.add(closure[0])
+            closures.append(closure)
+    return closures, errors
+
+
+def restore_network_from_workbook(filename=None):
+    """Đưa vào kho các măng xông có trong file Excel, trả về (số măng xông đã nạp, lỗi)
+
+    Kho SQLite là nguồn chính nên chỉ bổ sung măng xông còn thiếu; kho bộ
+    nhớ không bền vững nên đấu nối trong file Excel được ưu tiên.
+    """
+    filename = filename or MAIN_EXCEL_FILE
+    if not os.path.exists(filename):
+        return 0, []
+
+    started = time.perf_counter()
+    store = get_store()
+    # Sheet mang tên măng xông đã có trong kho SQLite thì không cần đọc
+    skip = {mx_name for mx_name, _ in store.items()} if isinstance(store, SQLiteStore) else ()
+    closures, errors = load_network_from_workbook(filename, skip=skip)
+
+    missing = [closure for closure in closures if closure[0] not in store]
+    if missing and not import_closures(missing):
+        raise ValueError(f"Không ghi được các măng xông từ {filename} vào kho")
+    restored = len(missing)
+    if not isinstance(store, SQLiteStore):
+        missing_names = {closure[0] for closure in missing}
+        for mx_name, _, _, connections, fiber_count in closures:
+            mx_data = store.get(mx_name)
+            if mx_name in missing_names or get_fiber_count(mx_data) != fiber_count:
+                continue
+            if dict(mx_data['connections'].items()) != connections and update_mx_connections(mx_name, connections):
+                restored += 1
+
+    for title, error in errors:
+        logger.warning(f"Bỏ qua sheet '{title}' sai định dạng trong {filename}: {error}")
+    if errors:
+        METRICS.inc('mx_workbook_malformed_sheets_total', len(errors))
+    logger.info(
+        f"Đã đọc {len(closures)} sheet từ {filename} trong {time.perf_counter() - started:.2f}s: "
+        f"nạp {restored} măng xông, {len(errors)} sheet lỗi"
+    )
+    return restored, errors
+
+
+# Thời gian chờ yên lặng và thời gian trễ tối đa (giây) trước khi ghi gộp vào file Excel
+WORKBOOK_FLUSH_QUIET = float(os.getenv('WORKBOOK_FLUSH_QUIET', '2'))
+WORKBOOK_FLUSH_MAX_DELAY = float(os.getenv('WORKBOOK_FLUSH_MAX_DELAY', '10'))
+
+
+class WorkbookFlusher:
+    """Gom các măng xông đã thay đổi và ghi vào file Excel trong một lần lưu
+
+    Lần ghi diễn ra khi không có thay đổi mới trong quiet_delay giây, hoặc
+    muộn nhất max_delay giây sau thay đổi đầu tiên chưa được ghi.
+    """
+
+    def __init__(self, quiet_delay=WORKBOOK_FLUSH_QUIET, max_delay=WORKBOOK_FLUSH_MAX_DELAY):
+        self.quiet_delay = quiet_delay
+        self.max_delay = max_delay
+        self._dirty = set()
+        self._first_dirty_at = None
+        self._last_dirty_at = None
+        self._task = None
+        self._flushing = asyncio.Lock()
+
+    @property
+    def queue_depth(self):
+        """Số măng xông đang chờ ghi vào file Excel"""
+        return len(self._dirty)
+
+    def mark_dirty(self, mx_name):
+        """Đánh dấu măng xông cần ghi vào file Excel"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._dirty.add(mx_name)
+        if self._first_dirty_at is None:
+            self._first_dirty_at = now
+        self._last_dirty_at = now
+        logger.info(f"Đã xếp {mx_name} vào hàng đợi ghi Excel (đang chờ: {self.queue_depth})")
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        """Chờ hết khoảng yên lặng hoặc thời gian trễ tối đa rồi ghi"""
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            deadline = min(self._last_dirty_at + self.quiet_delay, self._first_dirty_at + self.max_delay)
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self.flush()
+
+    async def flush(self):
+        """Ghi ngay mọi măng xông đang chờ trong một lần lưu"""
+        async with self._flushing:
+            if not self._dirty:
+                return 0
+
+            mx_names = sorted(self._dirty)
+            self._dirty = set()
+            self._first_dirty_at = None
+            self._last_dirty_at = None
+            version = DATA_VERSION
+
+            # Nhiều worker: chỉ worker giữ quyền ghi file chung, nó nhận các thay đổi này qua nhật ký
+            if not is_workbook_exporter():
+                return 0
+
+            try:
+                written = await run_workbook_job(flush_closures_to_excel, mx_names)
+            except Exception as e:
+                logger.error(f"Error flushing {len(mx_names)} closures to Excel: {e}")
+                # Đưa lại vào hàng đợi để thử lần sau
+                now = asyncio.get_running_loop().time()
+                self._dirty.update(mx_names)
+                self._first_dirty_at = self._first_dirty_at or now
+                self._last_dirty_at = now
+                return 0
+
+            # File vừa ghi vẫn khớp với file /download đã lưu nếu dữ liệu không đổi trong lúc ghi
+            if _DOWNLOAD_CACHE['version'] == version == DATA_VERSION and _DOWNLOAD_CACHE['path']:
+                _DOWNLOAD_CACHE['mtime'] = os.path.getmtime(_DOWNLOAD_CACHE['path'])
+            return written
+
+    async def close(self):
+        """Dừng bộ hẹn giờ và ghi nốt các thay đổi còn lại"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
+
+
+WORKBOOK_FLUSHER = WorkbookFlusher()
+
+
 # Thêm hàm xử lý lệnh sửa măng xông
+@instrument_handler
+async def import_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý lệnh nhập hàng loạt măng xông từ file"""
+    try:
+        user = update.effective_user
+
+        # Kiểm tra quyền
+        if not await check_permission_async(user.username, 'write'):
+            await update.message.reply_text(
+                "Bạn không có quyền thêm măng xông mới. "
+                "Liên hệ quản trị viên để được cấp quyền."
+            )
+            return ConversationHandler.END
+
+        await update.message.reply_text(
+            "Vui lòng gửi file CSV hoặc Excel (.xlsx), mỗi dòng là một cặp đấu nối với các cột:\n\n"
+            "TenMX, Lat, Long, SoSoi, DauVao, DauRa\n\n"
+            "Các dòng cùng TenMX thuộc một măng xông; Lat, Long, SoSoi chỉ cần ở dòng đầu tiên "
+            f"(SoSoi mặc định {DEFAULT_FIBER_COUNT}). Mỗi măng xông phải có đủ dòng cho mọi sợi đầu vào.\n"
+            "Măng xông có lỗi sẽ bị bỏ qua, các măng xông hợp lệ được lưu cùng lúc.\n"
+            "Gõ /cancel để hủy."
+        )
+        return IMPORT_MX
+    except Exception as e:
+        logger.error(f"Error in import_mx command: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi xử lý lệnh /importmx.")
+        return ConversationHandler.END
+
+
+@instrument_handler
+async def handle_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xử lý file nhập hàng loạt: kiểm tra toàn bộ rồi lưu một lần"""
+    try:
+        document = update.message.document
+        if document is None:
+            await update.message.reply_text("Vui lòng gửi file CSV hoặc .xlsx, hoặc gõ /cancel để hủy.")
+            return IMPORT_MX
+
+        filename = document.file_name or 'import.csv'
+        if not filename.lower().endswith(IMPORT_EXTENSIONS):
+            await update.message.reply_text("Chỉ hỗ trợ file .csv hoặc .xlsx. Vui lòng gửi lại.")
+            return IMPORT_MX
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await update.message.reply_text(
+                f"File quá lớn (tối đa {IMPORT_MAX_BYTES // (1024 * 1024)} MB). Vui lòng chia nhỏ file."
+            )
+            return IMPORT_MX
+
+        telegram_file = await document.get_file()
+        data = bytes(await telegram_file.download_as_bytearray())
+
+        # Đọc và kiểm tra file trong thread pool để không chặn event loop
+        closures, errors = await run_workbook_job(parse_import_document, filename, data)
+        if not await import_closures_async(closures, journal_user(update)):
+            await update.message.reply_text(
+                "Dữ liệu đã thay đổi trong lúc kiểm tra file (có măng xông vừa được thêm). "
+                "Vui lòng gửi lại file."
+            )
+            return IMPORT_MX
+
+        for mx_name, *_ in closures:
+            WORKBOOK_FLUSHER.mark_dirty(mx_name)
+
+        message, full_report = format_import_report(filename, closures, errors)
+        await update.message.reply_text(message)
+        if full_report:
+            await update.message.reply_document(
+                document=full_report.encode('utf-8'),
+                filename='loi_nhap_mx.txt',
+                caption="Danh sách đầy đủ các dòng lỗi"
+            )
+        logger.info(f"Nhập hàng loạt {filename}: {len(closures)} măng xông, {len(errors)} lỗi")
+    except Exception as e:
+        logger.error(f"Error in handle_import_document: {e}")
+        if update.message:
+            await update.message.reply_text("Có lỗi xảy ra khi nhập file. Vui lòng kiểm tra định dạng file.")
+
+    return ConversationHandler.END
+
+
+@instrument_handler
 async def edit_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh sửa đấu nối măng xông"""
     try:
         user = update.effective_user
 
         # Kiểm tra quyền
-        if not check_permission(user.username, 'write'):
+        if not await check_permission_async(user.username, 'write'):
             await update.message.reply_text(
                 "Bạn không có quyền sửa măng xông. "
                 "Liên hệ quản trị viên để được cấp quyền."
@@ -781,37 +4324,37 @@ async def edit_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Thêm hàm xử lý tên măng xông cần sửa
+@instrument_handler
 async def handle_edit_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý tên măng xông cần sửa"""
     try:
-        mx_name = update.message.text.upper()
+        mx_name, suggestions = resolve_mx_name(update.message.text)
+        mx_data = get_store().get(mx_name) if mx_name else None
 
-        if mx_name not in CONNECTIONS:
-            await update.message.reply_text(
-                f"Không tìm thấy măng xông {mx_name} trong hệ thống."
-            )
-            return ConversationHandler.END
+        if not mx_data:
+            await update.message.reply_text(format_name_suggestions(update.message.text, suggestions))
+            return EDIT_MX if suggestions else ConversationHandler.END
 
-        # Lưu tên măng xông vào context
-        context.user_data['editing_mx'] = mx_name
-        context.user_data['original_connections'] = CONNECTIONS[mx_name]['connections'].copy()
+        # Mở phiên sửa riêng: mọi thay đổi nằm trong bản nháp cho tới khi 'done'
+        context.user_data['edit_session'] = EditSession(mx_name, mx_data)
 
-        # Hiển thị thông tin hiện tại và hướng dẫn
-        message = (
-            f"Thông tin đấu nối hiện tại của măng xông {mx_name}:\n\n"
-            "Sợi | Đầu vào -> Đầu ra | Ghi chú\n"
-            "---------------------------\n"
-        )
-
-        connections = CONNECTIONS[mx_name]['connections']
-        for input_fiber, output_fiber in connections.items():
-            note = "Thẳng" if input_fiber == output_fiber else "Chéo"
-            color_name, _ = FIBER_COLORS[input_fiber]
-            message += f"{input_fiber:2} ({color_name:10}) -> {output_fiber:2} | {note}\n"
+        # Hiển thị thông tin hiện tại (cáp lớn gửi từng trang) và hướng dẫn
+        table, page_count = render_splice_table(mx_name)
+        if page_count > 1:
+            for page in range(1, page_count + 1):
+                await update.message.reply_text(
+                    f"Thông tin đấu nối hiện tại của măng xông {mx_name} (trang {page}/{page_count}):\n\n"
+                    f"{render_splice_table(mx_name, page)[0]}"
+                )
+            message = ""
+        else:
+            message = f"Thông tin đấu nối hiện tại của măng xông {mx_name}:\n\n{table}"
 
         message += (
             "\nVui lòng nhập cặp đấu nối cần sửa theo định dạng:\n"
             "ĐầuVào:ĐầuRa (ví dụ: 1:2 để đổi đầu ra của sợi 1 thành 2)\n"
+            "Có thể nhập nhiều cặp trong một tin nhắn (mỗi dòng hoặc cách nhau bởi dấu phẩy), "
+            "dãy sợi 1-12:13-24, hoặc mẫu straight / pairswap (ví dụ: pairswap 1-12).\n"
             "Nhập 'done' để kết thúc hoặc 'cancel' để hủy"
         )
 
@@ -825,95 +4368,112 @@ async def handle_edit_mx(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Thêm hàm xử lý sửa đấu nối
+@instrument_handler
 async def handle_edit_mx_connection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý thay đổi đấu nối của măng xông"""
     try:
         text = update.message.text.strip().lower()
-        mx_name = context.user_data['editing_mx']
-        connections = CONNECTIONS[mx_name]['connections'].copy()
+        session = context.user_data['edit_session']
+        mx_name = session.mx_name
+        fiber_count = session.fiber_count
+        connections = session.draft
+
+        pairs_text, done = split_done_token(text)
+        if pairs_text and text != 'cancel':
+            # Một tin nhắn có thể chứa nhiều cặp, dãy sợi hoặc mẫu; chỉ áp dụng khi tất cả hợp lệ
+            try:
+                pairs = parse_connection_spec(pairs_text, fiber_count)
+            except ValueError as e:
+                await update.message.reply_text(
+                    f"{e}. Vui lòng nhập lại theo định dạng: ĐầuVào:ĐầuRa (ví dụ: 1:2, 1-12:13-24 hoặc pairswap)")
+                return EDIT_MX_CONNECTION
 
-        if text == 'done':
-            # Cập nhật đấu nối mới vào hệ thống
-            success = update_mx_connections(mx_name, connections)
+            connections, swapped, errors = apply_edit_pairs(connections, pairs)
+            if errors:
+                await update.message.reply_text(
+                    "Không áp dụng thay đổi nào trong tin nhắn này:\n"
+                    + "\n".join(f"❌ {error}" for error in errors[:20])
+                    + (f"\n... và {len(errors) - 20} lỗi khác" if len(errors) > 20 else "")
+                    + "\n\nVui lòng nhập lại."
+                )
+                return EDIT_MX_CONNECTION
+
+            session.apply(connections, pairs, swapped)  # Chỉ sửa bản nháp của phiên, chưa ghi vào kho
+
+            # Hiển thị thông tin cập nhật
+            table = get_fiber_table(fiber_count)
+            lines = []
+            for input_fiber, output_fiber in pairs[:20]:
+                note = "Thẳng" if input_fiber == output_fiber else "Chéo"
+                lines.append(f"{input_fiber} ({table[input_fiber][0]}) -> {output_fiber} | {note}")
+            if len(pairs) > 20:
+                lines.append(f"... và {len(pairs) - 20} cặp khác")
+            message = f"Đã cập nhật {len(pairs)} cặp đấu nối:\n" + "\n".join(lines) + "\n"
+            for other_input, new_output in sorted(swapped.items())[:20]:
+                message += f"Sợi {other_input} được hoán đổi sang đầu ra {new_output}.\n"
+            if len(swapped) > 20:
+                message += f"... và {len(swapped) - 20} sợi khác được hoán đổi.\n"
+
+            if not done:
+                await update.message.reply_text(
+                    message + "\nTiếp tục nhập cặp đấu nối khác cần sửa hoặc nhập 'done' để kết thúc."
+                )
+                return EDIT_MX_CONNECTION
+            await update.message.reply_text(message)
 
-            if success:
-                # Cập nhật file Excel
-                update_excel_connections(mx_name, connections)
+        if done:
+            # Ghi bản nháp bằng compare-and-swap theo phiên bản lúc bắt đầu sửa
+            success, clashes, merged_swaps = commit_edit_session(session, journal_user(update))
 
+            if success:
+                # Cập nhật file Excel (ghi gộp sau)
+                WORKBOOK_FLUSHER.mark_dirty(mx_name)
+
+                message = f"Đã cập nhật thành công đấu nối cho măng xông {mx_name}.\n"
+                if merged_swaps:
+                    # Đã gộp với thay đổi của người khác: báo lại các sợi đổi do hoán đổi tự động
+                    message += (
+                        "Măng xông vừa được người khác sửa các sợi khác, thay đổi của bạn đã được gộp. "
+                        "Các sợi được hoán đổi tự động cũng đã được ghi:\n"
+                        + "\n".join(f"Sợi {fiber} -> {output or 'chưa đấu'}"
+                                    + (f" (do sửa sợi {cause})" if cause else "")
+                                    for fiber, output, cause in merged_swaps[:20])
+                        + "\n"
+                    )
+                await update.message.reply_text(message + "Bạn có thể tải file Excel mới nhất bằng lệnh /download.")
+            elif clashes:
+                # Người khác đã sửa cùng sợi: bắt đầu lại từ dữ liệu mới nhất
+                session.rebase(get_store().get(mx_name))
+                lines = [
+                    f"Sợi {fiber}{f' (tự hoán đổi khi bạn sửa sợi {cause})' if cause else ''}: "
+                    f"bạn sửa thành {mine or 'chưa đấu'}, hiện tại là {theirs or 'chưa đấu'}"
+                    for fiber, mine, theirs, cause in clashes[:20]
+                ]
+                if len(clashes) > 20:
+                    lines.append(f"... và {len(clashes) - 20} sợi khác")
                 await update.message.reply_text(
-                    f"Đã cập nhật thành công đấu nối cho măng xông {mx_name}.\n"
-                    "Bạn có thể tải file Excel mới nhất bằng lệnh /download."
+                    f"Măng xông {mx_name} vừa được người khác sửa, thay đổi của bạn chưa được lưu.\n"
+                    "Các sợi bị xung đột:\n" + "\n".join(lines) + "\n\n"
+                    "Phiên sửa đã được cập nhật theo dữ liệu mới nhất. "
+                    "Vui lòng nhập lại các cặp cần sửa, 'done' để kết thúc hoặc 'cancel' để hủy."
                 )
+                return EDIT_MX_CONNECTION
             else:
                 await update.message.reply_text("Có lỗi xảy ra khi cập nhật đấu nối.")
 
             # Xóa dữ liệu tạm
-            if 'editing_mx' in context.user_data:
-                del context.user_data['editing_mx']
-            if 'original_connections' in context.user_data:
-                del context.user_data['original_connections']
-
+            context.user_data.pop('edit_session', None)
             return ConversationHandler.END
 
         if text == 'cancel':
-            # Khôi phục lại đấu nối ban đầu nếu có
-            if 'original_connections' in context.user_data:
-                CONNECTIONS[mx_name]['connections'] = context.user_data['original_connections']
-
-            # Xóa dữ liệu tạm
-            if 'editing_mx' in context.user_data:
-                del context.user_data['editing_mx']
-            if 'original_connections' in context.user_data:
-                del context.user_data['original_connections']
-
+            # Bản nháp chưa từng được ghi nên chỉ cần bỏ phiên sửa
+            context.user_data.pop('edit_session', None)
             await update.message.reply_text("Đã hủy thao tác sửa đấu nối.")
             return ConversationHandler.END
 
-        # Xử lý cặp đấu nối
-        if ':' not in text:
-            await update.message.reply_text(
-                "Định dạng không đúng. Vui lòng nhập theo định dạng: ĐầuVào:ĐầuRa (ví dụ: 1:2)")
-            return EDIT_MX_CONNECTION
-
-        try:
-            input_fiber, output_fiber = map(int, text.split(':'))
-            if not (1 <= input_fiber <= 24 and 1 <= output_fiber <= 24):
-                raise ValueError
-        except ValueError:
-            await update.message.reply_text("Số sợi phải từ 1 đến 24. Vui lòng nhập lại.")
-            return EDIT_MX_CONNECTION
-
-        # Kiểm tra xem sợi đầu vào có tồn tại không
-        if input_fiber not in connections:
-            await update.message.reply_text(
-                f"Sợi đầu vào {input_fiber} không tồn tại trong măng xông {mx_name}. Vui lòng nhập lại.")
-            return EDIT_MX_CONNECTION
-
-        # Kiểm tra xem sợi đầu ra đã được sử dụng bởi sợi khác chưa (trừ trường hợp đấu thẳng)
-        if output_fiber in connections.values() and input_fiber != output_fiber:
-            # Tìm sợi đầu vào nào đang sử dụng đầu ra này
-            conflicting_input = next(
-                (in_fib for in_fib, out_fib in connections.items() if out_fib == output_fiber),
-                None
-            )
-            await update.message.reply_text(
-                f"Sợi đầu ra {output_fiber} đã được sử dụng bởi sợi đầu vào {conflicting_input}. "
-                "Vui lòng nhập lại."
-            )
-            return EDIT_MX_CONNECTION
-
-        # Cập nhật đấu nối
-        connections[input_fiber] = output_fiber
-        CONNECTIONS[mx_name]['connections'] = connections  # Cập nhật tạm thời
-
-        # Hiển thị thông tin cập nhật
-        note = "Thẳng" if input_fiber == output_fiber else "Chéo"
-        color_name, _ = FIBER_COLORS[input_fiber]
-
         await update.message.reply_text(
-            f"Đã cập nhật: {input_fiber} ({color_name}) -> {output_fiber} | {note}\n\n"
-            "Tiếp tục nhập cặp đấu nối khác cần sửa hoặc nhập 'done' để kết thúc."
-        )
+            "Vui lòng nhập cặp đấu nối cần sửa (ví dụ: 1:2, 1-12:13-24 hoặc pairswap), "
+            "'done' để kết thúc hoặc 'cancel' để hủy.")
         return EDIT_MX_CONNECTION
     except Exception as e:
         logger.error(f"Error in handle_edit_mx_connection: {e}")
@@ -921,30 +4481,54 @@ async def handle_edit_mx_connection(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text("Có lỗi xảy ra khi xử lý yêu cầu sửa đấu nối.")
         return ConversationHandler.END
 
+@instrument_handler
 async def download(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xử lý lệnh tải file Excel"""
     try:
-        filename = create_excel_file(MAIN_EXCEL_FILE)  # Đã chuyển thành synchronous function
+        cached = get_cached_download()
+        count_cache('download', cached is not None)
+        if cached and cached['file_id']:
+            # Dữ liệu chưa đổi: gửi lại file Telegram đã lưu, không tạo và tải lên lại
+            try:
+                await update.message.reply_document(
+                    document=cached['file_id'],
+                    caption=f"File Excel tổng hợp thông tin măng xông cáp quang\nĐường dẫn: {cached['path']}"
+                )
+                logger.info(f"Đã gửi lại file từ bộ nhớ đệm (phiên bản {cached['version']})")
+                return
+            except Exception as e:
+                logger.warning(f"Không dùng lại được file_id đã lưu, tải lên lại: {e}")
+                cached['file_id'] = None
+
+        if cached:
+            filename = cached['path']
+            version = cached['version']
+        else:
+            version = DATA_VERSION
+            filename = await create_excel_file_async(workbook_download_path())
+            remember_download(version, os.path.abspath(filename))
         abs_path = os.path.abspath(filename)
 
         logger.info(f"Đang chuẩn bị tải file từ: {abs_path}")
-        print(f"Đang chuẩn bị tải file từ: {abs_path}")
 
         with open(filename, 'rb') as file:
-            await update.message.reply_document(
+            sent = await update.message.reply_document(
                 document=file,
                 caption=f"File Excel tổng hợp thông tin măng xông cáp quang\nĐường dẫn: {abs_path}"
             )
 
+        # Lưu file_id để lần sau gửi lại mà không cần tải lên
+        if sent and sent.document and _DOWNLOAD_CACHE['version'] == version:
+            _DOWNLOAD_CACHE['file_id'] = sent.document.file_id
+
         logger.info(f"Đã gửi file thành công từ: {abs_path}")
-        print(f"Đã gửi file thành công từ: {abs_path}")
     except Exception as e:
         error_msg = f"Error generating Excel file: {e}"
         logger.error(error_msg)
-        print(error_msg)
         await update.message.reply_text("Có lỗi xảy ra khi tạo file Excel. Vui lòng thử lại sau.")
 
 
+@instrument_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Hủy bỏ conversation hiện tại"""
     try:
@@ -953,6 +4537,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             del context.user_data['new_mx']
         if 'adding_mx' in context.user_data:
             del context.user_data['adding_mx']
+        context.user_data.pop('edit_session', None)
 
         await update.message.reply_text('Đã hủy thao tác hiện tại.')
     except Exception as e:
@@ -976,60 +4561,887 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in error_handler: {e}")
 
 
-def main():
-    """Khởi chạy bot"""
+class MetricsServer:
+    """Endpoint HTTP tối giản trả số đo theo định dạng Prometheus tại GET /metrics"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Endpoint số đo tại http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Bỏ qua phần header của request
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = METRICS.render_prometheus().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Lỗi khi phục vụ endpoint số đo: {e}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+METRICS_SERVER = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+
+
+async def on_startup(application: Application):
+    """Mở endpoint số đo (nếu bật) khi bot khởi động và ghi báo cáo thời gian khởi động"""
+    if METRICS_SERVER is not None:
+        await METRICS_SERVER.start()
+    record_startup_phase('kết nối Telegram')
+    logger.info(format_startup_report())
+
+
+async def on_shutdown(application: Application):
+    """Dọn dẹp khi bot dừng: ghi nốt file Excel và đợi các job workbook hoàn tất"""
+    if METRICS_SERVER is not None:
+        await METRICS_SERVER.close()
+    await WORKBOOK_FLUSHER.close()
+    await asyncio.get_running_loop().run_in_executor(None, shutdown_workbook_executor)
+    if CLUSTER is not None:
+        CLUSTER.release()
+    if JOURNAL is not None:
+        JOURNAL.close()
+    get_store().close()
+
+
+# Chế độ nhận update: 'polling' hoặc 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+# Cấu hình webhook: địa chỉ lắng nghe cục bộ và URL công khai Telegram gọi tới
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+# Số update được xử lý đồng thời (các cuộc hội thoại khác nhau)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+
+
+# Giới hạn gửi tin của Telegram: tin/giây và số tin gửi dồn tối đa, cho cả bot và từng chat
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+OUTBOUND_GLOBAL_BURST = int(os.getenv('OUTBOUND_GLOBAL_BURST', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Số lần gửi lại khi Telegram trả về RetryAfter
+OUTBOUND_MAX_RETRIES = 3
+# Độ ưu tiên gửi tin: số nhỏ được gửi trước
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PROGRESS = 1
+# rate_limit_args cho tin báo tiến độ: tin mới thay thế tin cùng loại còn đang chờ gửi trong chat
+PROGRESS_RATE_LIMIT = {'priority': PRIORITY_PROGRESS, 'merge_key': 'progress'}
+# Địa chỉ Bot API (vd. http://127.0.0.1:8081 để chạy thử với Bot API giả lập)
+TELEGRAM_API_ROOT = os.getenv('TELEGRAM_API_ROOT', '').rstrip('/')
+
+
+class TokenBucket:
+    """Token bucket: nạp rate token/giây, chứa tối đa capacity token"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Số giây phải chờ tới khi có một token"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Lấy một token"""
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _OutboundRequest:
+    __slots__ = ('priority', 'seq', 'chat_id', 'merge_key', 'callback', 'args', 'kwargs',
+                 'future', 'retries', 'merged')
+
+    def __init__(self, priority, seq, chat_id, merge_key, callback, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.merge_key = merge_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.retries = 0
+        self.merged = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def _settle_from(future, source):
+    """Đặt kết quả (hoặc lỗi, hủy) của source cho future"""
+    if future.done():
+        return
+    if source.cancelled():
+        future.cancel()
+    elif source.exception() is not None:
+        future.set_exception(source.exception())
+    else:
+        future.set_result(source.result())
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Hàng đợi gửi tin theo token bucket toàn bot và từng chat, có độ ưu tiên
+
+    Chỉ các lệnh gửi/sửa tin có chat_id đi qua hàng đợi; các lệnh khác gọi
+    thẳng. Tin có độ ưu tiên cao (trả lời người dùng) được gửi trước tin báo
+    tiến độ; cùng độ ưu tiên thì theo thứ tự gửi. Tin có merge_key thay thế
+    tin cùng merge_key trong cùng chat còn đang chờ, cả hai lời gọi nhận cùng
+    một kết quả. Khi Telegram trả về RetryAfter, cả hàng đợi tạm dừng rồi gửi lại.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, global_burst=OUTBOUND_GLOBAL_BURST,
+                 chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 max_retries=OUTBOUND_MAX_RETRIES, clock=time.monotonic):
+        self._clock = clock
+        self._global = TokenBucket(global_rate, global_burst, clock())
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}
+        self._max_retries = max_retries
+        self._pending = []
+        self._waiting_merge = {}
+        self._seq = 0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self._sending = set()
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+
+    @property
+    def queue_depth(self):
+        """Số tin đang chờ gửi"""
+        return len(self._pending)
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for request in self._pending:
+            if not request.future.done():
+                request.future.cancel()
+        self._pending = []
+        self._waiting_merge = {}
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None or not endpoint.startswith(('send', 'edit', 'copy', 'forward')):
+            return await callback(*args, **kwargs)
+        if self._task is None:
+            await self.initialize()
+
+        rate_limit_args = rate_limit_args or {}
+        merge_key = rate_limit_args.get('merge_key')
+        if merge_key is not None:
+            waiting = self._waiting_merge.get((chat_id, merge_key))
+            if waiting is not None:
+                # Tin cũ chưa gửi: gửi nội dung mới thay cho nó
+                waiting.args, waiting.kwargs = args, kwargs
+                waiting.merged += 1
+                self.merged += 1
+                return await asyncio.shield(waiting.future)
+
+        self._seq += 1
+        request = _OutboundRequest(
+            rate_limit_args.get('priority', PRIORITY_INTERACTIVE), self._seq, chat_id, merge_key,
+            callback, args, kwargs, asyncio.get_running_loop().create_future()
+        )
+        self._enqueue(request)
+        return await asyncio.shield(request.future)
+
+    def _enqueue(self, request):
+        bisect.insort(self._pending, request)
+        if request.merge_key is not None:
+            self._waiting_merge[(request.chat_id, request.merge_key)] = request
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1000:
+                # Bỏ bucket của các chat đã đầy token (không gửi gần đây)
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst, now)
+        return bucket
+
+    def _next_ready(self, now):
+        """Tin ưu tiên nhất có thể gửi ngay, hoặc (None, số giây cần chờ)"""
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        for index, request in enumerate(self._pending):
+            chat_wait = self._chat_bucket(request.chat_id, now).wait_time(now)
+            if chat_wait <= 0:
+                return self._pending.pop(index), 0.0
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    async def _dispatch(self):
+        """Vòng lặp lấy tin khỏi hàng đợi khi đủ token"""
+        while True:
+            now = self._clock()
+            request, wait = (None, self._paused_until - now) if self._paused_until > now \
+                else self._next_ready(now)
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take(now)
+            self._chat_bucket(request.chat_id, now).take(now)
+            if request.merge_key is not None:
+                self._waiting_merge.pop((request.chat_id, request.merge_key), None)
+            task = asyncio.get_running_loop().create_task(self._send(request))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, request):
+        try:
+            result = await request.callback(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            retry_after = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+            logger.warning(f"Telegram yêu cầu chờ {retry_after}s trước khi gửi tiếp (chat {request.chat_id})")
+            self._paused_until = max(self._paused_until, self._clock() + retry_after)
+            newer = self._waiting_merge.get((request.chat_id, request.merge_key)) \
+                if request.merge_key is not None else None
+            if newer is not None:
+                # Tin cùng loại mới hơn đang chờ: không gửi lại nội dung cũ, nhận kết quả của tin mới
+                newer.merged += 1
+                self.merged += 1
+                newer.future.add_done_callback(functools.partial(_settle_from, request.future))
+            elif request.retries < self._max_retries:
+                request.retries += 1
+                self.retried += 1
+                self._enqueue(request)
+            elif not request.future.done():
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+# Lưu trạng thái hội thoại và user_data để phiên /addmx, /editmx dang dở còn nguyên sau khi khởi động lại
+STATE_PERSISTENCE = os.getenv('MX_STATE_PERSISTENCE', '1') != '0'
+STATE_FILE = os.getenv('MX_STATE_FILE', 'mang_xong_state.db')
+# Chu kỳ (giây) ghi các thay đổi xuống đĩa
+STATE_FLUSH_INTERVAL = float(os.getenv('MX_STATE_FLUSH_INTERVAL', '5'))
+CONVERSATION_NAME = 'mx'
+
+
+class SQLitePersistence(BasePersistence):
+    """Lưu trạng thái ConversationHandler và user_data vào SQLite
+
+    Mỗi user và mỗi cuộc hội thoại là một dòng. Application chỉ gọi
+    update_* cho các user có update kể từ lần ghi trước, và dòng chỉ được
+    ghi lại khi nội dung (pickle) thực sự đổi, nên mỗi lần ghi chỉ chạm
+    tới các chat có thay đổi.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, key)
+        )""",
+    )
+
+    def __init__(self, path, update_interval=STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        # user_id -> bản pickle đã ghi, để bỏ qua các lần ghi không đổi gì
+        self._written = {}
+        # (tên, khóa) của các cuộc hội thoại đang dở, cho gauge mx_active_conversations
+        self._conversation_keys = set()
+
+    @property
+    def active_conversations(self):
+        """Số cuộc hội thoại đang dở theo lần ghi gần nhất"""
+        return len(self._conversation_keys)
+
+    def _write(self, statement, params, kind):
+        with self._conn:
+            self._conn.execute(statement, params)
+        METRICS.inc('mx_state_writes_total', kind=kind)
+
+    async def get_user_data(self):
+        started = time.perf_counter()
+        user_data = {}
+        for user_id, blob in self._conn.execute('SELECT user_id, data FROM user_data'):
+            try:
+                user_data[user_id] = pickle.loads(blob)
+            except Exception as e:
+                logger.warning(f"Bỏ qua user_data đã lưu của user {user_id}: {e}")
+                continue
+            self._written[user_id] = blob
+        logger.info(f"Đã nạp user_data của {len(user_data)} user trong {(time.perf_counter() - started) * 1000:.0f} ms")
+        return user_data
+
+    async def get_conversations(self, name):
+        conversations = {}
+        for key, state in self._conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)):
+            conversations[tuple(json.loads(key))] = state
+        self._conversation_keys.update((name, key) for key in conversations)
+        logger.info(f"Đã khôi phục {len(conversations)} cuộc hội thoại '{name}' đang dở")
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._write('DELETE FROM conversations WHERE name = ? AND key = ?',
+                        (name, json.dumps(list(key))), 'conversation')
+            self._conversation_keys.discard((name, tuple(key)))
+        else:
+            self._write('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                        (name, json.dumps(list(key)), new_state), 'conversation')
+            self._conversation_keys.add((name, tuple(key)))
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._written.get(user_id) == blob:
+            return
+        self._write('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)', (user_id, blob), 'user_data')
+        self._written[user_id] = blob
+
+    async def drop_user_data(self, user_id):
+        if self._written.pop(user_id, None) is not None:
+            self._write('DELETE FROM user_data WHERE user_id = ?', (user_id,), 'user_data')
+
+    async def refresh_user_data(self, user_id, user_data):
+        """user_data chỉ do tiến trình này sửa, không cần nạp lại"""
+
+    async def flush(self):
+        self._conn.close()
+
+    # chat_data, bot_data và callback_data không được dùng
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+# Số worker xử lý update dùng chung kho SQLite (1: chạy một tiến trình như trước)
+BOT_WORKERS = max(1, int(os.getenv('BOT_WORKERS', '1')))
+# Chu kỳ (giây) mỗi worker đọc nhật ký thay đổi của các worker khác
+CLUSTER_POLL_INTERVAL = float(os.getenv('CLUSTER_POLL_INTERVAL', '0.5'))
+# Thời hạn (giây) quyền ghi file Excel chung; worker giữ quyền dừng thì worker khác nhận sau thời hạn này
+EXPORTER_LEASE_TTL = float(os.getenv('EXPORTER_LEASE_TTL', '10'))
+EXPORTER_LEASE = 'workbook_exporter'
+# Số thay đổi giữ lại trong nhật ký (worker chậm hơn số này sẽ nạp lại toàn bộ)
+CHANGE_LOG_KEEP = 10000
+
+
+class ClusterSync:
+    """Đồng bộ một worker với các worker khác qua kho SQLite dùng chung
+
+    Mỗi vòng: gia hạn (hoặc giành) quyền ghi file Excel chung, rồi nạp lại
+    vào bộ nhớ đệm các măng xông mà worker khác vừa ghi theo nhật ký thay
+    đổi. Chỉ worker giữ quyền mới ghi MAIN_EXCEL_FILE, nên không có hai
+    tiến trình cùng lưu một file.
+    """
+
+    def __init__(self, store, worker_id):
+        self.store = store
+        self.worker_id = worker_id
+        self.is_exporter = False
+        self.last_seq = store.last_change()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def release(self):
+        """Trả quyền ghi file Excel để worker khác nhận ngay"""
+        if self.is_exporter:
+            self.store.release_lease(EXPORTER_LEASE, self.worker_id)
+            self.is_exporter = False
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Lỗi đồng bộ worker {self.worker_id}: {e}")
+            await asyncio.sleep(CLUSTER_POLL_INTERVAL)
+
+    async def poll(self):
+        """Một vòng đồng bộ với kho dùng chung"""
+        was_exporter = self.is_exporter
+        self.is_exporter = self.store.acquire_lease(EXPORTER_LEASE, self.worker_id, EXPORTER_LEASE_TTL)
+        if self.is_exporter and not was_exporter:
+            logger.info(f"Worker {self.worker_id} được chọn ghi file Excel chung")
+            # Worker giữ quyền trước có thể chưa kịp ghi hết: tạo lại toàn bộ file
+            await create_excel_file_async(MAIN_EXCEL_FILE)
+            self.store.prune_changes(CHANGE_LOG_KEEP)
+
+        changes = self.store.changes_since(self.last_seq)
+        if not changes:
+            return
+        if changes[0][0] > self.last_seq + 1 and self.last_seq:
+            # Nhật ký đã bị cắt bớt phần worker này chưa đọc
+            logger.warning(f"Worker {self.worker_id} chậm hơn nhật ký thay đổi, nạp lại toàn bộ kho")
+            self.store.load()
+            rebuild_indexes()
+            mark_data_changed()
+            names = set()
+        else:
+            names = {mx_name for _, mx_name, origin in changes if origin != self.worker_id}
+            if names:
+                self.apply(names)
+        self.last_seq = changes[-1][0]
+        METRICS.inc('mx_cluster_reloads_total', len(names))
+
+        if self.is_exporter:
+            for mx_name in names:
+                WORKBOOK_FLUSHER.mark_dirty(mx_name)
+            if self.last_seq % CHANGE_LOG_KEEP < len(changes):
+                self.store.prune_changes(CHANGE_LOG_KEEP)
+
+    def apply(self, names):
+        """Nạp lại các măng xông đã đổi và cập nhật chỉ mục, bộ nhớ đệm hiển thị"""
+        before = {mx_name: self.store.get(mx_name) for mx_name in names}
+        self.store.reload(names)
+        structural = False
+        for mx_name, old in before.items():
+            new = self.store.get(mx_name)
+            if old is None or new is None or old.get('next_mx') != new.get('next_mx'):
+                structural = True
+        if structural:
+            # Thêm măng xông hoặc đổi đoạn cáp: dựng lại chỉ mục tên, vị trí và đồ thị cáp
+            rebuild_indexes()
+            mark_data_changed()
+        else:
+            for mx_name in names:
+                mark_data_changed(mx_name)
+
+
+CLUSTER = None
+
+
+def is_workbook_exporter():
+    """Tiến trình này có được ghi file Excel chung không (luôn có khi chạy một tiến trình)"""
+    return CLUSTER is None or CLUSTER.is_exporter
+
+
+def workbook_download_path():
+    """File Excel tạo cho /download: worker không giữ quyền ghi file chung dùng file riêng"""
+    if is_workbook_exporter():
+        return MAIN_EXCEL_FILE
+    root, ext = os.path.splitext(MAIN_EXCEL_FILE)
+    return f"{root}.{CLUSTER.worker_id}{ext}"
+
+
+def _worker_for_update(update, workers):
+    """Worker xử lý update: chia theo user để user_data và hội thoại của một user luôn ở cùng worker"""
+    user = update.effective_user
+    chat = update.effective_chat
+    key = user.id if user else chat.id if chat else update.update_id
+    return key % workers
+
+
+def run_worker(worker_index, token, update_queue):
+    """Tiến trình worker: xử lý các update do tiến trình nhận update chuyển tới"""
+    global CLUSTER, METRICS_SERVER
+    worker_id = f"worker-{worker_index}-{os.getpid()}"
+    store = init_store('sqlite')
+    store.origin = worker_id
+    init_journal(store)
+    CLUSTER = ClusterSync(store, worker_id)
+    if METRICS_PORT:
+        # Mỗi worker một cổng số đo: METRICS_PORT + 1 + số thứ tự worker
+        METRICS_SERVER = MetricsServer(METRICS_LISTEN, METRICS_PORT + 1 + worker_index)
+
+    # Giới hạn tốc độ gửi chung của bot được chia đều cho các worker
+    application = build_application(token, global_rate=OUTBOUND_GLOBAL_RATE / BOT_WORKERS, updater=False)
+    logger.info(f"Worker {worker_id} sẵn sàng")
+    asyncio.run(_serve_worker(application, update_queue))
+
+
+async def _serve_worker(application, update_queue):
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    CLUSTER.start()
     try:
+        while True:
+            data = await loop.run_in_executor(None, update_queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await CLUSTER.stop()
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+
+def run_supervisor(token):
+    """Chạy BOT_WORKERS worker và nhận update ở tiến trình chính, chia cho các worker theo user"""
+    if STORE_BACKEND != 'sqlite':
+        raise ValueError("Chạy nhiều worker cần kho SQLite dùng chung (MX_STORE_BACKEND=sqlite)")
+
+    spawn = multiprocessing.get_context('spawn')
+    queues = [spawn.Queue() for _ in range(BOT_WORKERS)]
+    workers = [None] * BOT_WORKERS
+
+    def start_worker(index):
+        workers[index] = spawn.Process(target=run_worker, args=(index, token, queues[index]),
+                                       name=f"mx-worker-{index}")
+        workers[index].start()
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        index = _worker_for_update(update, BOT_WORKERS)
+        if not workers[index].is_alive():
+            logger.warning(f"Worker {index} đã dừng (mã {workers[index].exitcode}), khởi động lại")
+            start_worker(index)
+        queues[index].put(update.to_dict())
+
+    async def stop_workers(application: Application):
+        for update_queue in queues:
+            update_queue.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+            if worker.is_alive():
+                logger.warning(f"Worker {worker.name} không dừng kịp, buộc dừng")
+                worker.terminate()
+
+    # Các worker tự mở kho; tiến trình nhận update không giữ kết nối nào
+    get_store().close()
+    for index in range(BOT_WORKERS):
+        start_worker(index)
+    logger.info(f"Đã khởi động {BOT_WORKERS} worker dùng chung kho {STORE_FILE}")
+
+    builder = Application.builder().token(token).post_shutdown(stop_workers)
+    if TELEGRAM_API_ROOT:
+        builder = builder.base_url(f"{TELEGRAM_API_ROOT}/bot").base_file_url(f"{TELEGRAM_API_ROOT}/file/bot")
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, forward))
+    run_application(application)
+
+
+class PerConversationUpdateProcessor(BaseUpdateProcessor):
+    """Xử lý đồng thời update của các cuộc hội thoại khác nhau
+
+    Update của cùng một cuộc hội thoại (cùng chat và user, như khóa của
+    ConversationHandler) vẫn được xử lý tuần tự theo thứ tự nhận, nên các
+    state của ConversationHandler không bị chen ngang.
+
+    BaseUpdateProcessor.process_update giữ chỗ trong semaphore của nó trước
+    khi gọi do_process_update, nên một chat gửi dồn dập sẽ chiếm hết chỗ
+    trong lúc chờ khóa của chính nó. Vì vậy semaphore của lớp cha để không
+    giới hạn; giới hạn thật (limit) chỉ được giữ sau khi đã có khóa cuộc hội thoại.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates phải là số nguyên dương")
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+
+    @staticmethod
+    def conversation_key(update):
+        """Khóa cuộc hội thoại của update, None nếu update không thuộc chat/user nào"""
+        if not isinstance(update, Update):
+            return None
+        chat = update.effective_chat
+        user = update.effective_user
+        if chat is None and user is None:
+            return None
+        return (chat.id if chat else None, user.id if user else None)
+
+    async def do_process_update(self, update, coroutine):
+        key = self.conversation_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        # [khóa, số update đang chờ]: xóa khóa khi không còn update nào của cuộc hội thoại
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Khóa cuộc hội thoại trước, chỗ xử lý sau: update đang chờ lượt không giữ chỗ của chat khác
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        """Không cần khởi tạo tài nguyên"""
+
+    async def shutdown(self):
+        """Không cần giải phóng tài nguyên"""
+
+
+def build_application(token, global_rate=OUTBOUND_GLOBAL_RATE, updater=True):
+    """Tạo Application với đầy đủ handler, hàng đợi gửi tin và lưu trạng thái hội thoại
+
+    updater=False khi update được chuyển tới từ tiến trình khác (chế độ nhiều worker).
+    """
+    # Các cuộc hội thoại khác nhau chạy song song, cùng cuộc hội thoại vẫn tuần tự;
+    # tin gửi đi qua hàng đợi theo giới hạn tốc độ của Telegram
+    scheduler = OutboundScheduler(global_rate=global_rate)
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PerConversationUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(scheduler)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    persistence = None
+    if STATE_PERSISTENCE:
+        persistence = SQLitePersistence(STATE_FILE)
+        builder = builder.persistence(persistence)
+    if not updater:
+        builder = builder.updater(None)
+    if TELEGRAM_API_ROOT:
+        builder = builder.base_url(f"{TELEGRAM_API_ROOT}/bot").base_file_url(f"{TELEGRAM_API_ROOT}/file/bot")
+    application = builder.build()
+
+    # Tạo ConversationHandler cho các lệnh
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('findmx', find_mx),
+            CommandHandler('getmx', get_mx),
+            CommandHandler('addmx', add_mx),
+            CommandHandler('editmx', edit_mx),  # Thêm entry point mới
+            CommandHandler('nearmx', near_mx),
+            CommandHandler('importmx', import_mx)
+        ],
+        states={
+            FIND_MX: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_find_mx)],
+            GET_MX: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_get_mx)],
+            ADD_MX_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_mx_name)],
+            ADD_MX_CONNECTIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_mx_connections)],
+            EDIT_MX: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_mx)],
+            NEAR_MX: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.LOCATION, handle_near_mx)],
+            IMPORT_MX: [MessageHandler(filters.Document.ALL | (filters.TEXT & ~filters.COMMAND),
+                                       handle_import_document)],
+            EDIT_MX_CONNECTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_mx_connection)] # Thêm state mới
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        # Khôi phục cuộc hội thoại đang dở sau khi khởi động lại
+        name=CONVERSATION_NAME,
+        persistent=STATE_PERSISTENCE
+    )
+
+    # Đăng ký các handler
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("download", download))
+    application.add_handler(CommandHandler("trace", trace_mx))
+    application.add_handler(CommandHandler("linkmx", link_mx))
+    application.add_handler(CommandHandler("history", history_mx))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(conv_handler)
+
+    # Gauge được đọc khi xem /stats hoặc endpoint số đo
+    METRICS.gauge('mx_closures', lambda: len(get_store()))
+    if persistence is not None:
+        METRICS.gauge('mx_active_conversations', lambda: persistence.active_conversations)
+    METRICS.gauge('mx_outbound_queue_depth', lambda: scheduler.queue_depth)
+    METRICS.gauge('mx_render_cache_entries', lambda: len(_RENDER_CACHE))
+    METRICS.gauge('mx_workbook_pending_flush', lambda: WORKBOOK_FLUSHER.queue_depth)
+    METRICS.gauge('mx_startup_seconds', lambda: round(sum(seconds for _, seconds in STARTUP_PHASES), 3))
+
+    # Đăng ký error handler
+    application.add_error_handler(error_handler)
+    return application
+
+
+def run_application(application):
+    """Chạy bot theo BOT_MODE (polling hoặc webhook) cho tới khi dừng"""
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise ValueError("Chế độ webhook cần biến môi trường WEBHOOK_URL (URL công khai của bot)")
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info(f"Chạy webhook tại {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH} ({webhook_url})")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(100, MAX_CONCURRENT_UPDATES)
+        )
+    elif BOT_MODE == 'polling':
+        application.run_polling()
+    else:
+        raise ValueError(f"BOT_MODE không hợp lệ: {BOT_MODE} (polling hoặc webhook)")
+
+
+def main(argv=None):
+    """Khởi chạy bot, hoặc dựng lại file Excel của mạng tại một thời điểm (--as-of)"""
+    parser = argparse.ArgumentParser(description="Bot quản lý măng xông cáp quang")
+    parser.add_argument('--as-of', help="Dựng lại mạng tại thời điểm này từ nhật ký thay đổi "
+                                        "(ví dụ: '2024-05-01 08:30') và ghi ra file Excel thay vì chạy bot")
+    parser.add_argument('--output', help="File Excel ghi mạng dựng lại (mặc định mang_xong_<thời điểm>.xlsx)")
+    args = parser.parse_args(argv)
+    if args.as_of:
+        try:
+            as_of = parse_as_of(args.as_of)
+            output = args.output or f"mang_xong_{datetime.fromtimestamp(as_of).strftime('%Y%m%d_%H%M%S')}.xlsx"
+            rebuild_workbook_as_of(as_of, output)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    record_startup_phase('khởi tạo module')
+    try:
+        # Nạp mạng măng xông từ kho lưu trữ
+        init_store()
+        record_startup_phase('nạp kho lưu trữ')
+
+        # Bổ sung các măng xông chỉ có trong file Excel
+        if WORKBOOK_LOAD_ON_START:
+            restore_network_from_workbook(MAIN_EXCEL_FILE)
+            record_startup_phase('nạp file Excel')
+
+        # Nhật ký thay đổi: lần đầu chụp toàn bộ kho làm điểm bắt đầu
+        init_journal(get_store())
+
         # Tạo file Excel ban đầu nếu chưa có
         if not os.path.exists(MAIN_EXCEL_FILE):
             create_excel_file(MAIN_EXCEL_FILE)
+            record_startup_phase('tạo file Excel')
 
         # Tạo file phân quyền mẫu nếu chưa có
         if not os.path.exists(PERMISSION_FILE):
             permission_path = os.path.abspath(PERMISSION_FILE)
             logger.info(f"Đang tạo file phân quyền tại: {permission_path}")
-            print(f"Đang tạo file phân quyền tại: {permission_path}")
 
-            df = pd.DataFrame({'username': ['admin'], 'permission': ['write']})
-            df.to_excel(PERMISSION_FILE, index=False)
+            wb = openpyxl.Workbook(write_only=True)
+            ws = wb.create_sheet()
+            ws.append(['username', 'permission'])
+            ws.append(['admin', 'admin'])
+            wb.save(PERMISSION_FILE)
 
             logger.info(f"Đã tạo file phân quyền thành công tại: {permission_path}")
-            print(f"Đã tạo file phân quyền thành công tại: {permission_path}")
+            record_startup_phase('tạo file phân quyền')
 
         # Lấy token từ biến môi trường hoặc nhập trực tiếp
         TOKEN = os.getenv('TELEGRAM_BOT_TOKEN') or '6183270075:AAHgGhIT5mjREJjyneaY9oLyxYJjhsJn36A'
 
-        # Tạo application
-        application = Application.builder().token(TOKEN).build()
-
-        # Tạo ConversationHandler cho các lệnh
-        conv_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('findmx', find_mx),
-                CommandHandler('getmx', get_mx),
-                CommandHandler('addmx', add_mx),
-                CommandHandler('editmx', edit_mx)  # Thêm entry point mới
-            ],
-            states={
-                FIND_MX: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_find_mx)],
-                GET_MX: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_get_mx)],
-                ADD_MX_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_mx_name)],
-                ADD_MX_CONNECTIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_mx_connections)],
-                EDIT_MX_CONNECTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_mx_connection)] # Thêm state mới
-            },
-            fallbacks=[CommandHandler('cancel', cancel)]
-        )
-
-        # Đăng ký các handler
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("download", download))
-        application.add_handler(conv_handler)
+        # Nhiều worker: tiến trình này chỉ nhận update và chia cho các worker
+        if BOT_WORKERS > 1:
+            run_supervisor(TOKEN)
+            return
 
-        # Đăng ký error handler
-        application.add_error_handler(error_handler)
-
-        # Khởi động bot
-        application.run_polling()
+        # Tạo application
+        application = build_application(TOKEN)
+        record_startup_phase('tạo application')
+        run_application(application)
 
     except Exception as e:
         logger.critical(f"Fatal error in main: {e}", exc_info=True)
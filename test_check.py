@@ -0,0 +1,1061 @@
+"""Kiểm thử các phần của check.py không cần Telegram
+
+Chạy: python -m unittest test_check
+"""
+import os
+import json
+import shutil
+import random
+import zipfile
+import tempfile
+import threading
+import asyncio
+import unittest
+from unittest import mock
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import check
+from telegram import Update
+
+
+def make_update(update_id, chat_id, text='x'):
+    """Update tin nhắn văn bản tối thiểu của một chat riêng"""
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'test'},
+        },
+    }, None)
+
+
+def build_network(size, fiber_count=check.DEFAULT_FIBER_COUNT, seed=1):
+    """Nạp vào kho bộ nhớ size măng xông với đấu nối ngẫu nhiên"""
+    rng = random.Random(seed)
+    check.CONNECTIONS.clear()
+    for index in range(size):
+        outputs = list(range(1, fiber_count + 1))
+        rng.shuffle(outputs)
+        check.CONNECTIONS[f"MX{index + 1}"] = {
+            'location': {'lat': 10 + index * 0.01, 'long': 106 + index * 0.01},
+            'connections': dict(zip(range(1, fiber_count + 1), outputs)),
+            'fiber_count': fiber_count
+        }
+    check.init_store('memory')
+    check.rebuild_indexes()
+    check.mark_data_changed()
+
+
+class WorkdirTestCase(unittest.TestCase):
+    """Mỗi test chạy trong thư mục tạm riêng"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='mx_test_')
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        patcher = mock.patch.object(check, 'MAIN_EXCEL_FILE', os.path.join(self.workdir, 'mx.xlsx'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class StreamWorkbookTest(WorkdirTestCase):
+
+    def test_stream_round_trip(self):
+        build_network(3)
+        for mx_name, fiber_count in (('MX96', 96), ('MX288', 288)):
+            outputs = list(range(fiber_count, 0, -1))
+            check.register_new_mx(mx_name, 11.0, 107.0, dict(zip(range(1, fiber_count + 1), outputs)), fiber_count)
+        check.create_excel_file(check.MAIN_EXCEL_FILE, write_only=True)
+
+        closures, errors = check.load_network_from_workbook(check.MAIN_EXCEL_FILE, workers=1)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(closures), 5)
+        for mx_name, lat, long, connections, fiber_count in closures:
+            mx_data = check.get_store().get(mx_name)
+            self.assertEqual(fiber_count, check.get_fiber_count(mx_data))
+            self.assertEqual(connections, dict(mx_data['connections'].items()))
+            self.assertEqual((lat, long), (mx_data['location']['lat'], mx_data['location']['long']))
+
+        workbook = check.openpyxl.load_workbook(check.MAIN_EXCEL_FILE)
+        sheet = workbook['MX288']
+        self.assertEqual(sheet['B1'].value, 'MX288')
+        self.assertEqual(sheet['F5'].value, 288)
+        self.assertTrue(sheet['A4'].font.b)
+        self.assertEqual(sheet['E5'].fill.fgColor.rgb, workbook['MX1']['E5'].fill.fgColor.rgb)
+
+    def test_invalid_sheet_title_keeps_old_file(self):
+        build_network(2)
+        check.create_excel_file(check.MAIN_EXCEL_FILE, write_only=True)
+        with open(check.MAIN_EXCEL_FILE, 'rb') as file:
+            before = file.read()
+
+        for mx_name in ('A' * 40, 'X/Y', 'CTRL\x01X'):
+            with self.subTest(mx_name=mx_name):
+                build_network(2)
+                check.get_store().add(mx_name, 10.0, 106.0, dict(zip(range(1, 25), range(1, 25))), 24)
+                with self.assertRaises(Exception):
+                    check.create_excel_file(check.MAIN_EXCEL_FILE, write_only=True)
+                with open(check.MAIN_EXCEL_FILE, 'rb') as file:
+                    self.assertEqual(file.read(), before)
+        self.assertEqual(os.listdir(self.workdir), ['mx.xlsx'])
+
+    def test_cell_with_control_character_is_rejected(self):
+        with self.assertRaises(ValueError):
+            check._xlsx_cell('G5', 'ghi chú\x0b')
+
+    @unittest.skipUnless(resource, "cần module resource")
+    def test_stream_many_closures_with_few_file_descriptors(self):
+        build_network(1500)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, hard), hard))
+        try:
+            check.create_excel_file(check.MAIN_EXCEL_FILE, write_only=True)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        with zipfile.ZipFile(check.MAIN_EXCEL_FILE) as zin:
+            self.assertEqual(len(check._xlsx_sheet_parts(zin)), 1500)
+
+
+class NameIndexTest(unittest.TestCase):
+
+    def test_prefix_prefers_short_names(self):
+        index = check.NameIndex()
+        index.rebuild([f"MX{number}" for number in range(1, 2000)])
+        self.assertEqual(index.prefix('mx', 5), ['MX1', 'MX2', 'MX3', 'MX4', 'MX5'])
+        self.assertEqual(index.prefix('MX2', 3), ['MX2', 'MX20', 'MX21'])
+
+        index.remove('MX2')
+        self.assertEqual(index.prefix('MX2', 2), ['MX20', 'MX21'])
+        self.assertEqual(len(index), 1998)
+
+    def test_resolve_unique_prefix(self):
+        index = check.NameIndex()
+        index.rebuild(['TRAM-A1', 'TRAM-B1', 'MX1'])
+        self.assertEqual(index.resolve('tram-b'), ('TRAM-B1', []))
+        self.assertEqual(index.resolve('TRAM')[0], None)
+
+
+class NearQueryTest(unittest.IsolatedAsyncioTestCase):
+
+    def test_parse_radius(self):
+        self.assertEqual(check.parse_near_query('10.5,106.5,2km'), (10.5, 106.5, check.NEAR_MX_DEFAULT_K, 2.0))
+        self.assertEqual(check.parse_near_query('10.5 106.5'), (10.5, 106.5, check.NEAR_MX_DEFAULT_K, None))
+        for option in ('nankm', 'infkm', '-infkm', '0km', f"{check.NEAR_MX_MAX_RADIUS_KM + 1}km", '0', '21'):
+            with self.subTest(option=option):
+                with self.assertRaises(ValueError):
+                    check.parse_near_query(f"10.5,106.5,{option}")
+
+    async def test_radius_reply_reports_truncation(self):
+        build_network(check.NEAR_MX_MAX_K + 5)
+        update = mock.Mock()
+        update.message.reply_text = mock.AsyncMock()
+        await check.reply_nearest_mx(update, 10.0, 106.0, radius_km=check.NEAR_MX_MAX_RADIUS_KM)
+        text = update.message.reply_text.await_args.args[0]
+        self.assertTrue(text.startswith(f"{check.NEAR_MX_MAX_K + 5} măng xông trong bán kính"))
+        self.assertIn(f"chỉ hiển thị {check.NEAR_MX_MAX_K}", text)
+        self.assertIn(f"{check.NEAR_MX_MAX_K}. MX", text)
+        self.assertNotIn(f"{check.NEAR_MX_MAX_K + 1}. MX", text)
+
+
+class EditMxNameTest(unittest.IsolatedAsyncioTestCase):
+
+    async def edit(self, text):
+        update = mock.Mock()
+        update.message.text = text
+        update.message.reply_text = mock.AsyncMock()
+        context = mock.Mock(user_data={})
+        state = await check.handle_edit_mx(update, context)
+        return state, context.user_data, update.message.reply_text.await_args_list[0].args[0]
+
+    async def test_prefix_and_typo_resolve_like_getmx(self):
+        build_network(1)
+        check.register_new_mx('TRAM-BENTHANH', 10.7, 106.7, {fiber: fiber for fiber in range(1, 25)}, 24)
+
+        state, user_data, _ = await self.edit('tram-ben')
+        self.assertEqual(state, check.EDIT_MX_CONNECTION)
+        self.assertEqual(user_data['edit_session'].mx_name, 'TRAM-BENTHANH')
+
+        state, user_data, reply = await self.edit('TRAM-BENTANH')
+        self.assertEqual(state, check.EDIT_MX)
+        self.assertNotIn('edit_session', user_data)
+        self.assertIn('- TRAM-BENTHANH', reply)
+
+        state, _, reply = await self.edit('KHONGCO')
+        self.assertEqual(state, check.ConversationHandler.END)
+        self.assertIn('Không tìm thấy măng xông KHONGCO', reply)
+
+
+class ValidateMxNameTest(unittest.TestCase):
+
+    def test_excel_sheet_name_rules(self):
+        for mx_name in ('MX1', 'TRAM-A.01', 'A' * 31, "O'NEIL"):
+            with self.subTest(mx_name=mx_name):
+                check.validate_mx_name(mx_name)
+        for mx_name in ('', 'A' * 32, 'X/Y', 'A[1]', 'B:C', 'D*', 'E?', 'F\\G', 'CTRL\x01X', "'MX1"):
+            with self.subTest(mx_name=mx_name):
+                with self.assertRaises(ValueError):
+                    check.validate_mx_name(mx_name)
+
+
+class ValidateImportRowsTest(unittest.TestCase):
+
+    @staticmethod
+    def _rows(closures):
+        rows = [(1, ['TenMX', 'Lat', 'Long', 'DauVao', 'DauRa'])]
+        for name, pairs in closures:
+            if not pairs:
+                rows.append((len(rows) + 1, [name, '10.5', '106.5', '', '']))
+            for input_fiber, output_fiber in pairs:
+                rows.append((len(rows) + 1, [name, '10.5', '106.5', str(input_fiber), str(output_fiber)]))
+        return rows
+
+    def test_only_complete_permutations_are_valid(self):
+        full = [(fiber, 25 - fiber) for fiber in range(1, 25)]
+        valid, errors = check.validate_import_rows(self._rows([
+            ('MXA', full), ('MXB', full[:2] + full[5:]), ('MXC', []),
+        ]))
+        self.assertEqual([closure[0] for closure in valid], ['MXA'])
+        self.assertEqual(dict(valid[0][3].items()), dict(full))
+        messages = {name: message for _, name, message in errors}
+        self.assertEqual(set(messages), {'MXB', 'MXC'})
+        self.assertIn('3/24', messages['MXB'])
+        self.assertIn('3-5', messages['MXB'])
+        self.assertIn('24/24', messages['MXC'])
+
+    def test_names_that_are_not_sheet_names_are_rejected(self):
+        full = [(fiber, fiber) for fiber in range(1, 25)]
+        valid, errors = check.validate_import_rows(self._rows([('MX/1', full), ('A' * 32, full), ('MX1', full)]))
+        self.assertEqual([closure[0] for closure in valid], ['MX1'])
+        self.assertEqual({name for _, name, _ in errors}, {'MX/1', 'A' * 32})
+
+
+class ImportDocumentTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_store_write_runs_off_the_event_loop(self):
+        build_network(1)
+        rows = ['TenMX,Lat,Long,DauVao,DauRa'] + [f"MXNEW,10.5,106.5,{fiber},{fiber}" for fiber in range(1, 25)]
+        data = "\n".join(rows).encode('utf-8')
+        update = mock.Mock()
+        update.effective_user.username = 'test'
+        update.message.reply_text = mock.AsyncMock()
+        update.message.document.file_name = 'mx.csv'
+        update.message.document.file_size = len(data)
+        update.message.document.get_file = mock.AsyncMock(return_value=mock.Mock(
+            download_as_bytearray=mock.AsyncMock(return_value=bytearray(data))))
+
+        store = check.get_store()
+        threads = []
+        add_many = store.add_many
+
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return add_many(*args, **kwargs)
+
+        with mock.patch.object(store, 'add_many', record_thread), \
+                mock.patch.object(check, 'WORKBOOK_FLUSHER') as flusher:
+            await check.handle_import_document(update, mock.Mock())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.assertIn('MXNEW', store)
+        self.assertEqual(check.resolve_mx_name('mxne'), ('MXNEW', []))
+        flusher.mark_dirty.assert_called_once_with('MXNEW')
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def test_write_without_invalidation_is_not_served_stale(self):
+        build_network(2)
+        before, _ = check.render_splice_table('MX1')
+        self.assertIs(check.render_splice_table('MX1')[0], before)
+
+        # Ghi thẳng vào kho như khi nạp lại từ worker khác, không gọi mark_data_changed
+        connections = dict(zip(range(1, 25), range(24, 0, -1)))
+        self.assertTrue(check.get_store().update_connections('MX1', connections))
+        after, _ = check.render_splice_table('MX1')
+        self.assertNotEqual(after, before)
+        self.assertEqual(after, check._render_splice_pages(check.SpliceMap(24, connections), 24)[0])
+
+
+class ConnectionSpecTest(unittest.TestCase):
+
+    def test_valid_specs(self):
+        cases = [
+            ('1:2', 24, [(1, 2)]),
+            (' 3 : 4 ', 24, [(3, 4)]),
+            ('1:2, 3:4; 5:6', 24, [(1, 2), (3, 4), (5, 6)]),
+            ('1-3:13-15', 24, [(1, 13), (2, 14), (3, 15)]),
+            ('3-1:1-3', 24, [(3, 1), (2, 2), (1, 3)]),
+            ('straight', 4, [(1, 1), (2, 2), (3, 3), (4, 4)]),
+            ('THANG 5-6', 24, [(5, 5), (6, 6)]),
+            ('pairswap 1-4', 24, [(1, 2), (2, 1), (3, 4), (4, 3)]),
+            ('doicap', 2, [(1, 2), (2, 1)]),
+            ('straight 1-2\n3-4:4-3\n\n5:6,', 24, [(1, 1), (2, 2), (3, 4), (4, 3), (5, 6)]),
+        ]
+        for text, fiber_count, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(check.parse_connection_spec(text, fiber_count), expected)
+
+    def test_invalid_specs(self):
+        cases = [
+            ('', 'Không có cặp đấu nối nào'),
+            (' , ;\n', 'Không có cặp đấu nối nào'),
+            ('1', 'không đúng định dạng'),
+            ('1:2:3', 'không đúng định dạng'),
+            ('a:2', 'không phải số sợi'),
+            ('1-2-3:4', 'không phải số sợi'),
+            ('0:1', 'Số sợi phải từ 1 đến 24'),
+            ('1:25', 'Số sợi phải từ 1 đến 24'),
+            ('1-3:4-5', 'không cùng độ dài'),
+            ('pairswap 1-3', 'cần một số chẵn sợi'),
+            ('straight 1-30', 'Số sợi phải từ 1 đến 24'),
+            ('1:2, oops', 'không đúng định dạng'),
+        ]
+        for text, message in cases:
+            with self.subTest(text=text), self.assertRaisesRegex(ValueError, message):
+                check.parse_connection_spec(text, 24)
+
+    def test_new_pairs_are_all_or_nothing(self):
+        connections = check.SpliceMap(24, {1: 1})
+        cases = [
+            ('2:2, 3:3, 1:5', ['Sợi đầu vào 1 đã được nhập trước đó']),
+            ('2:1', ['Sợi đầu ra 1 đã được sử dụng bởi sợi đầu vào 1']),
+            ('2:3, 2:4', ['Sợi đầu vào 2 được nhập nhiều lần']),
+            ('2:3, 4:3', ['Sợi đầu ra 3 được dùng cho cả đầu vào 2 và 4']),
+            ('straight 2-3, 3:5', ['Sợi đầu vào 3 được nhập nhiều lần']),
+        ]
+        for text, errors in cases:
+            with self.subTest(text=text):
+                updated, found = check.apply_new_pairs(connections, check.parse_connection_spec(text))
+                self.assertEqual(found, errors)
+                self.assertIs(updated, connections)
+                self.assertEqual(dict(connections.items()), {1: 1})
+
+        updated, errors = check.apply_new_pairs(connections, check.parse_connection_spec('2-3:3-2'))
+        self.assertEqual(errors, [])
+        self.assertEqual(dict(updated.items()), {1: 1, 2: 3, 3: 2})
+        self.assertEqual(dict(connections.items()), {1: 1})
+
+    def test_edit_pairs_swap_or_reject_atomically(self):
+        connections = check.SpliceMap(4, {1: 1, 2: 2, 3: 3, 4: 4})
+        updated, swapped, errors = check.apply_edit_pairs(
+            connections, check.parse_connection_spec('1:2', 4))
+        self.assertEqual((dict(updated.items()), swapped, errors), ({1: 2, 2: 1, 3: 3, 4: 4}, {2: 1}, []))
+
+        partial = check.SpliceMap(4, {1: 1, 2: 2})
+        for text, error in (('1:2, 3:3', 'Sợi đầu vào 3 không tồn tại trong măng xông'),
+                            ('pairswap 1-2, 1:1', 'Sợi đầu vào 1 được nhập nhiều lần')):
+            with self.subTest(text=text):
+                result = check.apply_edit_pairs(partial, check.parse_connection_spec(text, 4))
+                self.assertEqual(result, (partial, {}, [error]))
+                self.assertEqual(dict(partial.items()), {1: 1, 2: 2})
+
+
+class CableGraphTest(unittest.TestCase):
+    """MX1 -> MX2 -> MX3 nối tiếp, MX4 đứng riêng"""
+
+    def setUp(self):
+        build_network(4)
+        self.identity = {fiber: fiber for fiber in range(1, 25)}
+        self.reverse = {fiber: 25 - fiber for fiber in range(1, 25)}
+        for mx_name, connections in (('MX1', self.identity), ('MX2', self.reverse),
+                                     ('MX3', self.identity), ('MX4', self.identity)):
+            self.assertTrue(check.update_mx_connections(mx_name, connections))
+        check.link_cable_segment('MX1', 'MX2')
+        check.link_cable_segment('MX2', 'MX3')
+        patcher = mock.patch.object(check, 'METRICS', check.MetricsRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _trace_lookups(self):
+        counters, _ = check.METRICS.snapshot()
+        return tuple(counters.get(('mx_cache_requests_total', (('cache', 'trace'), ('result', result))), 0)
+                     for result in ('hit', 'miss'))
+
+    def test_trace_is_shared_by_every_hop(self):
+        trace = check.trace_fiber('MX2', 24)
+        self.assertEqual(trace.hops, (('MX1', 24, 24), ('MX2', 24, 1), ('MX3', 1, 1)))
+        self.assertFalse(trace.loop)
+        self.assertIs(check.trace_fiber('MX1', 24), trace)
+        self.assertIs(check.trace_fiber('MX3', 1), trace)
+        self.assertIsNot(check.trace_fiber('MX3', 2), trace)
+        self.assertEqual(self._trace_lookups(), (2, 2))
+
+    def test_connection_update_drops_traces_through_the_closure(self):
+        trace = check.trace_fiber('MX1', 1)
+        other = check.trace_fiber('MX4', 1)
+        self.assertTrue(check.update_mx_connections('MX3', {**self.identity, 24: 23, 23: 24}))
+
+        retraced = check.trace_fiber('MX1', 1)
+        self.assertIsNot(retraced, trace)
+        self.assertEqual(retraced.hops[-1], ('MX3', 24, 23))
+        self.assertIs(check.trace_fiber('MX4', 1), other)
+        # Cập nhật bị từ chối (sai phiên bản) không làm mất trace
+        self.assertFalse(check.update_mx_connections('MX2', self.identity, expected_version=0))
+        self.assertIs(check.trace_fiber('MX2', 1), retraced)
+
+    def test_linking_cables_drops_traces_on_both_sides(self):
+        trace = check.trace_fiber('MX1', 1)
+        check.link_cable_segment('MX3', 'MX4')
+        extended = check.trace_fiber('MX1', 1)
+        self.assertIsNot(extended, trace)
+        self.assertEqual([hop[0] for hop in extended.hops], ['MX1', 'MX2', 'MX3', 'MX4'])
+        self.assertIs(check.trace_fiber('MX4', 24), extended)
+
+        check.link_cable_segment('MX2', None)
+        self.assertEqual(check.trace_fiber('MX1', 1).hops, (('MX1', 1, 1), ('MX2', 1, 24)))
+        self.assertEqual(check.trace_fiber('MX4', 24).hops, (('MX3', 24, 24), ('MX4', 24, 24)))
+
+        check.link_cable_segment('MX4', 'MX1')
+        check.link_cable_segment('MX2', 'MX3')
+        looped = check.trace_fiber('MX1', 1)
+        # MX2 đảo sợi nên sợi 1 đi hai vòng (qua sợi 1 và sợi 24) rồi mới gặp lại chặng cũ
+        self.assertTrue(looped.loop)
+        self.assertEqual(len(looped.hops), 8)
+        self.assertEqual({(hop[0], hop[1]) for hop in looped.hops},
+                         {(mx_name, fiber) for mx_name in ('MX1', 'MX2', 'MX3', 'MX4') for fiber in (1, 24)})
+        self.assertIs(check.trace_fiber('MX3', 24), looped)
+
+    def test_link_errors_keep_the_graph(self):
+        trace = check.trace_fiber('MX1', 1)
+        check.register_new_mx('MX12', 11.0, 107.0, {fiber: fiber for fiber in range(1, 13)}, 12)
+        for from_mx, to_mx, message in (('MX1', 'MX1', 'chính nó'), ('MX4', 'MX2', 'đang nối với MX1'),
+                                        ('MX3', 'MX12', 'Số sợi không khớp'), ('MX9', 'MX1', 'Không tìm thấy')):
+            with self.subTest(from_mx=from_mx, to_mx=to_mx), self.assertRaisesRegex(ValueError, message):
+                check.link_cable_segment(from_mx, to_mx)
+        self.assertIs(check.trace_fiber('MX1', 1), trace)
+        self.assertEqual(check.CABLE_GRAPH.next_of('MX1'), 'MX2')
+        self.assertIsNone(check.CABLE_GRAPH.prev_of('MX4'))
+
+
+class CommitEditSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        build_network(1)
+        identity = {fiber: fiber for fiber in range(1, 25)}
+        self.assertTrue(check.update_mx_connections('MX1', identity))
+
+    def _edit(self, session, pairs):
+        draft, swapped, errors = check.apply_edit_pairs(session.draft, pairs)
+        self.assertEqual(errors, [])
+        session.apply(draft, pairs, swapped)
+
+    def _other_user_edits(self, pairs):
+        other = check.EditSession('MX1', check.get_store().get('MX1'))
+        self._edit(other, pairs)
+        self.assertEqual(check.commit_edit_session(other), (True, [], []))
+
+    def test_swap_induced_clash_names_the_typed_fiber(self):
+        session = check.EditSession('MX1', check.get_store().get('MX1'))
+        self._edit(session, [(1, 9)])
+        self.assertEqual(session.swap_causes, {9: 1})
+        self._other_user_edits([(5, 9)])
+
+        success, clashes, merged_swaps = check.commit_edit_session(session)
+        self.assertFalse(success)
+        self.assertEqual(clashes, [(9, 1, 5, 1)])
+        self.assertEqual(merged_swaps, [])
+
+    def test_merge_reports_swap_induced_changes(self):
+        session = check.EditSession('MX1', check.get_store().get('MX1'))
+        self._edit(session, [(1, 9)])
+        self._other_user_edits([(2, 3)])
+
+        self.assertEqual(check.commit_edit_session(session), (True, [], [(9, 1, 1)]))
+        connections = check.get_store().get('MX1')['connections']
+        self.assertEqual([connections[fiber] for fiber in (1, 2, 3, 9)], [9, 3, 2, 1])
+
+    def test_explicit_edit_clears_swap_cause(self):
+        session = check.EditSession('MX1', check.get_store().get('MX1'))
+        self._edit(session, [(1, 9)])
+        self._edit(session, [(9, 1)])
+        self.assertEqual(session.swap_causes, {})
+
+
+class PerConversationUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_burst_from_one_chat_does_not_block_other_chats(self):
+        processor = check.PerConversationUpdateProcessor(2)
+        release = asyncio.Event()
+        order = []
+
+        async def handle(name, wait):
+            order.append(f"start {name}")
+            if wait:
+                await release.wait()
+            order.append(f"end {name}")
+
+        tasks = [asyncio.create_task(processor.process_update(make_update(index, 1), handle(f"a{index}", True)))
+                 for index in range(5)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(make_update(10, 2), handle('b', False)), 1)
+        self.assertEqual(order, ['start a0', 'start b', 'end b'])
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual([step for step in order if step.startswith('start a')],
+                         [f"start a{index}" for index in range(5)])
+
+
+class FakeClock:
+    """Đồng hồ cho OutboundScheduler: chỉ chạy khi test gọi advance"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class OutboundSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.clock = FakeClock()
+        self.sent = []
+        self.failures = {}
+
+    def scheduler(self, **rates):
+        # Token nạp nhanh (vài chục ms thời gian thật) để vòng lặp gửi thử lại sớm,
+        # nhưng chỉ có token mới khi test cho đồng hồ chạy
+        rates = {'global_rate': 20, 'global_burst': 20, 'chat_rate': 20, 'chat_burst': 20, **rates}
+        scheduler = check.OutboundScheduler(clock=self.clock, **rates)
+        self.addAsyncCleanup(scheduler.shutdown)
+        return scheduler
+
+    async def _callback(self, text):
+        failures = self.failures.get(text)
+        if failures:
+            self.failures[text] -= 1
+            raise check.RetryAfter(0.05)
+        self.sent.append(text)
+        return text
+
+    def send(self, scheduler, chat_id, text, rate_limit_args=None):
+        return asyncio.create_task(scheduler.process_request(
+            self._callback, (text,), {}, 'sendMessage', {'chat_id': chat_id}, rate_limit_args
+        ))
+
+    @staticmethod
+    async def settle(seconds=0.0):
+        await asyncio.sleep(seconds)
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def test_interactive_messages_go_before_progress(self):
+        scheduler = self.scheduler(global_burst=1)
+        tasks = [self.send(scheduler, 1, 'progress 1', check.PROGRESS_RATE_LIMIT),
+                 self.send(scheduler, 2, 'progress 2', {'priority': check.PRIORITY_PROGRESS}),
+                 self.send(scheduler, 3, 'reply 3'),
+                 self.send(scheduler, 4, 'reply 4')]
+        await self.settle()
+        self.assertEqual(self.sent, ['reply 3'])
+
+        for _ in range(3):
+            self.clock.advance(1 / 20)
+            await self.settle(0.1)
+        self.assertEqual(self.sent, ['reply 3', 'reply 4', 'progress 1', 'progress 2'])
+        self.assertEqual(await asyncio.gather(*tasks), ['progress 1', 'progress 2', 'reply 3', 'reply 4'])
+
+    async def test_waiting_progress_messages_are_merged(self):
+        scheduler = self.scheduler(chat_burst=1)
+        first = self.send(scheduler, 1, 'reply')
+        await self.settle()
+        progress = [self.send(scheduler, 1, f"{percent}%", check.PROGRESS_RATE_LIMIT) for percent in (10, 50, 90)]
+        other_chat = self.send(scheduler, 2, '20%', check.PROGRESS_RATE_LIMIT)
+        await self.settle(0.1)
+        self.assertEqual(self.sent, ['reply', '20%'])
+        self.assertEqual(scheduler.queue_depth, 1)
+
+        self.clock.advance(1 / 20)
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(*progress), 1), ['90%'] * 3)
+        self.assertEqual(self.sent, ['reply', '20%', '90%'])
+        self.assertEqual((scheduler.sent, scheduler.merged), (3, 2))
+        await asyncio.gather(first, other_chat)
+
+    async def test_retry_after_pauses_every_chat(self):
+        scheduler = self.scheduler()
+        self.failures['flood'] = 1
+        flood = self.send(scheduler, 1, 'flood')
+        await self.settle()
+        self.assertEqual((self.sent, scheduler.retried), ([], 1))
+
+        later = self.send(scheduler, 2, 'later')
+        await self.settle(0.2)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(scheduler.queue_depth, 2)
+
+        self.clock.advance(0.05)
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(flood, later), 1), ['flood', 'later'])
+        self.assertEqual(self.sent, ['flood', 'later'])
+
+    async def test_retried_progress_defers_to_newer_progress(self):
+        scheduler = self.scheduler(chat_burst=1)
+        release = asyncio.Event()
+
+        async def callback(text):
+            if text == '10%':
+                await release.wait()
+                raise check.RetryAfter(0.05)
+            self.sent.append(text)
+            return text
+
+        def send(text):
+            return asyncio.create_task(scheduler.process_request(
+                callback, (text,), {}, 'sendMessage', {'chat_id': 1}, check.PROGRESS_RATE_LIMIT))
+
+        old = send('10%')
+        await self.settle()
+        new = send('50%')
+        await self.settle()
+        release.set()
+        await self.settle()
+        self.assertEqual(scheduler.queue_depth, 1)
+
+        latest = send('90%')
+        self.clock.advance(1)
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(old, new, latest), 1), ['90%'] * 3)
+        self.assertEqual(self.sent, ['90%'])
+        self.assertEqual((scheduler.sent, scheduler.retried, scheduler.merged), (1, 0, 2))
+
+    async def test_retry_after_gives_up_after_max_retries(self):
+        scheduler = self.scheduler(max_retries=1)
+        self.failures['flood'] = 2
+        flood = self.send(scheduler, 1, 'flood')
+        await self.settle()
+        self.clock.advance(0.05)
+        with self.assertRaises(check.RetryAfter):
+            await asyncio.wait_for(flood, 1)
+        self.assertEqual((scheduler.sent, scheduler.retried), (0, 1))
+
+
+class JournalCommitOrderTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        path = os.path.join(self.workdir, 'mx.db')
+        self.stores = [check.SQLiteStore({}, path), check.SQLiteStore({}, path)]
+        for store in self.stores:
+            self.addCleanup(store.close)
+        self.journal = check.ChangeJournal(os.path.join(self.workdir, 'journal.jsonl'))
+        self.addCleanup(self.journal.close)
+        self.journal.ensure_baseline(self.stores[0])
+
+        identity = {fiber: fiber for fiber in range(1, 25)}
+        self.stores[0].add('MX1', 10.0, 106.0, identity, 24,
+                           [check.ChangeJournal.add_entry('MX1', 10.0, 106.0, identity, 24)])
+        self.stores[1].load()
+
+    def _set(self, store, pairs, user):
+        old = store.get('MX1')
+        connections = dict(old['connections'].items())
+        for input_fiber, output_fiber in pairs:
+            connections[input_fiber] = output_fiber
+        entry = check.ChangeJournal.connections_entry('MX1', old['connections'], connections, user)
+        self.assertTrue(store.update_connections('MX1', connections, check.get_data_version(old), [entry]))
+
+    def test_entries_are_exported_in_commit_order(self):
+        first, second = self.stores
+        # Worker đầu commit nhưng chưa kịp chép sang file; worker sau commit rồi chép trước
+        self._set(first, [(1, 2), (2, 1)], 'a')
+        second.reload(['MX1'])
+        self._set(second, [(3, 4), (4, 3)], 'b')
+        self.assertEqual(self.journal.sync(second), 3)
+        self.assertEqual(self.journal.sync(first), 0)
+
+        entries = [entry for _, entry in self.journal.iter_entries()]
+        self.assertEqual([(entry['op'], entry['u']) for entry in entries], [('add', None), ('set', 'a'), ('set', 'b')])
+        self.assertEqual([entry['s'] for entry in entries], sorted(entry['s'] for entry in entries))
+        network, _, _ = self.journal.rebuild()
+        second.load()
+        self.assertEqual(network['MX1']['c'], dict(second.get('MX1')['connections'].items()))
+
+    def test_committed_entries_survive_a_crash_before_export(self):
+        self._set(self.stores[0], [(1, 2), (2, 1)], 'a')
+        rows = self.stores[0]._conn.execute('SELECT seq, entry FROM journal ORDER BY seq').fetchall()
+        # Đã chép sang file nhưng dừng trước khi xóa khỏi kho: lần chép sau không ghi lặp
+        self.journal.export(rows[:1])
+
+        restarted = check.ChangeJournal(self.journal.path)
+        self.addCleanup(restarted.close)
+        self.assertEqual(restarted.sync(self.stores[1]), 2)
+        self.assertEqual([entry['op'] for _, entry in restarted.iter_entries()], ['add', 'set'])
+        self.assertEqual(self.stores[1].drain_journal(restarted.export), 0)
+
+
+class ChangeJournalTest(WorkdirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.journal = check.ChangeJournal(os.path.join(self.workdir, 'journal.jsonl'))
+        self.addCleanup(self.journal.close)
+        self.seq = 0
+
+    def write(self, t, entry):
+        self.seq += 1
+        self.journal.export([(self.seq, json.dumps({'t': t, **entry}))])
+
+    def offset(self):
+        return os.path.getsize(self.journal.path)
+
+    def test_rebuild_picks_snapshot_and_stops_at_as_of(self):
+        identity = {fiber: fiber for fiber in range(1, 25)}
+        self.journal._write_snapshot({'MX1': {'lat': 10.0, 'long': 106.0, 'n': 24, 'c': dict(identity)}}, 0, 100.0)
+        self.write(200.0, check.ChangeJournal.connections_entry('MX1', identity, {**identity, 1: 2, 2: 1}))
+        self.write(300.0, check.ChangeJournal.add_entry('MX2', 11.0, 107.0, identity, 24))
+        # Ảnh chụp sau: vĩ độ khác để biết ảnh nào được dùng
+        later = {'MX1': {'lat': 12.0, 'long': 106.0, 'n': 24, 'c': {**identity, 1: 2, 2: 1}},
+                 'MX2': {'lat': 11.0, 'long': 107.0, 'n': 24, 'c': dict(identity)}}
+        self.journal._write_snapshot(later, self.offset(), 300.0)
+        self.write(400.0, check.ChangeJournal.link_entry('MX1', 'MX2'))
+
+        network, offset, timestamp = self.journal.rebuild()
+        self.assertEqual((network['MX1']['lat'], network['MX1']['next']), (12.0, 'MX2'))
+        self.assertEqual((offset, timestamp), (self.offset(), 400.0))
+
+        network, _, timestamp = self.journal.rebuild(as_of=250.0)
+        self.assertEqual(sorted(network), ['MX1'])
+        self.assertEqual(network['MX1']['lat'], 10.0)
+        self.assertEqual((network['MX1']['c'][1], network['MX1']['c'][2], timestamp), (2, 1, 200.0))
+
+        network, _, _ = self.journal.rebuild(as_of=350.0)
+        self.assertEqual(network['MX1']['lat'], 12.0)
+        self.assertNotIn('next', network['MX1'])
+
+        with self.assertRaises(ValueError):
+            self.journal.rebuild(as_of=50.0)
+
+    def test_apply_replays_every_operation(self):
+        network = {}
+        check.ChangeJournal._apply(network, {'op': 'add', 'mx': 'MX1', 'lat': 1.0, 'long': 2.0, 'n': 24,
+                                             'c': {'1': 1, '2': 2}})
+        check.ChangeJournal._apply(network, {'op': 'set', 'mx': 'MX1', 'd': {'1': [1, 2], '2': [2, None]}})
+        check.ChangeJournal._apply(network, {'op': 'set', 'mx': 'MXX', 'd': {'1': [1, 2]}})
+        check.ChangeJournal._apply(network, {'op': 'link', 'mx': 'MX1', 'next': 'MX2'})
+        self.assertEqual(network, {'MX1': {'lat': 1.0, 'long': 2.0, 'n': 24, 'c': {1: 2}, 'next': 'MX2'}})
+        check.ChangeJournal._apply(network, {'op': 'link', 'mx': 'MX1', 'next': None})
+        self.assertNotIn('next', network['MX1'])
+
+    def test_partly_written_last_line_is_skipped(self):
+        self.journal._write_snapshot({}, 0, 100.0)
+        self.write(200.0, check.ChangeJournal.link_entry('MX1', None))
+        with open(self.journal.path, 'ab') as file:
+            file.write(b'{"t":300.0,"u":null,"op":"add","mx":"MX')
+        self.assertEqual([entry['t'] for _, entry in self.journal.iter_entries()], [200.0])
+        self.assertEqual(self.journal.rebuild()[2], 200.0)
+
+        # Dòng ghi tiếp theo không dính vào dòng ghi dở
+        self.write(400.0, check.ChangeJournal.add_entry('MX3', 1.0, 2.0, {1: 1}, 24))
+        with self.assertLogs(check.logger, 'WARNING'):
+            entries = [entry for _, entry in self.journal.iter_entries()]
+            network = self.journal.rebuild()[0]
+        self.assertEqual([(entry['t'], entry['s']) for entry in entries], [(200.0, 1), (400.0, 2)])
+        self.assertEqual(sorted(network), ['MX3'])
+
+    def test_history_lists_newest_first(self):
+        for t in range(1, 25):
+            self.write(float(t), check.ChangeJournal.link_entry('MX1' if t % 2 else 'MX10', None, user=str(t)))
+        history = self.journal.history('MX1', limit=3)
+        self.assertEqual([entry['u'] for entry in history], ['23', '21', '19'])
+
+
+class RebuildWorkbookAsOfTest(WorkdirTestCase):
+
+    def test_writes_past_network_without_touching_the_store(self):
+        build_network(3)
+        store = check.get_store()
+        path = os.path.join(self.workdir, 'journal.jsonl')
+        journal = check.ChangeJournal(path)
+        self.addCleanup(journal.close)
+        journal._write_snapshot({'PAST1': {'lat': 11.0, 'long': 107.0, 'n': 24,
+                                           'c': {fiber: 25 - fiber for fiber in range(1, 25)}}}, 0, 1000.0)
+
+        output = os.path.join(self.workdir, 'past.xlsx')
+        with mock.patch.object(check, 'JOURNAL_FILE', path):
+            check.rebuild_workbook_as_of(2000.0, output)
+        self.assertIs(check.get_store(), store)
+        self.assertEqual(len(store), 3)
+
+        closures, errors = check.load_network_from_workbook(output, workers=1)
+        self.assertEqual(errors, [])
+        self.assertEqual([closure[0] for closure in closures], ['PAST1'])
+        self.assertEqual(closures[0][3], {fiber: 25 - fiber for fiber in range(1, 25)})
+
+
+class ClusterSyncTest(WorkdirTestCase, unittest.IsolatedAsyncioTestCase):
+    """Hai worker dùng chung một file SQLite, mỗi worker một SQLiteStore"""
+
+    def setUp(self):
+        super().setUp()
+        path = os.path.join(self.workdir, 'mx.db')
+        self.remote, self.local = check.SQLiteStore({}, path), check.SQLiteStore({}, path)
+        for store, origin in ((self.remote, 'w1'), (self.local, 'w2')):
+            store.origin = origin
+            self.addCleanup(store.close)
+        self.identity = {fiber: fiber for fiber in range(1, 25)}
+        self.assertTrue(self.remote.add('MX1', 10.0, 106.0, self.identity, 24))
+        self.local.load()
+
+        for name, value in (('_STORE', self.local), ('WORKBOOK_FLUSHER', mock.Mock()),
+                            ('create_excel_file_async', mock.AsyncMock())):
+            patcher = mock.patch.object(check, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        check.rebuild_indexes()
+        check.mark_data_changed()
+
+    async def test_poll_reloads_closures_written_by_other_workers(self):
+        cluster = check.ClusterSync(self.local, 'w2')
+        before, _ = check.render_splice_table('MX1')
+        swapped = {**self.identity, 1: 2, 2: 1}
+        self.assertTrue(self.remote.update_connections('MX1', swapped))
+        self.assertTrue(self.remote.add('MX2', 10.5, 106.5, self.identity, 24))
+
+        await cluster.poll()
+        self.assertEqual(dict(self.local.get('MX1')['connections'].items()), swapped)
+        self.assertEqual(check.get_data_version(self.local.get('MX1')), 2)
+        self.assertNotEqual(check.render_splice_table('MX1')[0], before)
+        self.assertEqual(check.resolve_mx_name('mx2'), ('MX2', []))
+        self.assertEqual(check.find_nearest_mx(10.5, 106.5, 1)[0][1], 'MX2')
+        # Worker giữ quyền ghi file chung xếp các măng xông đổi vào hàng đợi ghi Excel
+        self.assertTrue(cluster.is_exporter)
+        self.assertEqual({call.args[0] for call in check.WORKBOOK_FLUSHER.mark_dirty.call_args_list},
+                         {'MX1', 'MX2'})
+
+        # Thay đổi của chính worker này không cần nạp lại
+        self.assertTrue(self.local.update_connections('MX1', self.identity))
+        with mock.patch.object(cluster, 'apply') as apply:
+            await cluster.poll()
+        apply.assert_not_called()
+        self.assertEqual(cluster.last_seq, self.local.last_change())
+
+    async def test_pruned_change_log_triggers_full_reload(self):
+        cluster = check.ClusterSync(self.local, 'w2')
+        cluster.last_seq = 1
+        for output in (2, 3, 4):
+            connections = {**self.identity, 1: output, output: 1}
+            self.assertTrue(self.remote.update_connections('MX1', connections))
+        self.remote.prune_changes(1)
+
+        with mock.patch.object(self.local, 'load', wraps=self.local.load) as load, \
+                self.assertLogs(check.logger, 'WARNING'):
+            await cluster.poll()
+        load.assert_called_once_with()
+        self.assertEqual(self.local.get('MX1')['connections'][1], 4)
+
+    async def test_exporter_lease_moves_on_release_and_expiry(self):
+        first, second = check.ClusterSync(self.remote, 'w1'), check.ClusterSync(self.local, 'w2')
+        await first.poll()
+        await second.poll()
+        self.assertEqual((first.is_exporter, second.is_exporter), (True, False))
+        check.create_excel_file_async.assert_awaited_once()
+
+        first.release()
+        await second.poll()
+        await first.poll()
+        self.assertEqual((first.is_exporter, second.is_exporter), (False, True))
+
+        # Worker giữ quyền dừng đột ngột: hết hạn thì worker khác nhận quyền
+        self.local.acquire_lease(check.EXPORTER_LEASE, 'w2', -1)
+        await first.poll()
+        self.assertTrue(first.is_exporter)
+        with mock.patch.object(check, 'CLUSTER', second):
+            await second.poll()
+            self.assertFalse(check.is_workbook_exporter())
+            self.assertNotEqual(check.workbook_download_path(), check.MAIN_EXCEL_FILE)
+
+
+class WorkerForUpdateTest(unittest.TestCase):
+
+    def test_updates_of_one_user_go_to_one_worker(self):
+        self.assertEqual(check._worker_for_update(make_update(1, 7), 4), 3)
+        self.assertEqual(check._worker_for_update(make_update(2, 7, 'khác'), 4), 3)
+        self.assertEqual({check._worker_for_update(make_update(index, index), 4) for index in range(8)},
+                         {0, 1, 2, 3})
+
+        channel_post = mock.Mock(effective_user=None, update_id=11)
+        channel_post.effective_chat.id = -1001
+        self.assertEqual(check._worker_for_update(channel_post, 4), -1001 % 4)
+        bare = mock.Mock(effective_user=None, effective_chat=None, update_id=11)
+        self.assertEqual(check._worker_for_update(bare, 4), 3)
+
+
+class SQLitePersistenceTest(WorkdirTestCase, unittest.IsolatedAsyncioTestCase):
+
+    def persistence(self):
+        persistence = check.SQLitePersistence(os.path.join(self.workdir, 'state.db'))
+        self.addAsyncCleanup(persistence.flush)
+        return persistence
+
+    async def test_active_conversations_follow_state_updates(self):
+        persistence = self.persistence()
+        await persistence.update_conversation('mx', (1, 1), check.ADD_MX_NAME)
+        await persistence.update_conversation('mx', (2, 2), check.EDIT_MX)
+        await persistence.update_conversation('mx', (1, 1), check.ADD_MX_CONNECTIONS)
+        self.assertEqual(persistence.active_conversations, 2)
+        await persistence.update_conversation('mx', (2, 2), None)
+        self.assertEqual(persistence.active_conversations, 1)
+
+        restarted = self.persistence()
+        self.assertEqual(await restarted.get_conversations('mx'), {(1, 1): check.ADD_MX_CONNECTIONS})
+        self.assertEqual(restarted.active_conversations, 1)
+
+    async def test_user_data_survives_restart(self):
+        build_network(1)
+        session = check.EditSession('MX1', check.get_store().get('MX1'))
+        draft, swapped, errors = check.apply_edit_pairs(session.draft, [(1, session.draft[2])])
+        self.assertEqual(errors, [])
+        session.apply(draft, [(1, session.draft[2])], swapped)
+        new_mx = {'name': 'MX9', 'lat': 10.5, 'long': 106.5, 'fiber_count': 12,
+                  'connections': check.SpliceMap(12, {1: 2, 2: 1})}
+
+        persistence = self.persistence()
+        await persistence.update_user_data(1, {'edit_session': session})
+        await persistence.update_user_data(2, {'adding_mx': True, 'new_mx': new_mx})
+        await persistence.update_user_data(3, {'adding_mx': True})
+        await persistence.update_user_data(3, {})
+        await persistence.update_conversation('mx', (2, 2), check.ADD_MX_CONNECTIONS)
+
+        restarted = self.persistence()
+        user_data = await restarted.get_user_data()
+        self.assertEqual(set(user_data), {1, 2})
+        self.assertEqual(user_data[2], {'adding_mx': True, 'new_mx': new_mx})
+        restored = user_data[1]['edit_session']
+        self.assertEqual((restored.mx_name, restored.base_version, restored.fiber_count),
+                         (session.mx_name, session.base_version, session.fiber_count))
+        self.assertEqual(restored.draft, session.draft)
+        self.assertEqual(restored.swap_causes, session.swap_causes)
+        self.assertEqual(restored.changed_fibers(), session.changed_fibers())
+        self.assertEqual(await restarted.get_conversations('mx'), {(2, 2): check.ADD_MX_CONNECTIONS})
+
+    async def test_unchanged_user_data_is_not_rewritten(self):
+        persistence = self.persistence()
+        data = {'adding_mx': True, 'new_mx': {'name': 'MX9', 'connections': check.SpliceMap(24, {1: 1})}}
+        with mock.patch.object(persistence, '_write', wraps=persistence._write) as write:
+            await persistence.update_user_data(1, data)
+            await persistence.update_user_data(1, data)
+            self.assertEqual(write.call_count, 1)
+            data['new_mx']['connections'][2] = 3
+            await persistence.update_user_data(1, data)
+            self.assertEqual(write.call_count, 2)
+
+        # Dữ liệu nạp lại sau khi khởi động cũng được coi là đã ghi
+        restarted = self.persistence()
+        user_data = await restarted.get_user_data()
+        with mock.patch.object(restarted, '_write', wraps=restarted._write) as write:
+            await restarted.update_user_data(1, user_data[1])
+            write.assert_not_called()
+            await restarted.drop_user_data(4)
+            write.assert_not_called()
+
+
+class RestoreNetworkFromWorkbookTest(WorkdirTestCase):
+    """File Excel có MX1-MX3, sheet MX2 hỏng và một sheet ghi chú; kho có MX1, MX2 khác file"""
+
+    def setUp(self):
+        super().setUp()
+        build_network(3)
+        self.workbook = {mx_name: dict(mx_data['connections'].items())
+                         for mx_name, mx_data in check.get_store().items()}
+        check.create_excel_file(check.MAIN_EXCEL_FILE)
+        workbook = check.openpyxl.load_workbook(check.MAIN_EXCEL_FILE)
+        workbook['MX2']['B2'] = 'không rõ'
+        workbook.create_sheet('Ghi chú')['A1'] = 'Danh sách liên hệ'
+        workbook.save(check.MAIN_EXCEL_FILE)
+
+        build_network(2, seed=2)
+        self.stored = {mx_name: dict(mx_data['connections'].items())
+                       for mx_name, mx_data in check.get_store().items()}
+        self.assertNotEqual(self.stored['MX1'], self.workbook['MX1'])
+        patcher = mock.patch.object(check, 'METRICS', check.MetricsRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _restore(self):
+        with self.assertLogs(check.logger, 'WARNING') as logs:
+            restored, errors = check.restore_network_from_workbook()
+        warnings = [record.getMessage() for record in logs.records if record.levelname == 'WARNING']
+        self.assertEqual(len(warnings), len(errors))
+        counters, _ = check.METRICS.snapshot()
+        self.assertEqual(counters[('mx_workbook_malformed_sheets_total', ())], len(errors))
+        return restored, dict(errors)
+
+    def _connections(self):
+        return {mx_name: dict(mx_data['connections'].items()) for mx_name, mx_data in check.get_store().items()}
+
+    def test_memory_store_takes_connections_from_workbook(self):
+        restored, errors = self._restore()
+        self.assertEqual(set(errors), {'MX2', 'Ghi chú'})
+        self.assertIn('vị trí', errors['MX2'])
+        # MX3 được thêm, MX1 lấy đấu nối trong file, MX2 giữ nguyên vì sheet hỏng
+        self.assertEqual(restored, 2)
+        self.assertEqual(self._connections(),
+                         {'MX1': self.workbook['MX1'], 'MX2': self.stored['MX2'], 'MX3': self.workbook['MX3']})
+        self.assertEqual(check.resolve_mx_name('mx3'), ('MX3', []))
+
+    def test_sqlite_store_only_adds_missing_closures(self):
+        check.init_store('sqlite', os.path.join(self.workdir, 'mx.db'))
+        self.addCleanup(check.init_store, 'memory')
+        with mock.patch.object(check, 'load_network_from_workbook',
+                               wraps=check.load_network_from_workbook) as load:
+            restored, errors = self._restore()
+        self.assertEqual(load.call_args.kwargs['skip'], {'MX1', 'MX2'})
+        # Sheet của măng xông đã có trong kho không được đọc nên MX2 hỏng cũng không bị báo
+        self.assertEqual(set(errors), {'Ghi chú'})
+        self.assertEqual(restored, 1)
+        self.assertEqual(self._connections(),
+                         {'MX1': self.stored['MX1'], 'MX2': self.stored['MX2'], 'MX3': self.workbook['MX3']})
+
+        reopened = check.SQLiteStore({}, os.path.join(self.workdir, 'mx.db'))
+        self.addCleanup(reopened.close)
+        reopened.load()
+        self.assertEqual(dict(reopened.get('MX3')['connections'].items()), self.workbook['MX3'])
+
+    def test_missing_workbook_is_not_an_error(self):
+        os.remove(check.MAIN_EXCEL_FILE)
+        self.assertEqual(check.restore_network_from_workbook(), (0, []))
+        self.assertEqual(self._connections(), self.stored)
+
+
+class PatchExcelConnectionsTest(WorkdirTestCase):
+
+    def _round_trip(self, raw_copy):
+        build_network(5)
+        check.create_excel_file(check.MAIN_EXCEL_FILE)
+        with zipfile.ZipFile(check.MAIN_EXCEL_FILE) as zin:
+            before = {info.filename: zin.read(info) for info in zin.infolist()}
+
+        connections = dict(zip(range(1, 25), range(24, 0, -1)))
+        with mock.patch.object(check, '_ZIP_RAW_COPY', raw_copy):
+            patched = check.patch_excel_connections(check.MAIN_EXCEL_FILE, {'MX3': (connections, 24)})
+        self.assertEqual(patched, {'MX3'})
+
+        with zipfile.ZipFile(check.MAIN_EXCEL_FILE) as zin:
+            self.assertIsNone(zin.testzip())
+            after = {info.filename: zin.read(info) for info in zin.infolist()}
+        self.assertEqual(list(after), list(before))
+        changed = [name for name in before if before[name] != after[name]]
+        self.assertEqual(len(changed), 1)
+
+        closures, errors = check.load_network_from_workbook(check.MAIN_EXCEL_FILE, workers=1)
+        self.assertEqual(errors, [])
+        by_name = {closure[0]: closure for closure in closures}
+        self.assertEqual(by_name['MX3'][3], connections)
+        self.assertEqual(by_name['MX2'][3], dict(check.get_store().get('MX2')['connections'].items()))
+
+    def test_raw_copy_round_trip(self):
+        if not check._ZIP_RAW_COPY:
+            self.skipTest("phiên bản Python này không chép thẳng dữ liệu nén")
+        self._round_trip(raw_copy=True)
+
+    def test_recompress_round_trip(self):
+        self._round_trip(raw_copy=False)
+
+
+if __name__ == '__main__':
+    unittest.main()